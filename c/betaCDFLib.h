@@ -0,0 +1,14 @@
+#ifndef BETACDFLIB_H
+#define BETACDFLIB_H
+
+/* Log of the regularized incomplete beta function I_x(a, b), i.e. of the
+ Beta(a, b) cdf at x. NaN for a <= 0, b <= 0 or x outside [0, 1]. Sets
+ *usedFallback (when not NULL) if the continued fraction did not converge
+ and the asymptotic approximation was used instead. */
+double logBetaCDF(double x, double a, double b, int* usedFallback);
+
+/* logBetaCDF of n (x, a, b) triples into out; returns the number of
+ triples that needed the asymptotic approximation */
+long logBetaCDFArray(const double* x, const double* a, const double* b, double* out, long n);
+
+#endif
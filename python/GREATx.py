@@ -1,4 +1,4 @@
-#! /usr/bin/python2.7
+#!/usr/bin/env python3
 """GREAT extension classes
 
 GREATx extends GREAT by assigning weighted hits on regulatory domains on
@@ -19,15 +19,19 @@ __date__ = """13 March 2012"""
 __credits__ = """Gill Bejerano, for a thrilling tour of the genome.
 Jim Notwell and Harendra Guturu, for their advice on this project."""
 
-from scipy.stats import norm
 from math import fabs
 import collections
+import copy
+import json
 import re
+import struct
 import sys
 import os
-import operator
-import scipy.stats
-from datetime import datetime
+import scipy.special
+import scipy.sparse
+import numpy as np
+import betaCDF
+import instrument
 
 # these are the hard-coded human chromosome names and sizes
 HUMAN_CHROMOSOMES = ['chr' + str(i) for i in range(1,23)] + ['chrX', 'chrY']
@@ -56,7 +60,146 @@ HUMAN_CHROMOSOME_SIZES = [ 247249719,\
                            154913754,\
                            57772954]
 
-class Dart:
+# chrom.sizes files of the assemblies getAssembly knows by name
+ASSEMBLY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),\
+        os.pardir, 'data', 'assemblies')
+
+class Assembly:
+    """Chromosome names and sizes of a genome assembly
+
+    Chromosome names are interned to small integer codes (their index in
+    chrNames), so per-chromosome indexes can be arrays indexed by code and
+    comparing chromosomes is comparing integers. A name the assembly does
+    not list, such as a contig in a dart file, is appended with size 0 the
+    first time it is interned, so a code never changes once handed out.
+
+    Parameters
+    ----------
+    name : str
+           assembly name (e.g. 'hg19')
+    chrNames : list of str
+               chromosome names, in code order
+    sizes : list of int
+            size of each chromosome
+
+    Attributes
+    ----------
+    name : str
+    chrNames : list of str
+               chromosome name of each code
+    codes : dict
+            chrName -> code
+
+    Example
+    --------
+    >>> hg19 = getAssembly('hg19')
+    >>> hg19.intern(['chr2', 'chrX', 'chr2'])
+    array([ 1, 22,  1])
+    >>> hg19.size('chrX')
+    155270560
+    """
+
+    def __init__(self, name, chrNames, sizes):
+        self.name = name
+        self.chrNames = []
+        self.codes = {}
+        self._sizes = []
+        for chrName, size in zip(chrNames, sizes):
+            if chrName in self.codes:
+                raise ValueError("Duplicate chromosome %s in assembly %s" %\
+                        (chrName, name))
+            self._add(chrName, int(size))
+
+    @classmethod
+    def fromChromSizes(cls, chromSizesFn, name=None):
+        """Reads a "chrom \\t size" file, keeping the order of its lines
+
+        name defaults to the file name up to its first dot.
+        """
+        chrNames, sizes = [], []
+        with open(chromSizesFn) as f:
+            for lineIx, line in enumerate(f):
+                line = line.rstrip('\n').split('\t')
+                if len(line) != 2:
+                    raise ValueError("Expecting exactly 2 words line %d of %s"\
+                            % (lineIx + 1, chromSizesFn))
+                chrNames.append(line[0])
+                sizes.append(int(line[1]))
+        if name is None:
+            name = os.path.basename(chromSizesFn).split('.')[0]
+        return cls(name, chrNames, sizes)
+
+    def __len__(self):
+        return len(self.chrNames)
+
+    def __repr__(self):
+        return 'Assembly(%r, <%d chromosomes>)' % (self.name, len(self))
+
+    def _add(self, chrName, size):
+        self.codes[chrName] = len(self.chrNames)
+        self.chrNames.append(chrName)
+        self._sizes.append(size)
+
+    def code(self, chrName):
+        """Returns the code of chrName, interning it if needed."""
+        if chrName not in self.codes:
+            self._add(chrName, 0)
+        return self.codes[chrName]
+
+    def intern(self, chrNames):
+        """Returns an array with the code of each of chrNames."""
+        chrNames = np.asarray(chrNames)
+        if len(chrNames) == 0:
+            return np.zeros(0, dtype=np.int64)
+        unique, inverse = np.unique(chrNames, return_inverse=True)
+        codes = np.array([self.code(c) for c in unique.tolist()],\
+                dtype=np.int64)
+        return codes[inverse.ravel()]
+
+    @property
+    def sizes(self):
+        """Array of the size of each code."""
+        return np.array(self._sizes, dtype=np.int64)
+
+    def size(self, chrName):
+        return self._sizes[self.codes[chrName]]
+
+    def chromSizes(self):
+        """Returns a dict of chromosome -> size, as readChromSizes does."""
+        return dict(zip(self.chrNames, self._sizes))
+
+    def totalLength(self):
+        return sum(self._sizes)
+
+ASSEMBLIES = {'hg18': Assembly('hg18', HUMAN_CHROMOSOMES,\
+        HUMAN_CHROMOSOME_SIZES)}
+DEFAULT_ASSEMBLY = 'hg18'
+
+def getAssembly(assembly=None):
+    """Returns an Assembly from the registry
+
+    assembly is an Assembly (returned as is), the name of a registered
+    assembly or of a chrom.sizes file in ASSEMBLY_DIR (hg18, hg19, hg38 and
+    mm10 are provided), or the path of a chrom.sizes file. Assemblies are
+    loaded once and shared, so indexes built on the same assembly share
+    chromosome codes. None gives DEFAULT_ASSEMBLY.
+    """
+    if isinstance(assembly, Assembly):
+        return assembly
+    if assembly is None:
+        assembly = DEFAULT_ASSEMBLY
+    if assembly not in ASSEMBLIES:
+        chromSizesFn = os.path.join(ASSEMBLY_DIR, assembly + '.chrom.sizes')
+        if os.path.exists(chromSizesFn):
+            ASSEMBLIES[assembly] = Assembly.fromChromSizes(chromSizesFn,\
+                    assembly)
+        elif os.path.exists(assembly):
+            ASSEMBLIES[assembly] = Assembly.fromChromSizes(assembly)
+        else:
+            raise ValueError("Unknown assembly %s" % assembly)
+    return ASSEMBLIES[assembly]
+
+class Dart(object):
     """Object representing a dart on the human genome
 
     Darts are used to represent the darts placed on the genome which GREATx
@@ -74,7 +217,8 @@ class Dart:
 
     Attributes
     ----------
-    Same as parameters.
+    Same as parameters. Attributes live in __slots__ rather than a
+    per-object dict, as are those of the other record classes.
 
     Example
     --------
@@ -83,10 +227,12 @@ class Dart:
     GREATx.Dart(chrName="'chr1'", name="'SRF.1'", position='1000')
     """
 
-    def __init__(self, **kwargs):
-        self.chrName = kwargs.get('chrName', '')
-        self.name = kwargs.get('name', '')
-        self.position = int(kwargs.get('position', -1))
+    __slots__ = ('chrName', 'name', 'position')
+
+    def __init__(self, chrName='', name='', position=-1):
+        self.chrName = chrName
+        self.name = name
+        self.position = int(position)
 
     def __str__(self):
         return "Dart Name: %s\nName: %s\nPosition: %d" % \
@@ -124,9 +270,11 @@ class WeightedDart(Dart):
     GREATx.WeightedDart(chrName="'chr1'", name="'SRF.1'", position='1000', weight='23')
     """
 
-    def __init__(self, **kwargs):
-        self.weight = kwargs.get('weight', -1)
-        Dart.__init__(self, **kwargs)
+    __slots__ = ('weight',)
+
+    def __init__(self, chrName='', name='', position=-1, weight=-1):
+        Dart.__init__(self, chrName, name, position)
+        self.weight = weight
 
     def __str__(self):
         return Dart.__str__(self) + ("\nWeight: %f" % self.weight)
@@ -136,7 +284,7 @@ class WeightedDart(Dart):
                 (repr(self.chrName), repr(self.name), repr(self.position),\
                 repr(self.weight))
 
-class DartTSSPair:
+class DartTSSPair(object):
     """Object representing a dart-TSS pair
 
     A DartTSSPair is a Dart with an addition attribute of weight. This object
@@ -161,6 +309,9 @@ class DartTSSPair:
     --------
     """
 
+    __slots__ = ('chrName', 'dartName', 'dartPosition', 'TSSPosition',\
+            'weight', 'geneName', 'geneID')
+
     def __init__(self, chrName='', dartName='', dartPosition=-1,\
             TSSPosition=-1, weight=-1, geneName='', geneID=''):
         self.chrName = chrName
@@ -183,9 +334,11 @@ class DartTSSPair:
                 repr(self.dartPosition), repr(self.TSSPosition),\
                 repr(self.weight), repr(self.geneName), repr(self.geneID))
 
-class TSS:
+class TSS(object):
     """Object representing a TSS"""
 
+    __slots__ = ('chrName', 'geneName', 'geneID', 'position')
+
     def __init__(self, position=-1, geneName='', geneID='', chrName=''):
         self.chrName = chrName
         self.geneName = geneName
@@ -230,7 +383,7 @@ class WeightedRegDom:
     --------
     Find the best position for a dart in a regulatory domain
 
-    >>> TSSs = [GREATx.TSS(chrName='chr123', geneName='tss', geneID='1234', position=i) for i in range(10)]
+    >>> TSSs = [GREATx.TSS(chrName='chr1', geneName='tss', geneID='1234', position=i) for i in range(10)]
     >>> wgtRegDom = GREATx.WeightedRegDom(cutOff=2, mean=0.0, sd=3)
     >>> bestWeightedDart = wgtRegDom.bestWeightedDart(TSSs)
 
@@ -246,49 +399,154 @@ class WeightedRegDom:
         self.cutOff = cutOff
         self.mean = mean
         self.sd = sd
+        # dividing the normal pdf by its value at the mean cancels the
+        # 1/(sd*sqrt(2*pi)) factor, leaving exp(scale*(offset - mean)**2)
+        self._expScale = -0.5/(float(sd)**2)
 
     def __repr__(self):
         return 'WeightedRegDom(%r, %r, %r)' %\
                 (repr(self.cutOff),repr(self.mean), repr(self.sd))
 
-    # note that this algorithm is okay because transcriptionStartSites is sorted
-    def bestWeightedDart(self, TSSs, chromosomes=HUMAN_CHROMOSOMES):
+    def bestWeightedDart(self, TSSs, chromosomes=None,\
+            tolerance=0.5, maxIter=100):
         """Returns the best WeightedDart for the given TSSs
 
-        This method stupidly visits every base within the regulatory
-        domain to determin which would be the best place to put a
-        dart. A lot of work can be done to improve this algorithm.
-        It is too slow to do anything reasonable with it.
+        The weight of a dart is a sum of Gaussian kernels, one for each TSS
+        within cutOff of the dart, so its maximum on a chromosome is either a
+        mode of the sum of the kernels in reach or the edge of some TSS's
+        window. Modes are found by mean-shift started at every kernel peak,
+        halfway between adjacent peaks and on both sides of every window
+        edge, restricting each step to the TSSs within cutOff (found by
+        binary search on the sorted TSSs). As mean-shift can stop short of
+        a flat mode, the integers around each mode then climb to an integer
+        local maximum, and the heaviest of those and of the window edges
+        wins. test_GREATx.py checks this against a scan of every base on
+        random TSSs; it is not proven to find the maximum in general.
+
+        Parameters
+        ----------
+        TSSs : list of TSS
+        chromosomes : list of str
+                      chromosomes to search (default = every chromosome
+                      with a TSS)
+        tolerance : float
+                    mean-shift stops once no candidate moves more than
+                    this many bases (default = 0.5)
+        maxIter : int
+                  maximum number of mean-shift steps (default = 100)
         """
 
-        bestWeightedDart = WeightedDart('', -1, weight=-1)
-        for chrName in chromosomes:
-            chrTSSs = filter(lambda x: x.chrName == chrName, TSSs)
-            chrTSSs.sort(key=operator.attrgetter('position'))
-            dart = Dart(chrName, -1)
+        # one pass groups the TSSs by chromosome
+        chrPositions = collections.defaultdict(list)
+        for tss in TSSs:
+            chrPositions[tss.chrName].append(tss.position)
+        if chromosomes is None:
+            chromosomes = list(chrPositions)
 
-            for tss in chrTSSs:
-                for i in range(-self.cutOff, self.cutOff+1):
+        bestWeightedDart = WeightedDart(weight=-1)
+        for chrName in chromosomes:
+            if chrName not in chrPositions:
+                continue
+            positions = np.sort(np.array(chrPositions[chrName],\
+                    dtype=np.int64))
+            position, weight = self._bestPosition(positions, tolerance,\
+                    maxIter)
+            if weight > bestWeightedDart.weight:
+                bestWeightedDart.chrName = chrName
+                bestWeightedDart.position = position
+                bestWeightedDart.weight = weight
 
-                    # dart position only increases
-                    if (dart.position < tss.position + i):
-                        dart.position = tss.position + i
-                        wDart = self.getWeightedDart(chrTSSs, dart, wantFilter=False)
+        return bestWeightedDart
 
-                        if (wDart.weight > bestWeightedDart.weight):
-                            bestWeightedDart.chrName = wDart.chrName
-                            bestWeightedDart.position = wDart.position
-                            bestWeightedDart.weight = wDart.weight
+    def _kernelSums(self, TSSPositions, positions):
+        """Sums the kernels within cutOff of each position
 
-        return bestWeightedDart
+        TSSPositions must be sorted. Returns (sum of weights, sum of weights
+        times kernel peaks) for each position.
+        """
+        lo = np.searchsorted(TSSPositions, positions - self.cutOff, side='left')
+        hi = np.searchsorted(TSSPositions, positions + self.cutOff, side='right')
+        counts = hi - lo
+        queryIdx = np.repeat(np.arange(len(positions)), counts)
+        runStarts = np.cumsum(counts) - counts
+        tssIdx = np.arange(counts.sum()) - np.repeat(runStarts - lo, counts)
+        peaks = TSSPositions[tssIdx] - self.mean
+        weights = self.getDartTSSPairWgts(positions[queryIdx],\
+                TSSPositions[tssIdx])
+        # bincount gives ints when no kernel is in reach of any position
+        return np.bincount(queryIdx, weights, len(positions))\
+                .astype(np.float64, copy=False),\
+                np.bincount(queryIdx, weights*peaks, len(positions))\
+                .astype(np.float64, copy=False)
+
+    def _bestPosition(self, TSSPositions, tolerance, maxIter):
+        """Returns (position, weight) of the heaviest dart on one chromosome."""
+        peaks = TSSPositions - self.mean
+        # the weight jumps where a TSS enters or leaves reach, so both
+        # sides of every window edge are scored and start a search too, as
+        # the sum between two edges may peak right next to one
+        edges = np.unique(np.concatenate((TSSPositions - self.cutOff - 1,\
+                TSSPositions - self.cutOff, TSSPositions + self.cutOff,\
+                TSSPositions + self.cutOff + 1)))
+        x = np.concatenate((peaks, (peaks[1:] + peaks[:-1])/2.0, edges))
+        for i in range(maxIter):
+            weightSums, peakSums = self._kernelSums(TSSPositions, x)
+            # a start with no kernel in reach stays where it is
+            shifted = np.where(weightSums > 0,\
+                    peakSums/np.maximum(weightSums, 1e-300), x)
+            converged = np.abs(shifted - x).max() < tolerance
+            x = shifted
+            if converged:
+                break
+
+        modes, modeWeights = self._climb(TSSPositions, np.unique(\
+                np.concatenate((np.floor(x), np.ceil(x), np.round(peaks)))\
+                .astype(np.int64)))
+        candidates = np.concatenate((modes, edges))
+        weights = np.concatenate((modeWeights,\
+                self._kernelSums(TSSPositions, edges)[0]))
+        # the heaviest, and of equal weights the leftmost, as a scan would
+        best = np.lexsort((candidates, -weights))[0]
+        return int(candidates[best]), float(weights[best])
+
+    def _climb(self, TSSPositions, positions):
+        """Moves each integer position to an integer local maximum
+
+        Mean-shift slows down on a flat top and can stop bases short of the
+        mode, so each position then takes the heavier of its neighbours
+        step bases away, doubling step after a move and halving it
+        otherwise, until neither neighbour one base away is heavier.
+        Positions out of reach of every kernel stay where they are.
+        Returns (positions, weights).
+        """
+        positions = positions.copy()
+        weights = self._kernelSums(TSSPositions, positions)[0]
+        steps = np.ones(len(positions), dtype=np.int64)
+        active = np.flatnonzero(weights > 0)
+        while len(active):
+            x, step = positions[active], steps[active]
+            left = self._kernelSums(TSSPositions, x - step)[0]
+            right = self._kernelSums(TSSPositions, x + step)[0]
+            current = weights[active]
+            toRight = (right > current) & (right >= left)
+            toLeft = (left > current) & ~toRight
+            moved = toRight | toLeft
+            positions[active] = np.where(toRight, x + step,\
+                    np.where(toLeft, x - step, x))
+            weights[active] = np.where(toRight, right,\
+                    np.where(toLeft, left, current))
+            steps[active] = np.where(moved, 2*step, np.maximum(step//2, 1))
+            active = active[moved | (step > 1)]
+        return positions, weights
 
     def getWeightedDart(self, TSSs, dart, wantFilter=True):
         """Returns a WeightedDart for the given TSSs."""
 
         if wantFilter:
-            TSSs = filter(lambda x: x.chrName == dart.chrName, TSSs)
+            TSSs = [tss for tss in TSSs if tss.chrName == dart.chrName]
 
-        wDart = WeightedDart(dart.chrName, dart.position, weight=0)
+        wDart = WeightedDart(chrName=dart.chrName, name=dart.name,\
+                position=dart.position, weight=0)
         for tss in TSSs:
             if (fabs(wDart.position - tss.position) <= self.cutOff):
                 wDart.weight += self.getDartTSSPairWgt(dart, tss)
@@ -298,11 +556,20 @@ class WeightedRegDom:
     def getDartTSSPairWgt(self, dart, tss):
         """Return the weight for a particular dart relative to a TSS."""
 
-        wgtDist = norm(self.mean, self.sd)
-        maxWgtDist = wgtDist.pdf(self.mean)
-        dartWgt = wgtDist.pdf(tss.position - dart.position)/maxWgtDist
+        return float(self.getDartTSSPairWgts(dart.position, tss.position))
+
+    def getDartTSSPairWgts(self, dartPositions, TSSPositions):
+        """Return the weights for arrays of dart and TSS positions
+
+        The weight of a dart relative to a TSS is the normal pdf of
+        TSSPosition - dartPosition divided by the pdf at the mean, so it lies
+        in (0, 1]. dartPositions and TSSPositions are broadcast against each
+        other; no cutOff is applied.
+        """
 
-        return dartWgt
+        offsets = np.subtract(TSSPositions, dartPositions, dtype=np.float64)
+        offsets -= self.mean
+        return np.exp(self._expScale*offsets*offsets)
 
     def makeDartTSSPair(self, dart, tss):
         if dart.chrName == tss.chrName:
@@ -314,11 +581,11 @@ class WeightedRegDom:
                     geneID=tss.geneID,\
                     TSSPosition=tss.position)
         else:
-            sys.stderr('Cannot make a dart-TSS pair b/c \
-                    dart.chrName != tss.chrName')
+            sys.stderr.write('Cannot make a dart-TSS pair b/c '\
+                    'dart.chrName != tss.chrName\n')
             return None
 
-class TermDartTSSTriple:
+class TermDartTSSTriple(object):
     """Object used to parse data from the output file of AssociationMaker
 
     This object is primarily used to parse the output file of AssociationMaker
@@ -360,6 +627,9 @@ class TermDartTSSTriple:
     >>> dartNames = list(set([lineObject.dartName for lineObject in lineObjects]))
     """
 
+    __slots__ = ('termID', 'chrName', 'dartName', 'dartPosition', 'geneName',\
+            'geneID', 'TSSPosition', 'weight', 'percentCoverage')
+
     def __init__(self, tripleLine):
         self._parseTermDartTSSTripleLine(tripleLine)
 
@@ -399,7 +669,259 @@ class TermDartTSSTriple:
                 repr(self.weight),\
                 repr(self.percentCoverage)])))
 
-class Loci:
+# binary columnar files: COLUMNS_MAGIC, the length of a JSON header, the
+# header, then the raw bytes of each column at a 64-byte aligned offset
+COLUMNS_MAGIC = b'GREATxC1'
+_COLUMN_ALIGNMENT = 64
+
+def _aligned(offset):
+    return -(-offset//_COLUMN_ALIGNMENT)*_COLUMN_ALIGNMENT
+
+def writeColumns(fn, kind, columns):
+    """Writes named arrays to a binary columnar file
+
+    Parameters
+    ----------
+    fn : str
+    kind : str
+           what the file holds, checked by mapColumns
+    columns : list of (str, array)
+              numeric or fixed-width string arrays; each is written with
+              its dtype (byte order included) and shape
+    """
+    entries, arrays, offset = [], [], 0
+    for name, array in columns:
+        array = np.ascontiguousarray(array)
+        if array.dtype.hasobject:
+            raise ValueError("column %s is not fixed width" % name)
+        if array.dtype.kind in 'SU' and array.dtype.itemsize == 0:
+            array = array.astype(array.dtype.kind + '1')
+        entries.append([name, array.dtype.str, list(array.shape), offset])
+        arrays.append(array)
+        offset += _aligned(array.nbytes)
+    header = json.dumps({'kind': kind, 'columns': entries}).encode('utf-8')
+    with open(fn, 'wb') as f:
+        f.write(COLUMNS_MAGIC + struct.pack('<Q', len(header)) + header)
+        for array in arrays:
+            f.write(b'\0'*(_aligned(f.tell()) - f.tell()))
+            array.tofile(f)
+
+def mapColumns(fn, kind=None):
+    """Memory-maps the columns of a file written by writeColumns
+
+    Returns a dict of name -> read-only array viewing the file, so nothing
+    is read until the arrays are used. Raises ValueError if fn is not a
+    columnar file, or holds another kind than kind.
+    """
+    with open(fn, 'rb') as f:
+        if f.read(len(COLUMNS_MAGIC)) != COLUMNS_MAGIC:
+            raise ValueError("%s is not a GREATx columnar file" % fn)
+        headerLength = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(headerLength).decode('utf-8'))
+    if kind is not None and header['kind'] != kind:
+        raise ValueError("%s holds a %s, not a %s" % (fn, header['kind'], kind))
+    dataStart = _aligned(len(COLUMNS_MAGIC) + 8 + headerLength)
+    buf = None
+    columns = {}
+    for name, dtype, shape, offset in header['columns']:
+        dtype = np.dtype(str(dtype))
+        shape = tuple(shape)
+        nbytes = dtype.itemsize*int(np.prod(shape))
+        if nbytes == 0:
+            columns[str(name)] = np.zeros(shape, dtype=dtype)
+            continue
+        if buf is None:
+            buf = np.memmap(fn, dtype=np.uint8, mode='r')
+        start = dataStart + offset
+        columns[str(name)] = np.asarray(buf[start:start + nbytes]).view(dtype)\
+                .reshape(shape)
+    return columns
+
+class TermDartTSSTable:
+    """Columnar form of the output file of AssociationMaker
+
+    Instead of one TermDartTSSTriple per line, every field is held in a
+    NumPy array. termID, dartName and chrName are stored as categorical
+    codes into sorted arrays of their unique values, and the rows are
+    sorted by term (keeping file order within a term) so that the rows of
+    each term are one contiguous slice.
+
+    writeBinary saves these arrays in the binary columnar format of
+    writeColumns, with gene names and ids dictionary-encoded too, and
+    fromBinary memory-maps them back without parsing anything.
+
+    Parameters
+    ----------
+    Same as TermDartTSSTriple, each given as a sequence with one entry
+    per line, plus
+
+    assembly : Assembly or str
+               when given, chrCodes are the codes of this assembly (see
+               getAssembly) and chrNames its chromosome names, so the
+               codes agree with indexes built on the same assembly
+               (default = None, codes into the sorted unique names)
+
+    Attributes
+    ----------
+    termIDs : array of str
+              unique term ids, sorted
+    termCodes : array of int
+                index into termIDs of each row
+    termOffsets : array of int
+                  rows of termIDs[k] are termOffsets[k]:termOffsets[k+1]
+    dartNames, dartCodes : array of str, array of int
+                           unique dart names and the code of each row
+    chrNames, chrCodes : array of str, array of int
+                         chromosome name of each code and the code of
+                         each row
+    dartPositions, geneNames, geneIDs, TSSPositions, weights,
+    percentCoverages : arrays
+                       the remaining fields of each row
+
+    Example
+    --------
+    >>> table = TermDartTSSTable.fromFile('data/SRFtoTerms.data')
+    >>> for termID, rows in table.iterTerms():
+    >>>     alpha = table.weights[rows].sum()
+    """
+
+    def __init__(self, termIDs, chrNames, dartNames, dartPositions,\
+            geneNames, geneIDs, TSSPositions, weights, percentCoverages,\
+            assembly=None):
+        self.termIDs, termCodes = np.unique(np.asarray(termIDs),\
+                return_inverse=True)
+        order = np.argsort(termCodes, kind='mergesort')
+        self.termCodes = termCodes[order]
+        self.termOffsets = np.searchsorted(self.termCodes,\
+                np.arange(len(self.termIDs) + 1))
+
+        self.dartNames, dartCodes = np.unique(np.asarray(dartNames),\
+                return_inverse=True)
+        self.dartCodes = dartCodes[order]
+        if assembly is None:
+            self.chrNames, chrCodes = np.unique(np.asarray(chrNames),\
+                    return_inverse=True)
+        else:
+            assembly = getAssembly(assembly)
+            chrCodes = assembly.intern(chrNames)
+            self.chrNames = np.array(assembly.chrNames)
+        self.chrCodes = chrCodes[order]
+
+        self.dartPositions = np.asarray(dartPositions, dtype=np.int64)[order]
+        self.geneNames = np.asarray(geneNames)[order]
+        self.geneIDs = np.asarray(geneIDs)[order]
+        self.TSSPositions = np.asarray(TSSPositions, dtype=np.int64)[order]
+        self.weights = np.asarray(weights, dtype=np.float64)[order]
+        self.percentCoverages = \
+                np.asarray(percentCoverages, dtype=np.float64)[order]
+
+    @classmethod
+    @instrument.timed('associationTable')
+    def fromFile(cls, tripleFn, assembly=None):
+        """Reads an AssociationMaker output file in one pass."""
+        columns = [[] for i in range(9)]
+        with open(tripleFn) as f:
+            for line in f:
+                for column, field in zip(columns, line.split()):
+                    column.append(field)
+        instrument.count('associationLines', len(columns[0]))
+        return cls(columns[0], columns[1], columns[2],\
+                np.array(columns[3], dtype=np.int64), columns[4], columns[5],\
+                np.array(columns[6], dtype=np.int64),\
+                np.array(columns[7], dtype=np.float64),\
+                np.array(columns[8], dtype=np.float64), assembly)
+
+    # columns of the binary format, besides the dictionary-encoded genes
+    _binaryColumns = ('termIDs', 'termCodes', 'termOffsets', 'dartNames',\
+            'dartCodes', 'chrNames', 'chrCodes', 'dartPositions',\
+            'TSSPositions', 'weights', 'percentCoverages')
+
+    def writeBinary(self, binaryFn):
+        """Writes the table in the binary columnar format."""
+        columns = [(name, getattr(self, name)) for name in self._binaryColumns]
+        for name in ('geneNames', 'geneIDs'):
+            values, codes = np.unique(getattr(self, name), return_inverse=True)
+            columns.append((name + 'Values', values))
+            columns.append((name + 'Codes', codes.ravel().astype(np.int64)))
+        writeColumns(binaryFn, 'TermDartTSSTable', columns)
+
+    @classmethod
+    @instrument.timed('associationTable')
+    def fromBinary(cls, binaryFn):
+        """Memory-maps a table written by writeBinary
+
+        Every column is a read-only view of the file. geneNames and geneIDs
+        are decoded from their dictionaries the first time they are used.
+        """
+        columns = mapColumns(binaryFn, 'TermDartTSSTable')
+        table = cls.__new__(cls)
+        for name in cls._binaryColumns:
+            setattr(table, name, columns[name])
+        table._encoded = dict((name, (columns[name + 'Values'],\
+                columns[name + 'Codes'])) for name in ('geneNames', 'geneIDs'))
+        return table
+
+    @classmethod
+    def load(cls, tripleFn, assembly=None):
+        """Opens an AssociationMaker output file in the text or the binary
+        format; assembly only applies to text."""
+        with open(tripleFn, 'rb') as f:
+            if f.read(len(COLUMNS_MAGIC)) == COLUMNS_MAGIC:
+                return cls.fromBinary(tripleFn)
+        return cls.fromFile(tripleFn, assembly)
+
+    def __getattr__(self, name):
+        # decodes a dictionary-encoded column of a table from fromBinary
+        encoded = self.__dict__.get('_encoded', {})
+        if name not in encoded:
+            raise AttributeError(name)
+        values, codes = encoded[name]
+        setattr(self, name, values[codes])
+        return self.__dict__[name]
+
+    def __len__(self):
+        return len(self.termCodes)
+
+    def select(self, rows, weights=None, percentCoverages=None):
+        """Returns a table holding only some of the rows
+
+        rows is a boolean mask or an increasing array of row indices; terms
+        left without rows are dropped. weights and percentCoverages, when
+        given, replace those columns and are aligned with the selected rows.
+        Dart and chromosome codes are kept, so the selection shares
+        dartNames and chrNames with this table.
+        """
+        table = copy.copy(self)
+        termCodes = self.termCodes[rows]
+        present = np.bincount(termCodes, minlength=len(self.termIDs)) > 0
+        table.termIDs = self.termIDs[present]
+        table.termCodes = (np.cumsum(present) - 1)[termCodes]
+        table.termOffsets = np.searchsorted(table.termCodes,\
+                np.arange(len(table.termIDs) + 1))
+        for name in ('dartCodes', 'chrCodes', 'dartPositions', 'geneNames',\
+                'geneIDs', 'TSSPositions', 'weights', 'percentCoverages'):
+            setattr(table, name, getattr(self, name)[rows])
+        if weights is not None:
+            table.weights = np.asarray(weights, dtype=np.float64)
+        if percentCoverages is not None:
+            table.percentCoverages = \
+                    np.asarray(percentCoverages, dtype=np.float64)
+        return table
+
+    def __repr__(self):
+        return 'TermDartTSSTable(<%d lines, %d terms, %d darts>)' %\
+                (len(self), len(self.termIDs), len(self.dartNames))
+
+    def termSlice(self, termCode):
+        """Returns the slice of rows belonging to termIDs[termCode]."""
+        return slice(self.termOffsets[termCode], self.termOffsets[termCode + 1])
+
+    def iterTerms(self):
+        """Yields (termID, slice of rows) for every term."""
+        for termCode, termID in enumerate(self.termIDs):
+            yield termID, self.termSlice(termCode)
+
+class Loci(object):
     """Object to represent a loci
 
     This object is a convenient way to represent a loci and its attributes.
@@ -427,6 +949,8 @@ class Loci:
     --------
     """
 
+    __slots__ = ('chrName', 'TSSPosition', 'geneName', 'geneID', 'strand')
+
     def __init__(self, lociLine):
         self._parseLociLine(lociLine)
 
@@ -448,12 +972,7 @@ class Loci:
                 self.geneName])
 
     def __repr__(self):
-        return "Loci(%r, %r)" % (repr("\t".join([\
-                repr(self.geneID),\
-                repr(self.chrName),\
-                repr(self.TSSPosition),\
-                repr(self.strand),\
-                repr(self.geneName)])), repr(cutOff))
+        return "Loci(%r)" % Loci.__str__(self)
 
 class LociRegulatoryRegion(Loci):
     """Object representing a loci expanded into a regulatory region
@@ -491,6 +1010,8 @@ class LociRegulatoryRegion(Loci):
     >>>     regDom.write(str(LociRegulatoryRegion(line,cutOff=cutOff)) + '\n')
     """
 
+    __slots__ = ('regStart', 'regEnd')
+
     def __init__(self, *args, **kwargs):
         Loci.__init__(self, *args)
         cutOff = kwargs.pop('cutOff')
@@ -508,14 +1029,11 @@ class LociRegulatoryRegion(Loci):
                 str(self.TSSPosition)])
 
     def __repr__(self):
-        return "LociRegulatoryRegion(%r, cutOff=%r)" % (repr("\t".join([\
-                repr(self.geneName),\
-                repr(self.chrName),\
-                repr(self.TSSPosition),\
-                repr(self.strand),\
-                repr(self.geneName),\
-                repr(self.strand)])), repr(cutOff))
+        # regEnd is not clipped, so it gives back the cutOff
+        return "LociRegulatoryRegion(%r, cutOff=%r)" % (Loci.__str__(self),\
+                self.regEnd - self.TSSPosition)
 
+@instrument.timed('regdoms')
 def createRegDomsFileFromTSSs(lociFn, regDomFn, cutOff):
     """Expands Loci file into a regulator regions file
 
@@ -530,11 +1048,130 @@ def createRegDomsFileFromTSSs(lociFn, regDomFn, cutOff):
     cutOff : int
              cut-off for regulatory regions
     """
-    loci = open(lociFn, 'r')
-    regDom = open(regDomFn, 'w')
+    nLines = 0
+    with open(lociFn, 'r') as loci:
+        with open(regDomFn, 'w') as regDom:
+            for nLines, line in enumerate(loci, 1):
+                regDom.write(str(LociRegulatoryRegion(line,cutOff=cutOff)) + '\n')
+    instrument.count('lociLines', nLines)
+
+# the association rules of c/createRegulatoryDomains.c
+ASSOCIATION_RULES = ('oneClosest', 'twoClosest', 'basalPlusExtension')
+
+def readChromSizes(chromSizesFn):
+    """Returns a dict of chromosome -> size from a chrom.sizes file"""
+    return Assembly.fromChromSizes(chromSizesFn).chromSizes()
 
-    for line in loci:
-        regDom.write(str(LociRegulatoryRegion(line,cutOff=cutOff)) + '\n')
+def readTSSFile(TSSFn):
+    """Reads a "chrom \t tss \t strand \t name" file into arrays
+
+    Returns (chrNames, TSSPositions, strands, names).
+    """
+    columns = [[] for i in range(4)]
+    with open(TSSFn) as f:
+        for lineIx, line in enumerate(f):
+            line = line.rstrip('\n').split('\t')
+            if len(line) != 4:
+                raise ValueError("Expecting exactly 4 words line %d of %s" %\
+                        (lineIx + 1, TSSFn))
+            for column, field in zip(columns, line):
+                column.append(field)
+    return np.array(columns[0]), np.array(columns[1], dtype=np.int64),\
+            np.array(columns[2]), np.array(columns[3])
+
+def createRegulatoryDomains(chrNames, TSSPositions, strands, names,\
+        chromSizes, association, maxExtension=1000000, basalUpstream=5000,\
+        basalDownstream=1000):
+    """Builds the regulatory domains of genes under a GREAT association rule
+
+    This is createRegulatoryDomains.c on arrays: the genes are sorted by
+    (chromosome, TSS, + before -, name) and each domain is bounded by its
+    neighbors on the same chromosome, found by shifting the sorted arrays
+    by one.
+
+    oneClosest : TSS +/- maxExtension, up to the midpoint between the TSS
+                 and each neighboring TSS
+    basalPlusExtension : a basal domain of basalUpstream/basalDownstream
+                         around the TSS (strand-dependent), extended up to
+                         maxExtension until the basal domains of the
+                         neighboring genes
+    twoClosest : basalPlusExtension with empty basal domains
+
+    Parameters
+    ----------
+    chrNames, TSSPositions, strands, names : arrays
+                                             one entry per gene
+    chromSizes : dict
+                 chromosome -> size, as returned by readChromSizes
+    association : str
+                  one of ASSOCIATION_RULES
+    maxExtension, basalUpstream, basalDownstream : int
+            (default = 1000000, 5000, 1000)
+
+    Returns
+    -------
+    (order, starts, ends) : order sorts the genes as the C tool does and
+                            starts and ends are the domains of the genes in
+                            that order
+    """
+    if association not in ASSOCIATION_RULES:
+        raise ValueError("Association rule must be one of %s, %s, %s" %\
+                ASSOCIATION_RULES)
+    for name, value in (('Maximum extension', maxExtension),\
+            ('Basal upstream', basalUpstream),\
+            ('Basal downstream', basalDownstream)):
+        if value < 0:
+            raise ValueError("%s must be a non-negative integer: %d" %\
+                    (name, value))
+    if association == 'twoClosest':
+        basalUpstream = basalDownstream = 0
+
+    chrNames, strands, names = [np.asarray(v) for v in\
+            (chrNames, strands, names)]
+    TSSPositions = np.asarray(TSSPositions, dtype=np.int64)
+    order = np.lexsort((names, strands == '-', TSSPositions, chrNames))
+    chrNames, TSSs, strands = chrNames[order], TSSPositions[order],\
+            strands[order]
+    try:
+        sizes = np.array([chromSizes[c] for c in chrNames.tolist()],\
+                dtype=np.int64)
+    except KeyError as e:
+        raise ValueError("No chrom size for %s" % e.args[0])
+
+    # neighbors on the same chromosome
+    hasPrev = np.zeros(len(TSSs), dtype=bool)
+    hasPrev[1:] = chrNames[1:] == chrNames[:-1]
+    hasNext = np.zeros(len(TSSs), dtype=bool)
+    hasNext[:-1] = hasPrev[1:]
+    prevTSSs = np.roll(TSSs, 1)
+    nextTSSs = np.roll(TSSs, -1)
+
+    if association == 'oneClosest':
+        starts = np.maximum(0, TSSs - maxExtension)
+        starts = np.where(hasPrev, np.maximum(starts, (TSSs + prevTSSs)//2),\
+                starts)
+        ends = np.minimum(TSSs + maxExtension, sizes)
+        ends = np.where(hasNext, np.minimum(ends, (TSSs + nextTSSs)//2), ends)
+        return order, starts, ends
+
+    plus = strands == '+'
+    if not (plus | (strands == '-')).all():
+        raise ValueError("Invalid strand.")
+    upstream = np.where(plus, basalUpstream, basalDownstream)
+    downstream = np.where(plus, basalDownstream, basalUpstream)
+    basalStarts = np.maximum(0, TSSs - upstream)
+    basalEnds = np.minimum(sizes, TSSs + downstream)
+
+    # the unclipped basal domains of the neighbors bound the extension
+    starts = np.minimum(basalStarts, np.maximum(0, TSSs - maxExtension))
+    prevEnds = np.roll(TSSs + downstream, 1)
+    starts = np.where(hasPrev,\
+            np.minimum(basalStarts, np.maximum(prevEnds, starts)), starts)
+    ends = np.maximum(basalEnds, np.minimum(sizes, TSSs + maxExtension))
+    nextStarts = np.roll(TSSs - upstream, -1)
+    ends = np.where(hasNext,\
+            np.maximum(basalEnds, np.minimum(nextStarts, ends)), ends)
+    return order, starts, ends
 
 def buildOntoTermsDict(ontoTermsFn):
     """ Takes a mapping of GO numbers to their actual names and builds a dict
@@ -553,128 +1190,693 @@ def buildOntoTermsDict(ontoTermsFn):
         ontoTerms[int(line[0].split(':')[1])] = line[1]
     return ontoTerms
 
-def buildMaxDartWeights(dartNames, lineObjects):
-    dartMaxWeights = {}
-    count = 0
-    print("Starting dartMaxWeights calculation on "+str(len(dartNames))+" darts")
-    for dartName in dartNames:
-        count += 1
-        if(count % 50 == 0): print(str(count))
-        dartNameObjects = filter(lambda x: x.dartName == dartName, lineObjects)
-        weight = max([dartNameObject.weight for dartNameObject in dartNameObjects])
-        dartMaxWeights[dartName] = weight
-    print("~~~~~~~~~~~~~~Finished")
-    return dartMaxWeights
-
-def overlapSelect(regDomFn, dartFn, mergedFn, options=''):
-    """Runs overlapselect <options> <regDomFn> <dartFn> <mergedFn>.
+class DartAggregateIndex:
+    """Per-dart and per-(term, dart) weight aggregates of a TermDartTSSTable
+
+    Built once per table and shared by every Beta variant and by the Gi*
+    code. All aggregates come from a single sort of the rows by
+    (term, dart), which the table's term-sorted rows make cheap.
+
+    Parameters
+    ----------
+    table : TermDartTSSTable
+
+    Attributes
+    ----------
+    dartMaxWeights : array of float
+                     heaviest pair weight of each dart on any term
+    dartWeightSums : array of float
+                     total pair weight of each dart over all terms
+    dartChrCodes, dartPositions : array of int
+                                  chromosome code and position of each dart
+    termDartTermCodes, termDartDartCodes : array of int
+                                           the (term, dart) pairs, sorted
+    termDartWeights : array of float
+                      total pair weight of the dart on the term
+    termDartOffsets : array of int
+                      the (term, dart) pairs of termIDs[k] are
+                      termDartOffsets[k]:termDartOffsets[k+1]
+
+    All per-dart arrays are indexed by dart code, i.e. aligned with
+    table.dartNames.
+
+    Example
+    --------
+    >>> aggregates = DartAggregateIndex(table)
+    >>> rows = aggregates.termDartSlice(termCode)
+    >>> aggregates.termDartWeights[rows].max()
+    """
+
+    def __init__(self, table):
+        nTerms, nDarts = len(table.termIDs), len(table.dartNames)
+        order = np.lexsort((table.dartCodes, table.termCodes))
+        termCodes = table.termCodes[order]
+        dartCodes = table.dartCodes[order]
+        weights = table.weights[order]
+
+        newGroup = np.ones(len(order), dtype=bool)
+        newGroup[1:] = (termCodes[1:] != termCodes[:-1]) |\
+                (dartCodes[1:] != dartCodes[:-1])
+        groupStarts = np.flatnonzero(newGroup)
+        self.termDartTermCodes = termCodes[groupStarts]
+        self.termDartDartCodes = dartCodes[groupStarts]
+        if len(order):
+            self.termDartWeights = np.add.reduceat(weights, groupStarts)
+            groupMaxWeights = np.maximum.reduceat(weights, groupStarts)
+        else:
+            self.termDartWeights = groupMaxWeights = np.zeros(0)
+        self.termDartOffsets = np.searchsorted(self.termDartTermCodes,\
+                np.arange(nTerms + 1))
+
+        self.dartMaxWeights = np.zeros(nDarts)
+        np.maximum.at(self.dartMaxWeights, self.termDartDartCodes,\
+                groupMaxWeights)
+        self.dartWeightSums = np.bincount(self.termDartDartCodes,\
+                self.termDartWeights, minlength=nDarts)
+
+        # every dart has a single position and chromosome
+        firstRows = np.zeros(nDarts, dtype=np.int64)
+        firstRows[table.dartCodes[::-1]] = np.arange(len(table))[::-1]
+        self.dartChrCodes = table.chrCodes[firstRows]
+        self.dartPositions = table.dartPositions[firstRows]
+
+    def __repr__(self):
+        return 'DartAggregateIndex(<%d darts, %d term-dart pairs>)' %\
+                (len(self.dartMaxWeights), len(self.termDartWeights))
+
+    def termDartSlice(self, termCode):
+        """Returns the slice of (term, dart) pairs of termIDs[termCode]."""
+        return slice(self.termDartOffsets[termCode],\
+                self.termDartOffsets[termCode + 1])
+
+def _betacf(a, b, x, eps=1e-15, maxIter=100000):
+    """Evaluates the incomplete beta continued fraction for arrays
+
+    This is the modified Lentz method of betacf in c/betaCDF.c, run on
+    whole arrays at once; each element stops iterating once it converges.
+    """
+    FPMIN = 1e-300
+    qab, qap, qam = a + b, a + 1.0, a - 1.0
+    c = np.ones_like(x)
+    d = 1.0 - qab*x/qap
+    d = 1.0/np.where(np.abs(d) < FPMIN, FPMIN, d)
+    h = d.copy()
+    active = np.arange(len(x))
+    for m in range(1, maxIter + 1):
+        if len(active) == 0:
+            break
+        aA, bA, xA = a[active], b[active], x[active]
+        cA, dA = c[active], d[active]
+        m2 = 2*m
+        aa = m*(bA - m)*xA/((qam[active] + m2)*(aA + m2))
+        dA = 1.0 + aa*dA
+        dA = 1.0/np.where(np.abs(dA) < FPMIN, FPMIN, dA)
+        cA = 1.0 + aa/cA
+        cA = np.where(np.abs(cA) < FPMIN, FPMIN, cA)
+        h[active] *= dA*cA
+        aa = -(aA + m)*(qab[active] + m)*xA/((aA + m2)*(qap[active] + m2))
+        dA = 1.0 + aa*dA
+        dA = 1.0/np.where(np.abs(dA) < FPMIN, FPMIN, dA)
+        cA = 1.0 + aa/cA
+        cA = np.where(np.abs(cA) < FPMIN, FPMIN, cA)
+        delta = dA*cA
+        h[active] *= delta
+        c[active], d[active] = cA, dA
+        active = active[np.abs(delta - 1.0) >= eps]
+    return h
+
+def logBetaCDF(x, alpha, beta):
+    """Returns log of the Beta(alpha, beta) cdf at x for arrays
+
+    The in-process C library of betaCDF is used when it has been built.
+    Otherwise scipy.special.betainc is used wherever its result is
+    comfortably above the double precision floor. Where it would
+    underflow, the log of the continued fraction expansion is used instead,
+    so tiny p-values keep their magnitude. Invalid parameters (alpha or
+    beta <= 0) give NaN.
+    """
+    if betaCDF.available():
+        return betaCDF.logBetaCDF(x, alpha, beta)
+    x, alpha, beta = [np.array(v, dtype=np.float64) for v in\
+            np.broadcast_arrays(x, alpha, beta)]
+    shape = x.shape
+    x, alpha, beta = x.ravel(), alpha.ravel(), beta.ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logP = np.log(scipy.special.betainc(alpha, beta, x))
+        tiny = (alpha > 0) & (beta > 0) & (x > 0) & (x < 1) &\
+                ~(logP > -600.0)
+        idx = np.flatnonzero(tiny)
+        a, b, xs = alpha[idx], beta[idx], x[idx]
+        # the continued fraction for I_x(a,b) converges for x < (a+1)/(a+b+2)
+        flip = xs >= (a + 1.0)/(a + b + 2.0)
+        a, b = np.where(flip, b, a), np.where(flip, a, b)
+        xs = np.where(flip, 1.0 - xs, xs)
+        logFront = a*np.log(xs) + b*np.log1p(-xs) - scipy.special.betaln(a, b)
+        logTail = logFront + np.log(_betacf(a, b, xs)) - np.log(a)
+        # 1 - I_{1-x}(b,a) can only be tiny if the tail is close to 1
+        logP[idx] = np.where(flip, np.log1p(-np.exp(np.minimum(logTail, 0.0))),\
+                logTail)
+    logP[~((alpha > 0) & (beta > 0))] = np.nan
+    return logP.reshape(shape)
+
+class TermScores:
+    """Beta distribution p-values of every term of a TermDartTSSTable
+
+    Attributes
+    ----------
+    termIDs : array of str
+              term ids, excluding UNKNOWN
+    alphas, betas : array of float
+                    Beta distribution parameters of each term
+    xs : array of float
+         percent coverage of each term
+    nTerms : int
+             number of terms of the association table, UNKNOWN included:
+             the Bonferroni correction of writeRankedTerms
+    logPvals : array of float
+               natural log of the Beta cdf at x
+    pvals : array of float
+            exp(logPvals); underflows to 0 for very small p-values
+    """
+
+    def __init__(self, termIDs, alphas, betas, xs, nTerms=None):
+        self.termIDs = termIDs
+        self.alphas = alphas
+        self.betas = betas
+        self.xs = xs
+        self.nTerms = len(termIDs) if nTerms is None else nTerms
+        self.logPvals = logBetaCDF(xs, alphas, betas)
+        self.pvals = np.exp(self.logPvals)
+
+    def __len__(self):
+        return len(self.termIDs)
+
+    def __repr__(self):
+        return 'TermScores(<%d terms>)' % len(self)
+
+    def ranked(self):
+        """Returns term indices ordered by p-value, skipping NaN p-values."""
+        order = np.argsort(self.logPvals, kind='mergesort')
+        return order[~np.isnan(self.logPvals[order])]
+
+def formatLogP(logP):
+    """Formats exp(logP) like %g, even when it would underflow a double."""
+    if not np.isfinite(logP) or logP > -700.0:
+        return '%g' % np.exp(logP)
+    log10P = logP/np.log(10.0)
+    exponent = int(np.floor(log10P))
+    return '%ge%d' % (round(10.0**(log10P - exponent), 5), exponent)
+
+@instrument.timed('scoring')
+def scoreTerms(table, whichBeta, aggregates=None, wgtRegDom=None):
+    """Computes the Beta p-value of every term of a TermDartTSSTable at once
+
+    alpha is the total weight of the dart-TSS pairs of a term and x its
+    percent coverage. beta depends on whichBeta:
+
+    1 : number of pairs - alpha (the max score of a pair is 1)
+    2 : number of pairs * heaviest pair weight - alpha
+    3 : number of pairs * weight of the best possible dart for the term's
+        TSSs (one term at a time, via wgtRegDom.bestWeightedDart)
+    4 : number of darts * heaviest dart weight on the term - alpha
+    5 : sum over pairs of the dart's heaviest weight on any term - alpha
+
+    Except for 3, every quantity is a segmented reduction over the term
+    slices of the table and all p-values come from one vectorized call.
+
+    Parameters
+    ----------
+    table : TermDartTSSTable
+    whichBeta : int
+    aggregates : DartAggregateIndex
+                 aggregates of table used by whichBeta 4 and 5; built when
+                 needed and not given. (default = None)
+    wgtRegDom : WeightedRegDom
+                kernel used by whichBeta 3; pass the kernel the table's
+                weights were computed with
+                (default = WeightedRegDom(cutOff=1000000, mean=0, sd=333333))
+
+    Returns
+    -------
+    TermScores
+    """
+    known = np.flatnonzero(table.termIDs != 'UNKNOWN')
+    instrument.count('terms', len(known))
+    if len(table) == 0 or len(known) == 0:
+        empty = np.zeros(0)
+        return TermScores(table.termIDs[known], empty, empty, empty,\
+                nTerms=len(table.termIDs))
+    starts = table.termOffsets[:-1]
+    counts = np.diff(table.termOffsets)
+    alphas = np.add.reduceat(table.weights, starts)
+    xs = table.percentCoverages[starts]
+
+    #Basic beta, assumes max score is 1 for all darts
+    if whichBeta == 1:
+        betas = counts - alphas
+    #Assumes max score is the max of all darts hitting this term
+    elif whichBeta == 2:
+        betas = counts*np.maximum.reduceat(table.weights, starts) - alphas
+    elif whichBeta == 3:
+        if wgtRegDom is None:
+            wgtRegDom = WeightedRegDom(cutOff=1000000, mean=0, sd=333333)
+        betas = np.zeros(len(table.termIDs))
+        for termCode in known.tolist():
+            rows = table.termSlice(termCode)
+            termTSSs = [TSS(position=position, chrName=table.chrNames[chrCode])\
+                        for position, chrCode in\
+                        zip(table.TSSPositions[rows].tolist(),\
+                            table.chrCodes[rows].tolist())]
+            betas[termCode] = counts[termCode] * wgtRegDom.bestWeightedDart(\
+                    termTSSs, chromosomes=table.chrNames.tolist()).weight
+    #Assumes max score is the number of darts times the weight of the heaviest dart
+    elif whichBeta == 4:
+        if aggregates is None:
+            aggregates = DartAggregateIndex(table)
+        dartCounts = np.diff(aggregates.termDartOffsets)
+        betas = dartCounts*np.maximum.reduceat(aggregates.termDartWeights,\
+                aggregates.termDartOffsets[:-1]) - alphas
+    #Assumes max score for a given dart is the highest score achieved by
+    # that dart on any term
+    elif whichBeta == 5:
+        if aggregates is None:
+            aggregates = DartAggregateIndex(table)
+        betas = np.add.reduceat(aggregates.dartMaxWeights[table.dartCodes],\
+                starts) - alphas
+    else:
+        raise ValueError("whichBeta must be 1, 2, 3, 4 or 5: %r" % whichBeta)
+
+    return TermScores(table.termIDs[known], alphas[known],\
+            np.asarray(betas, dtype=np.float64)[known], xs[known],\
+            nTerms=len(table.termIDs))
+
+class DartSet:
+    """Columnar set of darts read from a BED file
+
+    Darts are kept as parallel NumPy arrays so that whole dart sets can be
+    joined against regulatory domains without building one object per dart.
+    The position of a dart is the midpoint of its BED interval.
+
+    Parameters
+    ----------
+    chrNames : array of str
+               chromosome name of each dart
+    starts : array of int
+             BED chromStart of each dart
+    ends : array of int
+           BED chromEnd of each dart
+    names : array of str
+            unique name of each dart
+    assembly : Assembly or str
+               assembly the darts are on, see getAssembly
+               (default = DEFAULT_ASSEMBLY)
+
+    Attributes
+    ----------
+    Same as parameters, plus
+
+    chrCodes : array of int
+               assembly code of each dart's chromosome
+    positions : array of int
+                midpoint of each dart
+
+    Example
+    --------
+    >>> darts = DartSet.fromFile('GREATRegDoms/SRF.hg18.bed')
+    >>> len(darts)
+    """
+
+    def __init__(self, chrNames, starts, ends, names, assembly=None):
+        self.assembly = getAssembly(assembly)
+        self.chrNames = np.asarray(chrNames)
+        self.chrCodes = self.assembly.intern(self.chrNames)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.names = np.asarray(names)
+        self.positions = (self.starts + self.ends)//2
+
+    @classmethod
+    def fromFile(cls, dartFn, assembly=None):
+        """Reads the first four columns of a dart BED file."""
+        with open(dartFn) as f:
+            return cls.fromLines(f, assembly)
+
+    @classmethod
+    @instrument.timed('darts')
+    def fromLines(cls, lines, assembly=None):
+        """Reads the first four columns of the lines of a dart BED file."""
+        chrNames, starts, ends, names = [], [], [], []
+        for lineIx, line in enumerate(lines):
+            line = line.split()
+            if not line or line[0] in ('track', 'browser') or \
+                    line[0].startswith('#'):
+                continue
+            if len(line) < 4:
+                raise ValueError("Expecting at least 4 words line %d" %\
+                        (lineIx + 1))
+            chrNames.append(line[0])
+            starts.append(int(line[1]))
+            ends.append(int(line[2]))
+            names.append(line[3])
+        instrument.count('darts', len(names))
+        return cls(chrNames, starts, ends, names, assembly)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return 'DartSet(<%d darts>)' % len(self)
+
+class RegDomIndex:
+    """Per-chromosome sorted arrays of regulatory domains
+
+    The regulatory domains of a regDom file (as written by
+    createRegDomsFileFromTSSs) are sorted by chromosome code and start. For
+    every chromosome we keep the slice of the sorted arrays it occupies and
+    the running maximum of the domain ends, which lets a dart midpoint find
+    every domain containing it with two binary searches.
+
+    Parameters
+    ----------
+    chrNames : array of str
+               chromosome name of each regulatory domain
+    starts : array of int
+             first base of each regulatory domain
+    ends : array of int
+           end (exclusive) of each regulatory domain
+    geneNames : array of str
+                gene name of each regulatory domain
+    geneIDs : array of str
+              gene id of each regulatory domain
+    strands : array of str
+              strand of each gene
+    TSSPositions : array of int
+                   TSS of each gene
+    assembly : Assembly or str
+               assembly of the chromosomes, see getAssembly
+               (default = DEFAULT_ASSEMBLY)
+
+    Attributes
+    ----------
+    Same as parameters, sorted by (chrCode, start), plus
+
+    chrCodes : array of int
+               assembly code of each domain's chromosome
+    chrOffsets : array of int
+                 domains on the chromosome with code c are
+                 chrOffsets[c]:chrOffsets[c+1] in the sorted arrays
+
+    Example
+    --------
+    >>> regDoms = RegDomIndex.fromFile('/tmp/hg18.regDom.bed')
+    >>> pairs = regDoms.join(DartSet.fromFile('GREATRegDoms/SRF.hg18.bed'))
+    """
+
+    def __init__(self, chrNames, starts, ends, geneNames, geneIDs, strands,\
+            TSSPositions, assembly=None):
+        self.assembly = getAssembly(assembly)
+        chrNames = np.asarray(chrNames)
+        chrCodes = self.assembly.intern(chrNames)
+        starts = np.asarray(starts, dtype=np.int64)
+        order = np.lexsort((starts, chrCodes))
+        self.chrNames = chrNames[order]
+        self.chrCodes = chrCodes[order]
+        self.starts = starts[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.geneNames = np.asarray(geneNames)[order]
+        self.geneIDs = np.asarray(geneIDs)[order]
+        self.strands = np.asarray(strands)[order]
+        self.TSSPositions = np.asarray(TSSPositions, dtype=np.int64)[order]
+
+        self.chrOffsets = np.searchsorted(self.chrCodes,\
+                np.arange(len(self.assembly) + 1))
+        self.maxEnds = np.empty_like(self.ends)
+        for lo, hi in self.chrBounds():
+            self.maxEnds[lo:hi] = np.maximum.accumulate(self.ends[lo:hi])
+
+    @classmethod
+    @instrument.timed('regdoms')
+    def fromFile(cls, regDomFn, assembly=None):
+        """Reads a 7 column regDom file.
+
+        | chrName | regStart | regEnd | Gene Name | GeneID | strand | TSS Location |
+        """
+        columns = [[] for i in range(7)]
+        with open(regDomFn) as f:
+            for line in f:
+                line = line.split()
+                for column, field in zip(columns, line):
+                    column.append(field)
+        instrument.count('regDomLines', len(columns[0]))
+        return cls(columns[0], np.array(columns[1], dtype=np.int64),\
+                np.array(columns[2], dtype=np.int64), columns[3], columns[4],\
+                columns[5], np.array(columns[6], dtype=np.int64), assembly)
+
+    @classmethod
+    @instrument.timed('regdoms')
+    def fromLoci(cls, lociFn, cutOff, assembly=None):
+        """Builds the +/- cutOff regulatory domains of a loci file in memory
+
+        This is the in-memory equivalent of createRegDomsFileFromTSSs.
+        """
+        columns = [[] for i in range(5)]
+        with open(lociFn) as f:
+            for line in f:
+                for column, field in zip(columns, line.split()):
+                    column.append(field)
+        TSSPositions = np.array(columns[2], dtype=np.int64)
+        instrument.count('lociLines', len(TSSPositions))
+        return cls(columns[1], np.maximum(0, TSSPositions - cutOff),\
+                TSSPositions + cutOff, columns[4], columns[0], columns[3],\
+                TSSPositions, assembly)
+
+    @classmethod
+    def fromAssociationRule(cls, lociFn, chromSizes, association,\
+            maxExtension=1000000, basalUpstream=5000, basalDownstream=1000):
+        """Builds the regulatory domains of a loci file under an association
+        rule (see createRegulatoryDomains)
+
+        chromSizes is a dict of chromosome -> size, or an assembly as taken
+        by getAssembly (an Assembly, an assembly name or a chrom.sizes file
+        name), which the index is then built on. Genes are ordered by their
+        gene name where the C tool would use the name column of its TSS
+        file.
+        """
+        assembly = None
+        if not isinstance(chromSizes, dict):
+            assembly = getAssembly(chromSizes)
+            chromSizes = assembly.chromSizes()
+        columns = [[] for i in range(5)]
+        with open(lociFn) as f:
+            for line in f:
+                for column, field in zip(columns, line.split()):
+                    column.append(field)
+        geneIDs, chrNames, TSSPositions, strands, geneNames = [np.array(c)\
+                for c in columns]
+        TSSPositions = TSSPositions.astype(np.int64)
+        order, starts, ends = createRegulatoryDomains(chrNames, TSSPositions,\
+                strands, geneNames, chromSizes, association, maxExtension,\
+                basalUpstream, basalDownstream)
+        return cls(chrNames[order], starts, ends, geneNames[order],\
+                geneIDs[order], strands[order], TSSPositions[order], assembly)
+
+    def withCutOff(self, cutOff):
+        """Returns the +/- cutOff regulatory domains of the same TSSs."""
+        return RegDomIndex(self.chrNames,\
+                np.maximum(0, self.TSSPositions - cutOff),\
+                self.TSSPositions + cutOff, self.geneNames, self.geneIDs,\
+                self.strands, self.TSSPositions, self.assembly)
+
+    def write(self, regDomFn):
+        """Writes the regulatory domains in the 7 column regDom format."""
+        with open(regDomFn, 'w') as f:
+            for fields in zip(self.chrNames.tolist(),\
+                    map(str, self.starts.tolist()), map(str, self.ends.tolist()),\
+                    self.geneNames.tolist(), self.geneIDs.tolist(),\
+                    self.strands.tolist(), map(str, self.TSSPositions.tolist())):
+                f.write("\t".join(fields) + "\n")
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return 'RegDomIndex(<%d regulatory domains on %d chromosomes>)' %\
+                (len(self), len(self.chrBounds()))
+
+    def chrBounds(self):
+        """Returns [(first, last + 1)] of every chromosome with domains."""
+        return _chrBounds(self.chrOffsets)
+
+    def overlapping(self, chrCode, positions):
+        """Returns (queryIdx, regDomIdx) for every domain containing a position
+
+        positions need not be sorted; every position p is matched to each
+        regulatory domain on the chromosome with code chrCode with
+        start <= p < end.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        lo, hi = _chrSlice(self.chrOffsets, chrCode)
+        if lo == hi or len(positions) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        starts = self.starts[lo:hi]
+        # candidates are the domains after the last one whose running max
+        # end is <= p and up to the last one starting at or before p
+        first = np.searchsorted(self.maxEnds[lo:hi], positions, side='right')
+        last = np.searchsorted(starts, positions, side='right')
+        counts = np.maximum(last - first, 0)
+        total = counts.sum()
+        queryIdx = np.repeat(np.arange(len(positions)), counts)
+        runStarts = np.cumsum(counts) - counts
+        regDomIdx = np.arange(total) - np.repeat(runStarts - first, counts)
+        hit = self.ends[lo + regDomIdx] > positions[queryIdx]
+        return queryIdx[hit], regDomIdx[hit] + lo
+
+    @instrument.timed('overlap')
+    def join(self, darts):
+        """Joins dart midpoints against the regulatory domains.
+
+        Returns a DartRegDomPairs holding one pair per (dart, regulatory
+        domain containing the dart), ordered by dart then domain start.
+        """
+        dartIdx, regDomIdx = [], []
+        for chrCode, onChr in _groupByCode(self._codesOf(darts)):
+            queryIdx, chrRegDomIdx = \
+                    self.overlapping(chrCode, darts.positions[onChr])
+            dartIdx.append(onChr[queryIdx])
+            regDomIdx.append(chrRegDomIdx)
+        if dartIdx:
+            dartIdx = np.concatenate(dartIdx)
+            regDomIdx = np.concatenate(regDomIdx)
+        else:
+            dartIdx = regDomIdx = np.zeros(0, dtype=np.int64)
+        order = np.lexsort((regDomIdx, dartIdx))
+        instrument.count('pairs', len(order))
+        return DartRegDomPairs(darts, self, dartIdx[order], regDomIdx[order])
+
+    def _codesOf(self, darts):
+        """Returns the chromosome codes of darts in this index's assembly."""
+        if darts.assembly is self.assembly:
+            return darts.chrCodes
+        return self.assembly.intern(darts.chrNames)
+
+def _chrBounds(chrOffsets):
+    """Returns [(first, last + 1)] of the non-empty chromosomes of an
+    offsets array indexed by chromosome code."""
+    lo, hi = chrOffsets[:-1], chrOffsets[1:]
+    present = hi > lo
+    return list(zip(lo[present].tolist(), hi[present].tolist()))
+
+def _chrSlice(chrOffsets, chrCode):
+    """Returns (first, last + 1) of chromosome chrCode; codes interned after
+    the offsets were built have no entries."""
+    if 0 <= chrCode < len(chrOffsets) - 1:
+        return int(chrOffsets[chrCode]), int(chrOffsets[chrCode + 1])
+    return 0, 0
+
+def _groupByCode(chrCodes):
+    """Yields (chrCode, indices of chrCodes equal to it) for each code, in
+    increasing code order, with a single sort."""
+    order = np.argsort(chrCodes, kind='mergesort')
+    sortedCodes = chrCodes[order]
+    bounds = np.flatnonzero(sortedCodes[1:] != sortedCodes[:-1]) + 1
+    for onChr in np.split(order, bounds):
+        if len(onChr):
+            yield int(chrCodes[onChr[0]]), onChr
+
+class DartRegDomPairs:
+    """Result of joining a DartSet against a RegDomIndex
+
+    Each pair is stored as an index into the darts and an index into the
+    regulatory domains, so the join never copies the per-record fields.
 
     Parameters
     ----------
-    selectFile : str
-                 name of file containing loci (e.g. hg18.loci)
-    inFile : str
-             name of file to contain the created regulatory regions (e.g. hg18.regDom.bed)
-    outFile : str
-              cut-off for regulatory regions
-    options : str
-              space delemited list of options (e.g. "-selectFmt=bed -mergeOutput")
-
-    Usage
-    -----
-    Note: This usage docstring is from the program overlapSelect
-
-    overlapSelect [options] selectFile inFile outFile
-
-    Select records based on overlaping chromosome ranges.  The ranges are
-    specified in the selectFile, with each block specifying a range.
-    Records are copied from the inFile to outFile based on the selection
-    criteria.  Selection is based on blocks or exons rather than entire
-    range.
-
-    Options starting with -select* apply to selectFile and those starting
-    with -in* apply to inFile.
-
-    Options:
-      -selectFmt=fmt - specify selectFile format:
-              psl - PSL format (default for *.psl files).
-              genePred - gepePred format (default for *.gp or
-                         *.genePred files).
-              bed - BED format (default for *.bed files).
-                    If BED doesn't have blocks, the bed range is used.
-      -selectCoordCols=spec - selectFile is tab-separate with coordinates
-           as described by spec, which is one of:
-                o chromCol - chrom in this column followed by start and end.
-                o chromCol,startCol,endCol - chrom, start, and end in specified
-                  columns.
-                o chromCol,startCol,endCol,strandCol - chrom, start, end, and
-                  strand in specified columns.
-              NOTE: column numbers are zero-based
-      -selectCds - Use only CDS in the selectFile
-      -selectRange - Use entire range instead of blocks from records in
-              the selectFile.
-      -inFmt=fmt - specify inFile format, same values as -selectFmt.
-      -inCoordCols=spec - inFile is tab-separate with coordinates specified by
-          spec, in format described above.
-      -inCds - Use only CDS in the inFile
-      -inRange - Use entire range instead of blocks of records in the inFile.
-      -nonOverlapping - select non-overlaping instead of overlaping records
-      -strand - must be on the same strand to be considered overlaping
-      -oppositeStrand - must be on the opposite strand to be considered overlaping
-      -excludeSelf - don't compare records with the same coordinates and name.
-          Warning: using only one of -inCds or -selectCds will result in different
-          coordinates for the same record.
-      -idMatch - only select overlapping records if they have the same id
-      -aggregate - instead of computing overlap bases on individual select entries,
-          compute it based on the total number of inFile bases overlap by selectFile
-          records. -overlapSimilarity and -mergeOutput will not work with
-          this option.
-      -overlapThreshold=0.0 - minimun fraction of an inFile record that
-          must be overlapped by a single select record to be considered
-          overlapping.  Note that this is only coverage by a single select
-          record, not total coverage.
-      -overlapThresholdCeil=1.1 - select only inFile records with less than
-          this amount of overlap with a single record.
-      -overlapSimilarity=0.0 - minimun fraction of inFile and select records that
-          Note that this is only coverage by a single select record and this
-          is; bidirectional inFile and selectFile must overlap by this
-          amount.  A value of 1.0 will select identical records (or CDS if
-          both CDS options are specified.  Not currently supported with
-          -aggregate.
-      -overlapSimilarityCeil=1.1 - select only inFile records with less than
-          this amount of similarity with a single record.
-      -overlapBases=-1 - minimum number of bases of overlap, < 0 disables.
-      -statsOutput - output overlap statistics instead of selected records.
-          If no overlap criteria is specified, all overlapping entries are
-          reported, Otherwise only the pairs passing the citeria are
-          reported. This results in a tab-seperated file with the columns:
-             inId selectId inOverlap selectOverlap overBases
-          Where inOverlap is the fraction of the inFile record overlapped by
-          the selectFile record and selectOverlap is the fraction of the
-          select record overlap by inFile records.  With -aggregate, output
-          is:
-             inId inOverlap inOverBases inBases
-      -statsOutputAll - like -statsOutput, however output all inFile records,
-          even ones that are not overlapped.
-      -mergeOutput - output file with be a merge of the input file with the
-          selectFile records that selected it.  The format is
-             inRec<tab>selectRec.
-          if multiple select records hit, inRec is repeated. This will increase
-          the memory required. Not supported with -nonOverlapping or -aggregate.
-      -idOutput - output a table seprate file of pairs of
-             inId selectId
-          with -aggregate, omly a single column of inId is written
-      -dropped=file  - output rows that were dropped to this file.
-      -verbose=n - verbose > 1 prints some details,
-    """
-
-    program = "/afs/ir/class/cs173/bin/i386_linux26/overlapSelect"
-    os.system(" ".join([program, options, regDomFn, dartFn, mergedFn]))
-
-def assignWeights(cutOff, mean, sd, mergedFn, dartsToWeightsFn):
+    darts : DartSet
+    regDoms : RegDomIndex
+    dartIdx : array of int
+              index of the dart of each pair
+    regDomIdx : array of int
+                index of the regulatory domain of each pair
+
+    Attributes
+    ----------
+    Same as parameters.
+    """
+
+    def __init__(self, darts, regDoms, dartIdx, regDomIdx):
+        self.darts = darts
+        self.regDoms = regDoms
+        self.dartIdx = dartIdx
+        self.regDomIdx = regDomIdx
+
+    def __len__(self):
+        return len(self.dartIdx)
+
+    def __repr__(self):
+        return 'DartRegDomPairs(<%d pairs>)' % len(self)
+
+    def dartTSSPairs(self, weights):
+        """Yields a DartTSSPair for each pair, given the pair weights."""
+        d, r = self.darts, self.regDoms
+        for fields in zip(d.chrNames[self.dartIdx].tolist(),\
+                d.names[self.dartIdx].tolist(),\
+                d.positions[self.dartIdx].tolist(),\
+                r.TSSPositions[self.regDomIdx].tolist(), list(weights),\
+                r.geneNames[self.regDomIdx].tolist(),\
+                r.geneIDs[self.regDomIdx].tolist()):
+            yield DartTSSPair(*fields)
+
+    def mergeLines(self):
+        """Yields the pairs in overlapSelect -mergeOutput format."""
+        d, r = self.darts, self.regDoms
+        for i, j in zip(self.dartIdx.tolist(), self.regDomIdx.tolist()):
+            yield "\t".join([d.chrNames[i], str(d.starts[i]), str(d.ends[i]),\
+                    d.names[i], r.chrNames[j], str(r.starts[j]),\
+                    str(r.ends[j]), r.geneNames[j], r.geneIDs[j],\
+                    r.strands[j], str(r.TSSPositions[j])]) + "\n"
+
+@instrument.timed('overlap')
+def overlapSelect(regDomFn, dartFn, mergedFn=None, assembly=None):
+    """Joins the darts in dartFn against the regulatory domains in regDomFn
+
+    This replaces the external overlapSelect -mergeOutput call: the join is
+    done in-process by RegDomIndex and the pairs are returned in memory. A
+    dart is paired with every regulatory domain containing its midpoint.
+
+    Parameters
+    ----------
+    regDomFn : str
+               name of file containing the regulatory regions
+               (e.g. hg18.regDom.bed)
+    dartFn : str
+             name of the dart BED file
+    mergedFn : str
+               if given, the pairs are also written to this file in the
+               overlapSelect -mergeOutput format read by assignWeights.
+               (default = None)
+    assembly : Assembly or str
+               assembly of the regulatory domains and darts, see
+               getAssembly (default = DEFAULT_ASSEMBLY)
+
+    Returns
+    -------
+    DartRegDomPairs
+    """
+    assembly = getAssembly(assembly)
+    pairs = RegDomIndex.fromFile(regDomFn, assembly).join(\
+            DartSet.fromFile(dartFn, assembly))
+    if mergedFn is not None:
+        with open(mergedFn, 'w') as merged:
+            merged.writelines(pairs.mergeLines())
+    return pairs
+
+@instrument.timed('assignWeights')
+def assignWeights(cutOff, mean, sd, merged, dartsToWeightsFn):
     """Writes to dartsToWeightsFn each dart with the geneName, geneID, and weight
 
-     merged file must follow this format:
+    merged is either the DartRegDomPairs returned by overlapSelect or the
+    name of a merged file, which must follow this format:
     |<-----------Dart Information---------->|<---------RegDom Info------->| Gene Name | GeneID | strand | TSS Location |
     | chrName | chrStart | chrEnd | dartName | chrName | chrStart | chrEnd | Gene Name | GeneID | strand | TSS Location |
 
@@ -683,30 +1885,693 @@ def assignWeights(cutOff, mean, sd, mergedFn, dartsToWeightsFn):
 
     """
 
-    merged = open(mergedFn, 'r')
-    dartsToWeightsFile = open(dartsToWeightsFn, 'w')
+    if isinstance(merged, DartRegDomPairs):
+        d, r = merged.darts, merged.regDoms
+        chrNames = d.chrNames[merged.dartIdx]
+        dartNames = d.names[merged.dartIdx]
+        dartPositions = d.positions[merged.dartIdx]
+        geneNames = r.geneNames[merged.regDomIdx]
+        geneIDs = r.geneIDs[merged.regDomIdx]
+        TSSPositions = r.TSSPositions[merged.regDomIdx]
+    else:
+        columns = [[] for i in range(11)]
+        with open(merged, 'r') as f:
+            for line in f:
+                for column, field in zip(columns, line.split()):
+                    column.append(field)
+        chrNames, dartNames = columns[0], columns[3]
+        dartPositions = (np.array(columns[1], dtype=np.int64) +\
+                np.array(columns[2], dtype=np.int64))//2
+        geneNames, geneIDs = columns[7], columns[8]
+        TSSPositions = np.array(columns[10], dtype=np.int64)
+
     wgtRegDom = WeightedRegDom(cutOff, mean, sd)
+    weights = wgtRegDom.getDartTSSPairWgts(dartPositions, TSSPositions)
+
+    with open(dartsToWeightsFn, 'w') as dartsToWeightsFile:
+        for fields in zip(list(chrNames), list(dartNames),\
+                map(str, dartPositions.tolist()), list(geneNames),\
+                list(geneIDs), map(str, TSSPositions.tolist()),\
+                map(str, weights.tolist())):
+            dartsToWeightsFile.write("\t".join(fields) + "\n")
+    instrument.count('weightLines', len(weights))
+
+
+class GenomeIntervals:
+    """Sorted, non-overlapping intervals on each chromosome
+
+    Used for antigap.bed style files listing every region of the genome a
+    dart may land in. As for calculateBinomialP, the intervals must not
+    overlap each other.
+
+    Parameters
+    ----------
+    chrNames : array of str
+    starts : array of int
+    ends : array of int
+    assembly : Assembly or str
+               see getAssembly (default = DEFAULT_ASSEMBLY)
+
+    Attributes
+    ----------
+    Same as parameters, sorted by (chrCode, start), plus
+
+    chrCodes : array of int
+               assembly code of each interval's chromosome
+    chrOffsets : array of int
+                 intervals on the chromosome with code c are
+                 chrOffsets[c]:chrOffsets[c+1] in the sorted arrays
+    """
+
+    def __init__(self, chrNames, starts, ends, assembly=None):
+        self.assembly = getAssembly(assembly)
+        chrNames = np.asarray(chrNames)
+        chrCodes = self.assembly.intern(chrNames)
+        starts = np.asarray(starts, dtype=np.int64)
+        order = np.lexsort((starts, chrCodes))
+        self.chrNames = chrNames[order]
+        self.chrCodes = chrCodes[order]
+        self.starts = starts[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.chrOffsets = np.searchsorted(self.chrCodes,\
+                np.arange(len(self.assembly) + 1))
+
+    @classmethod
+    def wholeGenome(cls, assembly=None):
+        """Returns one interval covering each chromosome of an assembly."""
+        assembly = getAssembly(assembly)
+        sizes = assembly.sizes
+        present = sizes > 0
+        return cls(np.array(assembly.chrNames)[present],\
+                np.zeros(present.sum(), dtype=np.int64), sizes[present],\
+                assembly)
+
+    @classmethod
+    def fromFile(cls, bedFn, assembly=None):
+        """Reads the first three columns of a BED file."""
+        chrNames, starts, ends = [], [], []
+        with open(bedFn) as f:
+            for line in f:
+                line = line.split()
+                if not line or line[0] in ('track', 'browser') or \
+                        line[0].startswith('#'):
+                    continue
+                chrNames.append(line[0])
+                starts.append(int(line[1]))
+                ends.append(int(line[2]))
+        return cls(chrNames, starts, ends, assembly)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return 'GenomeIntervals(<%d intervals>)' % len(self)
+
+    def totalLength(self):
+        return int((self.ends - self.starts).sum())
+
+    def clip(self, chrCodes, starts, ends):
+        """Intersects intervals with these intervals
 
-    dart = Dart()
-    tss = TSS()
-    for line in merged:
-        line = line.split()
+        chrCodes are codes of this object's assembly. Returns (sourceIdx,
+        starts, ends) of the pieces of the given intervals that fall inside
+        these intervals; sourceIdx is the index of the interval each piece
+        came from.
+        """
+        chrCodes = np.asarray(chrCodes, dtype=np.int64)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        pieces = []
+        for chrCode, onChr in _groupByCode(chrCodes):
+            lo, hi = _chrSlice(self.chrOffsets, chrCode)
+            if lo == hi:
+                continue
+            first = np.searchsorted(self.ends[lo:hi], starts[onChr], side='right')
+            last = np.searchsorted(self.starts[lo:hi], ends[onChr], side='left')
+            counts = np.maximum(last - first, 0)
+            runStarts = np.cumsum(counts) - counts
+            source = np.repeat(onChr, counts)
+            inner = lo + np.arange(counts.sum()) -\
+                    np.repeat(runStarts - first, counts)
+            pieceStarts = np.maximum(starts[source], self.starts[inner])
+            pieceEnds = np.minimum(ends[source], self.ends[inner])
+            keep = pieceEnds > pieceStarts
+            pieces.append((source[keep], pieceStarts[keep], pieceEnds[keep]))
+        if not pieces:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        return tuple(np.concatenate(p) for p in zip(*pieces))
+
+def unionLengths(groupCodes, chrCodes, starts, ends, nGroups):
+    """Returns the length of the union of each group's intervals
+
+    All groups are handled in a single sweep: the intervals are sorted by
+    (group, chromosome, start), and each interval adds whatever part of it
+    lies past the furthest end seen so far on its group and chromosome.
+    Intervals on different chromosomes never merge.
+
+    Parameters
+    ----------
+    groupCodes : array of int
+                 group (e.g. term code) of each interval, in [0, nGroups)
+    chrCodes : array of int
+               chromosome code of each interval
+    starts : array of int
+    ends : array of int
+    nGroups : int
+
+    Returns
+    -------
+    array of int of length nGroups
+    """
+    groupCodes = np.asarray(groupCodes, dtype=np.int64)
+    if len(groupCodes) == 0:
+        return np.zeros(nGroups, dtype=np.int64)
+    chrCodes = np.asarray(chrCodes, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    order = np.lexsort((starts, chrCodes, groupCodes))
+    groupCodes, chrCodes = groupCodes[order], chrCodes[order]
+    starts, ends = starts[order], ends[order]
+
+    newSegment = np.ones(len(order), dtype=bool)
+    newSegment[1:] = (groupCodes[1:] != groupCodes[:-1]) |\
+            (chrCodes[1:] != chrCodes[:-1])
+    # offsetting each segment above the previous ones lets one running max
+    # restart at every segment boundary
+    segmentStarts = np.flatnonzero(newSegment)
+    spans = np.maximum.reduceat(ends, segmentStarts) + 1
+    offsets = np.repeat(np.cumsum(spans) - spans, np.diff(\
+            np.append(segmentStarts, len(order))))
+    furthestEnds = np.maximum.accumulate(offsets + ends) - offsets
+    previousEnds = np.empty_like(furthestEnds)
+    previousEnds[0] = 0
+    previousEnds[1:] = furthestEnds[:-1]
+    previousEnds[newSegment] = starts[newSegment]
+    added = np.maximum(ends - np.maximum(starts, previousEnds), 0)
+    return np.bincount(groupCodes, added, minlength=nGroups).astype(np.int64)
+
+def _firstAppearanceCodes(values):
+    """Returns (unique values in order of first appearance, code of each
+    value)"""
+    uniques, first, inverse = np.unique(values, return_index=True,\
+            return_inverse=True)
+    order = np.argsort(first, kind='mergesort')
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    return uniques[order], ranks[inverse.ravel()]
+
+# first number of the term and of the gene column of an ontoToGene.canon line
+_CANON_LINE = re.compile(r'^[^\t\d\n]*(\d+)[^\t\n]*\t[^\t\d\n]*(\d+)', re.M)
+
+class GeneTermMatrix:
+    """Gene x term incidence matrix of an ontoToGene.canon file
+
+    Each "GO:termnumber \t geneID" line of the file is one entry. Genes
+    (rows) and terms (columns) are numbered in order of first appearance
+    and each gene's terms keep their file order, duplicates included, as
+    in the lists of readGeneTermMap. The matrix is held as the indptr and
+    indices arrays of a CSR matrix.
+
+    load parses the file with a single regular expression pass and caches
+    the arrays in the binary columnar format of writeColumns next to it
+    (ontoToGene.canon.csr). Later loads memory-map the cache as long as
+    the .canon file keeps its size and modification time.
+
+    Parameters
+    ----------
+    geneIDs : array of str
+              gene id of each row
+    termIDs : array of int
+              term id of each column
+    indptr, indices : array of int
+              the terms of geneIDs[i] are
+              termIDs[indices[indptr[i]:indptr[i+1]]]
+
+    Example
+    --------
+    >>> geneTerms = GeneTermMatrix.load('ontoToGene.canon')
+    >>> counts = geneTerms.matrix().T.dot(geneWeights)
+    """
+
+    CACHE_SUFFIX = '.csr'
+
+    def __init__(self, geneIDs, termIDs, indptr, indices):
+        self.geneIDs = geneIDs
+        self.termIDs = termIDs
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def fromCanon(cls, geneOntologyFn):
+        """Parses an ontoToGene.canon file."""
+        with open(geneOntologyFn) as f:
+            text = f.read()
+        entries = _CANON_LINE.findall(text)
+        nLines = text.count('\n') + (text != '' and text[-1] != '\n')
+        if len(entries) != nLines:
+            raise ValueError("Expecting a term and a gene number on each of "\
+                    "the %d lines of %s, found %d" % (nLines, geneOntologyFn,\
+                    len(entries)))
+        instrument.count('ontologyLines', nLines)
+        if not entries:
+            return cls.fromDict({})
+        entries = np.array(entries)
+        # terms are few: only their distinct numbers are converted to int
+        termNumbers, termCodes = np.unique(entries[:, 0], return_inverse=True)
+        termIDs = np.array([int(term) for term in termNumbers.tolist()],\
+                dtype=np.int64)
+        return cls._fromEntries(entries[:, 1], termIDs[termCodes.ravel()])
+
+    @classmethod
+    def fromDict(cls, genetoterms):
+        """Builds the matrix of a gene id -> list of int term ids dict."""
+        geneIDs, termIDs = [], []
+        for geneID, terms in genetoterms.items():
+            geneIDs.extend([geneID]*len(terms))
+            termIDs.extend(terms)
+        return cls._fromEntries(np.array(geneIDs, dtype=str),\
+                np.array(termIDs, dtype=np.int64))
+
+    @classmethod
+    def _fromEntries(cls, entryGeneIDs, entryTermIDs):
+        geneIDs, geneCodes = _firstAppearanceCodes(entryGeneIDs)
+        termIDs, termCodes = _firstAppearanceCodes(entryTermIDs)
+        order = np.argsort(geneCodes, kind='mergesort')
+        indptr = np.searchsorted(geneCodes[order],\
+                np.arange(len(geneIDs) + 1)).astype(np.int64)
+        return cls(geneIDs, termIDs, indptr, termCodes[order])
+
+    @classmethod
+    def load(cls, geneOntologyFn, cache=True):
+        """Reads an ontoToGene.canon file, through its binary cache when
+        cache is set; the cache is written if missing or stale and its
+        directory is writable."""
+        if not cache:
+            return cls.fromCanon(geneOntologyFn)
+        stat = os.stat(geneOntologyFn)
+        source = np.array([stat.st_size, int(stat.st_mtime*1e6)],\
+                dtype=np.int64)
+        cacheFn = geneOntologyFn + cls.CACHE_SUFFIX
+        try:
+            columns = mapColumns(cacheFn, 'GeneTermMatrix')
+            if np.array_equal(columns['source'], source):
+                return cls(columns['geneIDs'], columns['termIDs'],\
+                        columns['indptr'], columns['indices'])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        geneTerms = cls.fromCanon(geneOntologyFn)
+        try:
+            geneTerms.write(cacheFn, source)
+        except (IOError, OSError):
+            pass
+        return geneTerms
+
+    def write(self, binaryFn, source=None):
+        """Writes the matrix in the binary columnar format; source is the
+        (size, mtime in microseconds) of the .canon file it was read from.
+        The file is written under a temporary name and renamed."""
+        columns = [('geneIDs', self.geneIDs), ('termIDs', self.termIDs),\
+                ('indptr', self.indptr), ('indices', self.indices),\
+                ('source', np.zeros(2, dtype=np.int64) if source is None\
+                else source)]
+        tmpFn = '%s.%d.tmp' % (binaryFn, os.getpid())
+        try:
+            writeColumns(tmpFn, 'GeneTermMatrix', columns)
+            os.rename(tmpFn, binaryFn)
+        finally:
+            if os.path.exists(tmpFn):
+                os.remove(tmpFn)
+
+    def __len__(self):
+        return len(self.geneIDs)
+
+    def __repr__(self):
+        return 'GeneTermMatrix(<%d genes, %d terms, %d annotations>)' %\
+                (len(self.geneIDs), len(self.termIDs), len(self.indices))
+
+    def matrix(self):
+        """Returns the incidence as a scipy.sparse.csr_matrix of ones."""
+        return scipy.sparse.csr_matrix((np.ones(len(self.indices)),\
+                self.indices, self.indptr),\
+                shape=(len(self.geneIDs), len(self.termIDs)))
+
+    def rowsOf(self, geneIDs):
+        """Returns the row of each gene id, -1 for genes without terms."""
+        geneIDs = np.asarray(geneIDs)
+        if len(self.geneIDs) == 0:
+            return np.full(len(geneIDs), -1, dtype=np.int64)
+        order = np.argsort(self.geneIDs, kind='mergesort')
+        sortedIDs = self.geneIDs[order]
+        pos = np.minimum(np.searchsorted(sortedIDs, geneIDs),\
+                len(sortedIDs) - 1)
+        return np.where(sortedIDs[pos] == geneIDs, order[pos], -1)
+
+    def geneTerms(self):
+        """Returns a dict of gene id -> list of int term ids."""
+        terms = self.termIDs[self.indices].tolist()
+        bounds = self.indptr.tolist()
+        genetoterms = collections.defaultdict(list)
+        for i, geneID in enumerate(self.geneIDs.tolist()):
+            genetoterms[geneID] = terms[bounds[i]:bounds[i + 1]]
+        return genetoterms
+
+def readGeneTermMap(geneOntologyFn):
+    """Returns a dict of gene id -> list of int term ids from ontoToGene.canon
+
+    The file is read through GeneTermMatrix.load and its binary cache.
+    """
+    return GeneTermMatrix.load(geneOntologyFn).geneTerms()
+
+class OntologyIndex:
+    """Gene -> term annotation joined to the regulatory domains
+
+    Everything about an ontology that does not depend on the darts is
+    built once: the gene x term incidence matrix and one (term, regulatory
+    domain) interval per term of each domain's gene, clipped to the
+    antigap regions when given. Term coverage for a dart set then only
+    masks these intervals down to the genes hit and runs one unionLengths
+    sweep, and scorePairs scores every term with a few sparse products, so
+    one OntologyIndex can serve any number of dart sets.
+
+    Parameters
+    ----------
+    regDoms : RegDomIndex or str
+              regulatory domains, or the name of a regDom file
+    geneOntologyFn : str, GeneTermMatrix or dict
+                     name of the term -> gene file (e.g. ontoToGene.canon),
+                     read with GeneTermMatrix.load, its GeneTermMatrix, or
+                     a gene -> terms dict as returned by readGeneTermMap
+    antigapFn : str or GenomeIntervals
+                name of an antigap BED file, or its GenomeIntervals on the
+                regDoms' assembly; coverage is then intersected with it
+                and divided by its total length (default = None)
+    genomeSize : int
+                 denominator of the coverage without antigapFn
+                 (default = total length of the regDoms' assembly)
+    assembly : Assembly or str
+               assembly to read regDoms on when it is a file name, see
+               getAssembly (default = DEFAULT_ASSEMBLY)
+
+    Attributes
+    ----------
+    regDoms : RegDomIndex
+    geneTermMatrix : GeneTermMatrix
+    genetoterms : dict
+                  gene id -> list of int term ids, built from
+                  geneTermMatrix on first use
+    regDomGeneRows : array of int
+                     geneTermMatrix row of each regDom's gene, -1 for
+                     genes without terms
+    terms : list of str
+            term ids, indexed by the interval term codes
+    regDomTerms, regDomTermOffsets : array of int
+            codes of the terms of regDoms[i]'s gene are
+            regDomTerms[regDomTermOffsets[i]:regDomTermOffsets[i+1]],
+            i.e. the indices and indptr of the regdom x term incidence
+            matrix returned by termIncidence
+    genomeSize : int
+                 denominator of the coverage
+    """
+
+    @instrument.timed('ontology')
+    def __init__(self, regDoms, geneOntologyFn, antigapFn=None,\
+            genomeSize=None, assembly=None):
+        if not isinstance(regDoms, RegDomIndex):
+            regDoms = RegDomIndex.fromFile(regDoms, assembly)
+        self.regDoms = regDoms
+        if isinstance(geneOntologyFn, GeneTermMatrix):
+            self.geneTermMatrix = geneOntologyFn
+        elif isinstance(geneOntologyFn, dict):
+            self.geneTermMatrix = GeneTermMatrix.fromDict(geneOntologyFn)
+            self.genetoterms = geneOntologyFn
+        else:
+            self.geneTermMatrix = GeneTermMatrix.load(geneOntologyFn)
+
+        # one (term, regdom) interval per term of each regdom's gene
+        matrix = self.geneTermMatrix
+        rows = matrix.rowsOf(regDoms.geneIDs)
+        self.regDomGeneRows = rows
+        known = rows >= 0
+        starts = np.where(known, matrix.indptr[np.maximum(rows, 0)], 0)
+        counts = np.where(known, matrix.indptr[rows + 1] - starts, 0)
+        runStarts = np.cumsum(counts) - counts
+        regDomIdx = np.repeat(np.arange(len(regDoms)), counts)
+        columns = matrix.indices[np.arange(counts.sum()) -\
+                np.repeat(runStarts - starts, counts)]
+        # terms are coded in order of first appearance over the regdoms
+        termColumns, intervalTerms = _firstAppearanceCodes(columns)
+        self.terms = [str(term) for term in\
+                matrix.termIDs[termColumns].tolist()]
+        self.regDomTerms = intervalTerms
+        self.regDomTermOffsets = np.searchsorted(regDomIdx,\
+                np.arange(len(regDoms) + 1))
+        starts = regDoms.starts[regDomIdx]
+        ends = regDoms.ends[regDomIdx]
+
+        if antigapFn is not None:
+            antigaps = antigapFn
+            if not isinstance(antigaps, GenomeIntervals):
+                antigaps = GenomeIntervals.fromFile(antigapFn, regDoms.assembly)
+            source, starts, ends = antigaps.clip(regDoms.chrCodes[regDomIdx],\
+                    starts, ends)
+            regDomIdx, intervalTerms = regDomIdx[source], intervalTerms[source]
+            self.genomeSize = antigaps.totalLength()
+        elif genomeSize is not None:
+            self.genomeSize = genomeSize
+        else:
+            self.genomeSize = regDoms.assembly.totalLength()
+        self.intervalRegDoms = regDomIdx
+        self.intervalTerms = intervalTerms
+        self.intervalStarts = starts
+        self.intervalEnds = ends
+        instrument.count('ontologyTerms', len(self.terms))
+
+    def __repr__(self):
+        return 'OntologyIndex(<%d genes, %d terms>)' %\
+                (len(self.geneTermMatrix), len(self.terms))
+
+    def __getattr__(self, name):
+        # the gene -> terms dict is only needed to write associations
+        if name != 'genetoterms':
+            raise AttributeError(name)
+        self.genetoterms = self.geneTermMatrix.geneTerms()
+        return self.genetoterms
+
+    def getTerms(self, geneID):
+        return [str(x) for x in self.genetoterms.get(geneID, [])]
+
+    def expandTerms(self, regDomIdx):
+        """Returns (idx, termCodes) with one entry per term of the gene of
+        each regDomIdx[i], idx being that i."""
+        starts = self.regDomTermOffsets[regDomIdx]
+        counts = self.regDomTermOffsets[np.asarray(regDomIdx) + 1] - starts
+        runStarts = np.cumsum(counts) - counts
+        idx = np.repeat(np.arange(len(counts)), counts)
+        return idx, self.regDomTerms[np.arange(counts.sum()) -\
+                np.repeat(runStarts - starts, counts)]
+
+    def termCoverage(self, genes=None):
+        """Returns a dict of term id -> fraction of the genome it covers
+
+        Only the regulatory domains of genes in the set genes count (all of
+        them when genes is None); terms without any are left out.
+        """
+        keptRegDoms = None
+        if genes is not None:
+            keptRegDoms = np.fromiter((geneID in genes for geneID in\
+                    self.regDoms.geneIDs), dtype=bool, count=len(self.regDoms))
+        coverage, present = self.coverageOf(keptRegDoms)
+        return dict((self.terms[k], float(coverage[k]))\
+                for k in np.flatnonzero(present).tolist())
+
+    def coverageOf(self, keptRegDoms=None):
+        """Returns (fraction of the genome covered by each term code, whether
+        the term has any regulatory domain), counting only the regdoms where
+        the boolean array keptRegDoms is set (default = all)."""
+        if keptRegDoms is None:
+            kept = np.ones(len(self.intervalTerms), dtype=bool)
+        else:
+            kept = keptRegDoms[self.intervalRegDoms]
+        intervalTerms = self.intervalTerms[kept]
+        coverage = unionLengths(intervalTerms,\
+                self.regDoms.chrCodes[self.intervalRegDoms[kept]],\
+                self.intervalStarts[kept], self.intervalEnds[kept],\
+                len(self.terms))
+        present = np.bincount(intervalTerms, minlength=len(self.terms)) > 0
+        return coverage/float(self.genomeSize), present
+
+    def termIncidence(self):
+        """Returns the regdom x term incidence matrix, a
+        scipy.sparse.csr_matrix with a 1 for each term of each regdom's
+        gene; built on first use."""
+        if '_termIncidence' not in self.__dict__:
+            self._termIncidence = scipy.sparse.csr_matrix(\
+                    (np.ones(len(self.regDomTerms)), self.regDomTerms,\
+                    self.regDomTermOffsets),\
+                    shape=(len(self.regDoms), len(self.terms)))
+        return self._termIncidence
+
+    @instrument.timed('scoring')
+    def scorePairs(self, pairs, weights, whichBeta):
+        """Scores every term hit by dart-regdom pairs with sparse products
+
+        Gives the TermScores that scoreTerms gives on the pairs' association
+        table, without building the table. With R the regdom x term
+        incidence matrix, the pair counts and alpha of every term are R^T
+        times the per-regdom pair counts and weight sums, and beta comes
+        from the same kind of product (whichBeta 5), a per-term maximum
+        over the rows of R^T (2), or the dart x term weights D R, D being
+        the dart x regdom pair weights (4). whichBeta 3 needs the TSSs of
+        every term and is left to scoreTerms.
+
+        Parameters
+        ----------
+        pairs : DartRegDomPairs
+                pairs of a join against self.regDoms
+        weights : array of float
+                  weight of each pair
+        whichBeta : int
+                    1, 2, 4 or 5, see scoreTerms
+
+        Returns
+        -------
+        TermScores
+        """
+        if whichBeta not in (1, 2, 4, 5):
+            raise ValueError("whichBeta must be 1, 2, 4 or 5: %r" % whichBeta)
+        incidence = self.termIncidence()
+        nRegDoms = len(self.regDoms)
+        regDomIdx = pairs.regDomIdx
+        weights = np.asarray(weights, dtype=np.float64)
+        counts = incidence.T.dot(np.bincount(regDomIdx,\
+                minlength=nRegDoms).astype(np.float64))
+        alphas = incidence.T.dot(np.bincount(regDomIdx, weights,\
+                minlength=nRegDoms))
+
+        # the association table would hold the terms hit, sorted, and
+        # UNKNOWN for the pairs of genes without terms
+        termIDs = np.array(self.terms, dtype=str)
+        order = np.argsort(termIDs, kind='mergesort')
+        hit = order[counts[order] > 0]
+        hasUnknown = bool(np.any(np.diff(self.regDomTermOffsets)[regDomIdx]\
+                == 0))
+        instrument.count('terms', len(hit))
+        if len(hit) == 0:
+            empty = np.zeros(0)
+            return TermScores(termIDs[hit], empty, empty, empty,\
+                    nTerms=int(hasUnknown))
+
+        # coverage of the regdoms of the genes hit
+        rows = self.regDomGeneRows
+        keptRegDoms = (rows >= 0) & np.isin(rows, rows[regDomIdx])
+        xs = self.coverageOf(keptRegDoms)[0]
+
+        if whichBeta == 1:
+            betas = counts - alphas
+        elif whichBeta == 2:
+            regDomMaxWeights = np.zeros(nRegDoms)
+            np.maximum.at(regDomMaxWeights, regDomIdx, weights)
+            betas = counts*_rowMax(incidence.T.tocsr(), regDomMaxWeights) -\
+                    alphas
+        else:
+            # darts are told apart by name, as in the association table
+            dartCodes = np.unique(pairs.darts.names,\
+                    return_inverse=True)[1].ravel()[pairs.dartIdx]
+            nDarts = dartCodes.max() + 1 if len(dartCodes) else 0
+            if whichBeta == 4:
+                shape = (nDarts, nRegDoms)
+                dartWeights = scipy.sparse.csr_matrix((weights,\
+                        (dartCodes, regDomIdx)), shape=shape).dot(incidence)
+                # with ones, no (dart, term) sum cancels to an implicit 0
+                dartHits = scipy.sparse.csr_matrix((np.ones(len(weights)),\
+                        (dartCodes, regDomIdx)), shape=shape).dot(incidence)
+                betas = dartHits.getnnz(axis=0)*\
+                        dartWeights.max(axis=0).toarray().ravel() - alphas
+            else:
+                dartMaxWeights = np.zeros(nDarts)
+                np.maximum.at(dartMaxWeights, dartCodes, weights)
+                betas = incidence.T.dot(np.bincount(regDomIdx,\
+                        dartMaxWeights[dartCodes], minlength=nRegDoms)) -\
+                        alphas
+
+        return TermScores(termIDs[hit], alphas[hit], betas[hit], xs[hit],\
+                nTerms=len(hit) + hasUnknown)
+
+def _rowMax(matrix, values):
+    """Returns the largest values[j] over the entries (i, j) of each row i
+    of a CSR matrix, 0 for empty rows."""
+    rowMax = np.zeros(matrix.shape[0])
+    nonEmpty = np.flatnonzero(np.diff(matrix.indptr) > 0)
+    if len(nonEmpty):
+        rowMax[nonEmpty] = np.maximum.reduceat(values[matrix.indices],\
+                matrix.indptr[nonEmpty])
+    return rowMax
+
+class BinomialEnrichment:
+    """Region-based GREAT binomial test of every term of an ontology
+
+    This is calculateBinomialP for all terms at once. The antigap regions
+    are loaded once (by the OntologyIndex), and the gap-masked fraction of
+    the genome annotated by each term's regulatory domains comes from one
+    unionLengths sweep over every term. A dart set is then scored with one
+    join and one vectorized Beta evaluation: with n darts of which k hit a
+    term annotating a fraction p of the genome, the binomial p-value
+    P(X >= k) is the Beta(k, n - k + 1) cdf at p, and 1 when k = 0.
 
-        dart.chrName = line[0]
-        dart.name = line[3]
-        dart.position = (int(line[1]) + int(line[2]))/2
+    Parameters
+    ----------
+    ontology : OntologyIndex
+               built with the antigap file of the genome
 
-        tss.chrName = line[4]
-        tss.position = int(line[10])
-        tss.geneName = line[7]
-        tss.geneID = line[8]
+    Attributes
+    ----------
+    termIDs : array of str
+              the terms of ontology.terms
+    fractions : array of float
+                gap-masked fraction of the genome annotated by each term
 
-        dartTSSPair = wgtRegDom.makeDartTSSPair(dart, tss)
-        dartsToWeightsFile.write(str(dartTSSPair) + "\n")
+    Example
+    --------
+    >>> regDoms = RegDomIndex.fromLoci('hg18.loci', 1000000)
+    >>> binomial = BinomialEnrichment(OntologyIndex(regDoms,\
+            'ontoToGene.canon', 'antigap.bed'))
+    >>> scores = binomial.score(DartSet.fromFile('SRF.hg18.bed'))
+    """
 
+    def __init__(self, ontology):
+        self.ontology = ontology
+        self.termIDs = np.array(ontology.terms)
+        coverage = ontology.termCoverage()
+        self.fractions = np.array([coverage.get(termID, 0.0)\
+                for termID in ontology.terms])
 
-class RegDom:
+    def __repr__(self):
+        return 'BinomialEnrichment(<%d terms>)' % len(self.termIDs)
+
+    def hitCounts(self, darts):
+        """Returns the number of darts hitting a regulatory domain of each
+        term."""
+        pairs = self.ontology.regDoms.join(darts)
+        idx, termCodes = self.ontology.expandTerms(pairs.regDomIdx)
+        # a dart hitting several domains of a term counts once
+        hits = np.unique(termCodes*np.int64(len(darts)) + pairs.dartIdx[idx])
+        return np.bincount(hits // len(darts), minlength=len(self.termIDs))
+
+    def score(self, darts):
+        """Returns the TermScores of a DartSet, alphas holding the hit
+        counts."""
+        hits = self.hitCounts(darts)
+        scores = TermScores(self.termIDs, hits, len(darts) - hits + 1,\
+                self.fractions)
+        scores.logPvals[hits == 0] = 0.0
+        scores.pvals[hits == 0] = 1.0
+        return scores
+
+class RegDom(object):
     """Instantiates a regulatory domain"""
+    __slots__ = ('id', 'start', 'end')
+
     def __init__(self, start, end, id):
         self.id = id
         self.start = start
@@ -715,101 +2580,1174 @@ class RegDom:
 
 class AssociationMaker:
     # Output format:
-    """| term id# |  chrom name | arrow | arrow position (relative to chrom) | gene name | gene id | dart weight |  term coverage % (between 0 and 1) |"""
-    dartTSSPairs = []
-    genetoterms = collections.defaultdict(lambda :[])
-    termtocoverage = collections.defaultdict(lambda : 0.0)
+    """| term id# |  chrom name | arrow | arrow position (relative to chrom) | gene name | gene id | dart weight |  term coverage % (between 0 and 1) |
+
+    The dart-TSS pairs are streamed: iterAssociations (and iterating the
+    maker) yields one (term, pair, coverage) record at a time, so writing
+    or aggregating the associations never holds them all in memory. Only
+    the term coverage, which depends on every gene hit, is computed up
+    front, from the genes argument or from a first pass over the pairs. All
+    state belongs to the instance.
+    """
+    def __init__(self, dartsToWeights, geneOntology, regDoms=None,\
+            antigapFn=None, genomeSize=None, assembly=None, genes=None):
+        """dartsToWeights is a .wgt file name or an iterable of DartTSSPair.
+        geneOntology is an OntologyIndex, or the name of the term -> gene
+        file from which one is built with regDoms (a regDom file name or a
+        RegDomIndex), antigapFn, genomeSize and assembly.
+
+        genes is the set of gene ids of the pairs, when known. A .wgt file
+        is read once for its genes (unless given) and again while
+        streaming. A one-shot iterator of pairs is streamed as is if genes
+        is given, and can then be iterated only once; otherwise it is
+        first stored in a list."""
+        self.termtocoverage = collections.defaultdict(lambda : 0.0)
+        if isinstance(dartsToWeights, str):
+            self.dartsToWeightsFn = dartsToWeights
+            self.dartTSSPairs = None
+            if genes is None:
+                genes = self.readDartWeightsGenes(dartsToWeights)
+        else:
+            self.dartsToWeightsFn = None
+            if genes is None and iter(dartsToWeights) is dartsToWeights:
+                dartsToWeights = list(dartsToWeights)
+            self.dartTSSPairs = dartsToWeights
+        if isinstance(geneOntology, OntologyIndex):
+            self.ontology = geneOntology
+        else:
+            self.ontology = OntologyIndex(regDoms, geneOntology, antigapFn,\
+                    genomeSize, assembly)
+        self.genetoterms = self.ontology.genetoterms
+        self.buildTermWeightsMap(genes)
 
-    def __init__(self, dartsToWeightsFn, geneOntologyFn, regDomFn):
-        self.readDartWeightsFile(dartsToWeightsFn)
-        self.buildGeneTermMap(geneOntologyFn)
-        self.buildTermWeightsMap(regDomFn)
+    def __iter__(self):
+        return self.iterAssociations()
 
     def readDartWeightsFile(self, fstr):
+        """Yields a DartTSSPair for each line of a .wgt file"""
         with open(fstr) as f:
             for line in f:
                 line = line.split("\t")
-                dartTSSPair = DartTSSPair(\
-                        chrName=line[0],\
-                        dartName=line[1],\
-                        dartPosition=line[2],\
-                        geneName=line[3],\
-                        geneID=line[4],\
-                        TSSPosition=line[5],\
-                        weight=float(line[6]))
-
-                self.dartTSSPairs.append(dartTSSPair)
-
-    def buildGeneTermMap(self, geneOntologyFn):
-        f = open(geneOntologyFn)
-        for line in f:
-            line = line.split("\t")
-            term_id = int(re.search("\d+", line[0]).group(0))
-            geneID = re.search("\d+", line[1]).group(0)
-            self.genetoterms[geneID].append(term_id)
-
-    def buildTermWeightsMap(self, regDomFn):
-        genes = [dartTSSPair.geneID for dartTSSPair in self.dartTSSPairs]
-        regdoms = []
-        with open(regDomFn) as f:
-            for line in f:
-                line = line.split()
-                if line[4] in genes:
-                    regdoms.append(RegDom(int(line[1]),int(line[2]),line[4]))
-        genome_size = sum(HUMAN_CHROMOSOME_SIZES)
-        # build the map of terms to regdoms
-        termtoregdoms = collections.defaultdict(lambda : [])
-        for regdom in regdoms:
-            terms = self.getTerms(regdom.id)
-            for term in terms:
-                termtoregdoms[term].append(regdom)
-        # find the total length of all regions associated with that term
-        for item in termtoregdoms.items():
-            term = item[0]
-            regdoms = item[1]
-            nonoverlapping = self.removeOverlaps([(regdom.start,regdom.end) for regdom in regdoms])
-            coverage = sum([x[1]-x[0] for x in nonoverlapping])
-            percent = float(coverage)/genome_size
-            self.termtocoverage[term] = percent
+                # positional, in DartTSSPair's argument order
+                yield DartTSSPair(line[0], line[1], int(line[2]),\
+                        int(line[5]), float(line[6]), line[3], line[4])
 
+    def readDartWeightsGenes(self, fstr):
+        """Returns the set of gene ids of a .wgt file"""
+        with open(fstr) as f:
+            return set(line.split("\t")[4] for line in f)
 
-    # from http://stackoverflow.com/questions/1233292/whats-a-good-generic-algorithm-for-collapsing-a-set-of-potentially-overlapping
-    def removeOverlaps(self, ranges):
-        result = []
-        cur = None
-        for start, stop in sorted(ranges): # sorts by start
-            if cur is None:
-                cur = (start, stop)
-                continue
-            cStart, cStop = cur
-            if start <= cStop:
-                cur = (cStart, max(stop, cStop))
-            else:
-                result.append(cur)
-                cur = (start, stop)
-        result.append(cur)
-        return result
+    def iterDartTSSPairs(self):
+        """Yields the dart-TSS pairs, reading the .wgt file if there is one"""
+        if self.dartsToWeightsFn is not None:
+            return self.readDartWeightsFile(self.dartsToWeightsFn)
+        return iter(self.dartTSSPairs)
+
+    @instrument.timed('associations')
+    def buildTermWeightsMap(self, genes=None):
+        """Sets the fraction of the genome covered by each term
 
+        The coverage of a term is the length of the union of the regulatory
+        domains of its genes that have a dart-TSS pair, as computed by
+        OntologyIndex.termCoverage.
+        """
+        if genes is None:
+            genes = set(dartTSSPair.geneID for dartTSSPair in\
+                    self.iterDartTSSPairs())
+        self.termtocoverage.update(self.ontology.termCoverage(genes))
+
+    # from http://stackoverflow.com/questions/1233292/whats-a-good-generic-algorithm-for-collapsing-a-set-of-potentially-overlapping
     def getTerms(self, geneID):
         #return [str(x[0]) for x in self.termtogenes.items() if gene in x[1]]
-        return map(lambda x: str(x), self.genetoterms[geneID])
+        return [str(x) for x in self.genetoterms.get(geneID, [])]
 
     def buildLine(self, term_name, dartTSSPair, term_weight):
         return term_name + "\t" + str(dartTSSPair) + "\t" + str(term_weight) + "\n"
 
-    def writeOutput(self, output_file):
-        f = open(output_file, "w")
-        for dartTSSPair in self.dartTSSPairs:
+    def iterAssociations(self):
+        """Yields (term, dartTSSPair, term coverage) for each line of output"""
+        termtocoverage = self.termtocoverage
+        for dartTSSPair in self.iterDartTSSPairs():
             terms = self.getTerms(dartTSSPair.geneID)
             if terms == []: # in case we get a gene that for some reason has no terms associated
-                f.write(self.buildLine("UNKNOWN", dartTSSPair, "0.0"))
+                yield "UNKNOWN", dartTSSPair, 0.0
             else:
                 for term in terms:
-                    f.write(self.buildLine(term, dartTSSPair, self.termtocoverage[term]))
+                    yield term, dartTSSPair, termtocoverage.get(term, 0.0)
+
+    @instrument.timed('associations')
+    def writeOutput(self, output_file, binary=False):
+        """Writes the associations as text, or with binary in the binary
+        columnar format of TermDartTSSTable.writeBinary"""
+        if binary:
+            self.buildTable().writeBinary(output_file)
+            return
+        f = open(output_file, "w")
+        nLines = 0
+        for nLines, (term, dartTSSPair, coverage) in\
+                enumerate(self.iterAssociations(), 1):
+            f.write(self.buildLine(term, dartTSSPair, coverage))
         f.close()
+        instrument.count('associations', nLines)
+
+    @instrument.timed('associations')
+    def buildTable(self, output_file=None):
+        """Returns the output as a TermDartTSSTable
+
+        When output_file is given, the text output is written to it in the
+        same pass over the pairs.
+        """
+        columns = [[] for i in range(9)]
+        f = open(output_file, "w") if output_file is not None else None
+        try:
+            for term, p, coverage in self.iterAssociations():
+                if f is not None:
+                    f.write(self.buildLine(term, p, coverage))
+                for column, field in zip(columns, (term, p.chrName,\
+                        p.dartName, p.dartPosition, p.geneName, p.geneID,\
+                        p.TSSPosition, p.weight, coverage)):
+                    column.append(field)
+        finally:
+            if f is not None:
+                f.close()
+        instrument.count('associations', len(columns[0]))
+        return TermDartTSSTable(*columns,\
+                assembly=self.ontology.regDoms.assembly)
+
+def convertAssociations(textFn, binaryFn, assembly=None):
+    """Converts an AssociationMaker text file to the binary columnar format
+
+    assembly is passed to TermDartTSSTable.fromFile. Returns the table.
+    """
+    table = TermDartTSSTable.fromFile(textFn, assembly)
+    table.writeBinary(binaryFn)
+    return table
+
+@instrument.timed('output')
+def writeRankedTerms(scores, ontoTerms, outFn, correction, nBest=30):
+    """Writes the nBest terms of a TermScores, most significant first
+
+    Each line holds the Bonferroni corrected p-value (p * correction), the
+    term id and its description from ontoTerms.
+    """
+    with open(outFn, 'w') as outFile:
+        outFile.writelines(rankedTermLines(scores, ontoTerms, correction,\
+                nBest))
+
+def rankedTermLines(scores, ontoTerms, correction, nBest=30):
+    """Yields the lines writeRankedTerms writes"""
+    logCorrection = np.log(correction)
+    for k in scores.ranked()[0:nBest].tolist():
+        termID = scores.termIDs[k]
+        if(int(termID) in ontoTerms): desc = ontoTerms[int(termID)]
+        else: desc = "No description available"
+        yield formatLogP(scores.logPvals[k] + logCorrection) +\
+                "\t" + termID + "\t" + desc + "\n"
+    yield "\n\n~~~~~~~~~~~~~~~FINISHED~~~~~~~~~~~~~~~"
+
+def scoreDartSet(dartFn, ontology, wgtRegDom, whichBeta, mergedFn=None,\
+        dartsToWeightsFn=None, SRFtoTermsFn=None, wantTable=False):
+    """Scores one dart set against a preloaded OntologyIndex
+
+    Only the dart-regdom join, the dart-TSS weights, the term associations
+    and the scoring are done here; see run for the parameters. dartFn may
+    also be a DartSet.
+
+    The term associations are only built, as a TermDartTSSTable, when
+    SRFtoTermsFn is given, wantTable is set or whichBeta is 3. Otherwise
+    the terms are scored straight from the pairs by
+    OntologyIndex.scorePairs and no table is returned.
+
+    Returns
+    -------
+    (TermScores, TermDartTSSTable or None)
+    """
+    darts = dartFn
+    if not isinstance(darts, DartSet):
+        darts = DartSet.fromFile(dartFn, ontology.regDoms.assembly)
+    pairs = ontology.regDoms.join(darts)
+    if mergedFn is not None:
+        with open(mergedFn, 'w') as merged:
+            merged.writelines(pairs.mergeLines())
+
+    weights = pairWeights(pairs, wgtRegDom)
+    if dartsToWeightsFn is not None:
+        with open(dartsToWeightsFn, 'w') as dartsToWeights:
+            for dartTSSPair in pairs.dartTSSPairs(weights.tolist()):
+                dartsToWeights.write(str(dartTSSPair) + "\n")
+
+    return scoreWeightedPairs(pairs, weights, ontology, whichBeta,\
+            SRFtoTermsFn=SRFtoTermsFn, wantTable=wantTable,\
+            wgtRegDom=wgtRegDom)
+
+@instrument.timed('assignWeights')
+def pairWeights(pairs, wgtRegDom):
+    """Returns the WeightedRegDom weight of every dart-TSS pair of a
+    DartRegDomPairs, as an array."""
+    return wgtRegDom.getDartTSSPairWgts(pairs.darts.positions[pairs.dartIdx],\
+            pairs.regDoms.TSSPositions[pairs.regDomIdx])
+
+def scoreWeightedPairs(pairs, weights, ontology, whichBeta, SRFtoTermsFn=None,\
+        wantTable=False, wgtRegDom=None):
+    """Scores weighted dart-TSS pairs against an OntologyIndex
+
+    The pairs and weights do not depend on the ontology, so they can be
+    computed once and scored against several ontologies built on the same
+    regulatory domains. The table is built as in scoreDartSet, and
+    wgtRegDom, the kernel of the weights, is passed to scoreTerms for
+    whichBeta 3.
+
+    Returns
+    -------
+    (TermScores, TermDartTSSTable or None)
+    """
+    if SRFtoTermsFn is None and not wantTable and whichBeta != 3:
+        return ontology.scorePairs(pairs, weights, whichBeta), None
+
+    maker = AssociationMaker(pairs.dartTSSPairs(weights.tolist()), ontology,\
+            genes=set(pairs.regDoms.geneIDs[pairs.regDomIdx].tolist()))
+    table = maker.buildTable(SRFtoTermsFn)
+
+    return scoreTerms(table, whichBeta, wgtRegDom=wgtRegDom), table
+
+def run(lociFn, ontoToGeneFn, dartFn, cutOff, mean, sd, whichBeta,\
+        antigapFn=None, genomeSize=None, regDomFn=None, mergedFn=None,\
+        dartsToWeightsFn=None, SRFtoTermsFn=None, assembly=None,\
+        wantTable=True):
+    """Runs the GREATx pipeline in memory and returns the term scores
+
+    Regulatory domains, the dart-regdom join, the dart-TSS weights and the
+    term associations are passed between stages as arrays and objects
+    instead of text files. Each intermediate is also written to disk when
+    its file name is given.
+
+    Parameters
+    ----------
+    lociFn : str
+             name of the loci file (e.g. hg18.loci)
+    ontoToGeneFn : str
+                   name of the term -> gene file (e.g. ontoToGene.canon)
+    dartFn : str
+             name of the dart BED file
+    cutOff, mean, sd : int, float, float
+                       WeightedRegDom parameters
+    whichBeta : int
+                Beta variant passed to scoreTerms
+    antigapFn, genomeSize :
+                passed to OntologyIndex
+    regDomFn, mergedFn, dartsToWeightsFn, SRFtoTermsFn : str
+                files to write the regdoms, merged pairs, dart-TSS weights
+                and term associations to (default = None, not written)
+    assembly : Assembly or str
+               assembly of the loci and darts, see getAssembly
+               (default = DEFAULT_ASSEMBLY)
+    wantTable : bool
+                build and return the term association table; without it
+                the terms are scored with sparse products and the table
+                is None, unless SRFtoTermsFn is given or whichBeta is 3
+                (default = True)
+
+    Returns
+    -------
+    (TermScores, TermDartTSSTable)
+    """
+    regDoms = RegDomIndex.fromLoci(lociFn, cutOff, assembly)
+    if regDomFn is not None:
+        regDoms.write(regDomFn)
+    ontology = OntologyIndex(regDoms, ontoToGeneFn, antigapFn, genomeSize)
+
+    return scoreDartSet(dartFn, ontology, WeightedRegDom(cutOff, mean, sd),\
+            whichBeta, mergedFn=mergedFn, dartsToWeightsFn=dartsToWeightsFn,\
+            SRFtoTermsFn=SRFtoTermsFn, wantTable=wantTable)
+
+def listDartFiles(sources):
+    """Expands directories (every *.bed in them) and manifests (one BED
+    file name per line, relative to the manifest) into dart file names."""
+    dartFns = []
+    for source in sources:
+        if os.path.isdir(source):
+            dartFns.extend(sorted(os.path.join(source, fn) for fn in\
+                    os.listdir(source) if fn.endswith('.bed')))
+        elif source.endswith('.bed'):
+            dartFns.append(source)
+        else:
+            with open(source) as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        dartFns.append(os.path.join(os.path.dirname(source),\
+                                line))
+    return dartFns
+
+def batchOutFn(outDir, dartFn):
+    """Returns the result file name of a dart set in runBatch."""
+    return os.path.join(outDir,\
+            os.path.splitext(os.path.basename(dartFn))[0] + '.out')
+
+_batchState = {}
+
+def _initBatchWorker(ontology, wgtRegDom, whichBeta, ontoTerms, outDir):
+    _batchState.update(ontology=ontology, wgtRegDom=wgtRegDom,\
+            whichBeta=whichBeta, ontoTerms=ontoTerms, outDir=outDir)
+
+def _runBatchSet(dartFn):
+    state = _batchState
+    scores, table = scoreDartSet(dartFn, state['ontology'],\
+            state['wgtRegDom'], state['whichBeta'])
+    outFn = batchOutFn(state['outDir'], dartFn)
+    writeRankedTerms(scores, state['ontoTerms'], outFn, scores.nTerms)
+    return outFn
+
+def runBatch(lociFn, ontoToGeneFn, ontoTermsFn, dartFns, outDir, cutOff,\
+        mean, sd, whichBeta, antigapFn=None, genomeSize=None, processes=None,\
+        assembly=None):
+    """Scores many dart sets against one preloaded ontology
+
+    The loci, regulatory domains, gene -> term map and term descriptions
+    are loaded once; the dart sets are then scored by a pool of worker
+    processes, each writing outDir/<dart file name>.out as writeRankedTerms
+    does.
+
+    Parameters
+    ----------
+    lociFn, ontoToGeneFn, cutOff, mean, sd, whichBeta, antigapFn, genomeSize,
+    assembly : as for run
+    ontoTermsFn : str
+                  name of the term -> description file
+    dartFns : list of str
+              dart BED files (see listDartFiles)
+    outDir : str
+             directory for the result files, created if needed
+    processes : int
+                number of worker processes; 1 scores in this process
+                (default = None, one per CPU)
+
+    Returns
+    -------
+    list of str, the result file of each dart set
+    """
+    outFns = [batchOutFn(outDir, dartFn) for dartFn in dartFns]
+    if len(set(outFns)) != len(outFns):
+        raise ValueError("dart files must have distinct base names")
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+
+    regDoms = RegDomIndex.fromLoci(lociFn, cutOff, assembly)
+    initArgs = (OntologyIndex(regDoms, ontoToGeneFn, antigapFn, genomeSize),\
+            WeightedRegDom(cutOff, mean, sd), whichBeta,\
+            buildOntoTermsDict(ontoTermsFn), outDir)
+    if processes == 1:
+        _initBatchWorker(*initArgs)
+        return [_runBatchSet(dartFn) for dartFn in dartFns]
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes, _initBatchWorker, initArgs)
+    try:
+        return pool.map(_runBatchSet, dartFns, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def parseOntology(spec):
+    """Returns (name, ontoToGeneFn, ontoTermsFn) of NAME=ONTOTOGENE,ONTOTERMS"""
+    name, sep, files = spec.partition('=')
+    files = files.split(',')
+    if not sep or len(files) != 2:
+        raise ValueError("expecting NAME=ONTOTOGENE,ONTOTERMS: %s" % spec)
+    return name, files[0], files[1]
+
+_ontologyState = {}
+
+def _initOntologyWorker(pairs, weights, wgtRegDom, whichBeta, antigapFn,\
+        genomeSize, outDir):
+    _ontologyState.update(pairs=pairs, weights=weights, wgtRegDom=wgtRegDom,\
+            whichBeta=whichBeta, antigapFn=antigapFn, genomeSize=genomeSize,\
+            outDir=outDir)
+
+def _runOntology(spec):
+    name, ontoToGeneFn, ontoTermsFn = spec
+    state = _ontologyState
+    pairs = state['pairs']
+    ontology = OntologyIndex(pairs.regDoms, ontoToGeneFn, state['antigapFn'],\
+            state['genomeSize'])
+    scores, table = scoreWeightedPairs(pairs, state['weights'], ontology,\
+            state['whichBeta'], wgtRegDom=state['wgtRegDom'])
+    outFn = os.path.join(state['outDir'], name + '.out')
+    writeRankedTerms(scores, buildOntoTermsDict(ontoTermsFn), outFn,\
+            scores.nTerms)
+    return outFn
+
+def runOntologies(lociFn, ontologies, dartFn, outDir, cutOff, mean, sd,\
+        whichBeta, antigapFn=None, genomeSize=None, processes=None,\
+        assembly=None):
+    """Scores one dart set against several ontologies
+
+    The regulatory domains, the dart-regdom join and the dart-TSS weights
+    do not depend on the ontology and are computed once. The ontologies
+    are then loaded, aggregated and scored by a pool of worker processes,
+    each writing outDir/<name>.out as writeRankedTerms does.
+
+    Parameters
+    ----------
+    lociFn, dartFn, cutOff, mean, sd, whichBeta, antigapFn, genomeSize,
+    assembly : as for run
+    ontologies : list of (str, str, str)
+                 (name, ontoToGeneFn, ontoTermsFn) of each ontology, see
+                 parseOntology
+    outDir : str
+             directory for the result files, created if needed
+    processes : int
+                number of worker processes; 1 scores in this process
+                (default = None, one per CPU up to one per ontology)
+
+    Returns
+    -------
+    list of str, the result file of each ontology
+
+    Example
+    --------
+    >>> runOntologies('hg18.loci', [('GO', 'ontoToGene.canon',
+    ...     'ontoTerms.canon'), ('MP', 'mp.canon', 'mpTerms.canon')],
+    ...     'darts.bed', 'out', 1000000, 0, 333333, 5)
+    ['out/GO.out', 'out/MP.out']
+    """
+    ontologies = [tuple(spec) for spec in ontologies]
+    names = [spec[0] for spec in ontologies]
+    if len(set(names)) != len(names):
+        raise ValueError("ontologies must have distinct names")
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+
+    regDoms = RegDomIndex.fromLoci(lociFn, cutOff, assembly)
+    pairs = regDoms.join(DartSet.fromFile(dartFn, regDoms.assembly))
+    wgtRegDom = WeightedRegDom(cutOff, mean, sd)
+    weights = pairWeights(pairs, wgtRegDom)
+    initArgs = (pairs, weights, wgtRegDom, whichBeta, antigapFn, genomeSize,\
+            outDir)
+    if processes is None:
+        import multiprocessing
+        processes = min(multiprocessing.cpu_count(), len(ontologies))
+    if processes <= 1:
+        _initOntologyWorker(*initArgs)
+        return [_runOntology(spec) for spec in ontologies]
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes, _initOntologyWorker, initArgs)
+    try:
+        return pool.map(_runOntology, ontologies, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+class SweepResult:
+    """Term scores of every point of a parameter grid, one row per
+    (grid point, term)
+
+    Attributes
+    ----------
+    cutOffs, means, sds, whichBetas : arrays
+                                      parameters of each row
+    termIDs : array of str
+              term of each row
+    alphas, betas, xs, logPvals : array of float
+                                  as in TermScores
+    corrections : array of int
+                  number of terms at the row's grid point, i.e. the
+                  Bonferroni correction writeRankedTerms would apply
+    """
+
+    columns = ('cutOffs', 'means', 'sds', 'whichBetas', 'termIDs', 'alphas',\
+            'betas', 'xs', 'logPvals', 'corrections')
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    @classmethod
+    def fromPoints(cls, points):
+        """Stacks a list of ((cutOff, mean, sd, whichBeta), TermScores,
+        correction)."""
+        columns = dict((name, []) for name in cls.columns)
+        for (cutOff, mean, sd, whichBeta), scores, correction in points:
+            n = len(scores)
+            for name, value in zip(cls.columns[:4],\
+                    (cutOff, mean, sd, whichBeta)):
+                columns[name].append(np.repeat(value, n))
+            columns['termIDs'].append(scores.termIDs.astype(object))
+            for name in ('alphas', 'betas', 'xs', 'logPvals'):
+                columns[name].append(getattr(scores, name))
+            columns['corrections'].append(np.repeat(correction, n))
+        return cls(**dict((name, np.concatenate(values) if values else\
+                np.zeros(0)) for name, values in columns.items()))
+
+    def __len__(self):
+        return len(self.logPvals)
+
+    def __repr__(self):
+        return 'SweepResult(<%d rows>)' % len(self)
+
+    def point(self, cutOff, mean, sd, whichBeta):
+        """Returns the rows of one grid point as a boolean mask."""
+        return (self.cutOffs == cutOff) & (self.means == mean) &\
+                (self.sds == sd) & (self.whichBetas == whichBeta)
+
+    def lines(self, nBest=None):
+        """Yields the table as tab separated lines with a header
+
+        Within a grid point rows are ranked most significant first, and
+        only the nBest of each point are written when nBest is given.
+        """
+        yield "\t".join(['cutOff', 'mean', 'sd', 'whichBeta', 'termID',\
+                'alpha', 'beta', 'x', 'p', 'correctedP']) + "\n"
+        # rows of a grid point are contiguous
+        bounds = np.flatnonzero((self.cutOffs[1:] != self.cutOffs[:-1]) |\
+                (self.means[1:] != self.means[:-1]) |\
+                (self.sds[1:] != self.sds[:-1]) |\
+                (self.whichBetas[1:] != self.whichBetas[:-1])) + 1
+        bounds = [0] + bounds.tolist() + [len(self)]
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            rows = lo + np.argsort(self.logPvals[lo:hi], kind='mergesort')
+            for k in rows[:nBest].tolist():
+                yield "\t".join([str(self.cutOffs[k]), str(self.means[k]),\
+                        str(self.sds[k]), str(self.whichBetas[k]),\
+                        self.termIDs[k], str(self.alphas[k]),\
+                        str(self.betas[k]), str(self.xs[k]),\
+                        formatLogP(self.logPvals[k]),\
+                        formatLogP(self.logPvals[k] +\
+                                np.log(self.corrections[k]))]) + "\n"
+
+def _associationRows(pairs, genetoterms):
+    """Expands join pairs into one row per (pair, term of the pair's gene)
+
+    Returns (pair index, term id) arrays with rows ordered by term and by
+    pair within a term, i.e. in the row order of the TermDartTSSTable that
+    AssociationMaker would produce; genes without terms give UNKNOWN.
+    """
+    regDomTerms = [[str(term) for term in genetoterms.get(geneID, [])]\
+            or ['UNKNOWN'] for geneID in pairs.regDoms.geneIDs.tolist()]
+    counts = np.array([len(terms) for terms in regDomTerms], dtype=np.int64)
+    offsets = np.cumsum(counts) - counts
+    flatTerms = np.array([term for terms in regDomTerms for term in terms])
+
+    pairCounts = counts[pairs.regDomIdx]
+    runStarts = np.cumsum(pairCounts) - pairCounts
+    rowPairs = np.repeat(np.arange(len(pairs)), pairCounts)
+    rowTerms = flatTerms[np.arange(pairCounts.sum()) -\
+            np.repeat(runStarts - offsets[pairs.regDomIdx], pairCounts)]
+    order = np.argsort(rowTerms, kind='mergesort')
+    return rowPairs[order], rowTerms[order]
+
+def sweep(lociFn, ontoToGeneFn, dartFn, cutOffs, means, sds, whichBetas,\
+        antigapFn=None, genomeSize=None, assembly=None):
+    """Scores one dart set over a grid of kernel parameters
+
+    The darts are joined once against the regulatory domains of the
+    largest cutOff and every pair is expanded to its terms once. A smaller
+    cutOff keeps the pairs whose dart lies within [TSS - cutOff,
+    TSS + cutOff), exactly the pairs its own join would give, and only
+    recomputes the term coverage. Each (mean, sd) only re-evaluates the
+    kernel weights, and all Beta variants of a point share one
+    DartAggregateIndex. whichBeta 3 uses the point's kernel.
+
+    Parameters
+    ----------
+    lociFn, ontoToGeneFn, dartFn, antigapFn, genomeSize, assembly :
+            as for run
+    cutOffs, means, sds, whichBetas : lists
+            values of each parameter; every combination is scored
+
+    Returns
+    -------
+    SweepResult
+    """
+    cutOffs = sorted(set(cutOffs), reverse=True)
+    regDoms = RegDomIndex.fromLoci(lociFn, cutOffs[0], assembly)
+    geneTermMatrix = GeneTermMatrix.load(ontoToGeneFn)
+    genetoterms = geneTermMatrix.geneTerms()
+    pairs = regDoms.join(DartSet.fromFile(dartFn, regDoms.assembly))
+    dartPositions = pairs.darts.positions[pairs.dartIdx]
+    TSSPositions = regDoms.TSSPositions[pairs.regDomIdx]
+    distances = dartPositions - TSSPositions
+
+    rowPairs, rowTerms = _associationRows(pairs, genetoterms)
+    table = TermDartTSSTable(rowTerms,\
+            pairs.darts.chrNames[pairs.dartIdx][rowPairs],\
+            pairs.darts.names[pairs.dartIdx][rowPairs],\
+            dartPositions[rowPairs], regDoms.geneNames[pairs.regDomIdx][rowPairs],\
+            regDoms.geneIDs[pairs.regDomIdx][rowPairs], TSSPositions[rowPairs],\
+            np.zeros(len(rowPairs)), np.zeros(len(rowPairs)),\
+            regDoms.assembly)
+
+    points = []
+    for cutOff in cutOffs:
+        inRange = (distances >= -cutOff) & (distances < cutOff)
+        rows = inRange[rowPairs]
+        ontology = OntologyIndex(regDoms.withCutOff(cutOff), geneTermMatrix,\
+                antigapFn, genomeSize)
+        coverage = ontology.termCoverage(\
+                set(regDoms.geneIDs[pairs.regDomIdx[inRange]].tolist()))
+        termCoverages = np.array([coverage.get(termID, 0.0)\
+                for termID in table.termIDs.tolist()])
+        cutTable = table.select(rows,\
+                percentCoverages=termCoverages[table.termCodes[rows]])
+        cutPairs = rowPairs[rows]
+        for mean in means:
+            for sd in sds:
+                wgtRegDom = WeightedRegDom(cutOff, mean, sd)
+                weights = wgtRegDom.getDartTSSPairWgts(dartPositions,\
+                        TSSPositions)
+                cutTable.weights = weights[cutPairs]
+                aggregates = DartAggregateIndex(cutTable)
+                for whichBeta in whichBetas:
+                    scores = scoreTerms(cutTable, whichBeta, aggregates,\
+                            wgtRegDom)
+                    points.append(((cutOff, mean, sd, whichBeta), scores,\
+                            len(cutTable.termIDs)))
+    return SweepResult.fromPoints(points)
+
+class PermutationNull:
+    """Empirical null of the term p-values of a dart set
+
+    Random dart sets are drawn uniformly from the background regions,
+    keeping the number of darts on each chromosome, and are pushed through
+    the same join, kernel weighting, term association, coverage and Beta
+    scoring as the observed darts. A batch of permutations is handled as
+    one set of arrays: every term of every permutation is a group, so a
+    batch costs one join, one coverage sweep and one Beta evaluation.
+
+    Darts on a chromosome without any background region (e.g. chrM or a
+    random contig missing from an antigap file) cannot be permuted. They
+    are left out of the observed darts as well as the random ones, so both
+    are scored on the same darts; their number is reported on stderr and
+    kept in droppedDarts.
+
+    Parameters
+    ----------
+    regDoms : RegDomIndex
+    ontology : OntologyIndex
+               built on regDoms
+    darts : DartSet
+            the observed darts
+    wgtRegDom : WeightedRegDom
+    whichBeta : int
+                1, 2, 4 or 5, as in scoreTerms (3 searches for the best
+                dart one term at a time and is too slow to permute)
+    background : GenomeIntervals
+                 regions random darts are drawn from (default = None, the
+                 whole of every chromosome of the regDoms' assembly)
+
+    Attributes
+    ----------
+    observed : TermScores
+               scores of the observed darts over ontology.terms
+    nDarts : int
+             number of darts scored, droppedDarts excluded
+    droppedDarts : int
+                   number of darts left out for lack of background
+    """
+
+    def __init__(self, regDoms, ontology, darts, wgtRegDom, whichBeta,\
+            background=None):
+        if whichBeta not in (1, 2, 4, 5):
+            raise ValueError("whichBeta must be 1, 2, 4 or 5: %r" % whichBeta)
+        if background is None:
+            background = GenomeIntervals.wholeGenome(regDoms.assembly)
+        elif background.assembly is not regDoms.assembly:
+            raise ValueError("background and regDoms are on different "\
+                    "assemblies")
+        self.regDoms = regDoms
+        self.ontology = ontology
+        self.wgtRegDom = wgtRegDom
+        self.whichBeta = whichBeta
+        self.background = background
+
+        geneIDs, self.regDomGenes = np.unique(regDoms.geneIDs,\
+                return_inverse=True)
+        self.nGenes = len(geneIDs)
+
+        # dart counts per chromosome and the background to draw them from
+        self.chrDartCounts = []
+        observed = []
+        dropped = {}
+        for chrCode, onChr in _groupByCode(regDoms._codesOf(darts)):
+            lo, hi = _chrSlice(background.chrOffsets, chrCode)
+            if lo == hi:
+                dropped[regDoms.assembly.chrNames[chrCode]] = len(onChr)
+                continue
+            lengths = background.ends[lo:hi] - background.starts[lo:hi]
+            self.chrDartCounts.append((chrCode, len(onChr),\
+                    background.starts[lo:hi], np.cumsum(lengths)))
+            observed.append((chrCode,\
+                    darts.positions[onChr][np.newaxis, :]))
+        self.nDarts = sum(n for chrCode, n, starts, ends in self.chrDartCounts)
+        self.droppedDarts = sum(dropped.values())
+        if dropped:
+            instrument.count('droppedDarts', self.droppedDarts)
+            sys.stderr.write('PermutationNull: dropped %d darts on '\
+                    'chromosomes without background regions (%s)\n' %\
+                    (self.droppedDarts, ', '.join('%s: %d' % item\
+                    for item in sorted(dropped.items()))))
+
+        self.observed = TermScores(np.array(ontology.terms),\
+                *self._score(observed, 1))
+
+    def __repr__(self):
+        return 'PermutationNull(<%d darts, %d terms>)' %\
+                (self.nDarts, len(self.ontology.terms))
+
+    def randomDarts(self, rng, nPermutations):
+        """Returns [(chrCode, nPermutations x darts on chrCode positions)]."""
+        positions = []
+        for chrCode, n, starts, cumLengths in self.chrDartCounts:
+            # u is an offset into the concatenated background regions
+            u = rng.integers(0, cumLengths[-1], size=(nPermutations, n))
+            idx = np.searchsorted(cumLengths, u, side='right')
+            precedingLengths = np.append(0, cumLengths[:-1])
+            positions.append((chrCode, starts[idx] + u - precedingLengths[idx]))
+        return positions
+
+    def _score(self, positions, nPermutations):
+        """Scores every (permutation, term) group of a batch
+
+        Returns (alphas, betas, xs) over nPermutations*len(ontology.terms)
+        groups, group p*len(ontology.terms) + k being term k of permutation
+        p. Groups without rows get alpha = beta = 0, hence a NaN p-value.
+        """
+        nTerms = len(self.ontology.terms)
+        nGroups = nPermutations*nTerms
+        pairPerms, pairDarts, pairRegDoms, pairPositions = [], [], [], []
+        dartBase = 0
+        for chrCode, chrPositions in positions:
+            n = chrPositions.shape[1]
+            queryIdx, regDomIdx = self.regDoms.overlapping(chrCode,\
+                    chrPositions.ravel())
+            pairPerms.append(queryIdx // n)
+            # darts of a permutation are numbered across its chromosomes
+            pairDarts.append((queryIdx // n)*self.nDarts + dartBase +\
+                    queryIdx % n)
+            pairRegDoms.append(regDomIdx)
+            pairPositions.append(chrPositions.ravel()[queryIdx])
+            dartBase += n
+        pairPerms, pairDarts, pairRegDoms, pairPositions = [np.concatenate(v)\
+                if v else np.zeros(0, dtype=np.int64) for v in\
+                (pairPerms, pairDarts, pairRegDoms, pairPositions)]
+        pairWeights = self.wgtRegDom.getDartTSSPairWgts(pairPositions,\
+                self.regDoms.TSSPositions[pairRegDoms])
+
+        # coverage of each group: union of the regdoms of the genes hit
+        hit = np.zeros((nPermutations, self.nGenes), dtype=bool)
+        hit[pairPerms, self.regDomGenes[pairRegDoms]] = True
+        intervalPerms, intervals = np.nonzero(\
+                hit[:, self.regDomGenes[self.ontology.intervalRegDoms]])
+        coverage = unionLengths(\
+                intervalPerms*nTerms + self.ontology.intervalTerms[intervals],\
+                self.regDoms.chrCodes[self.ontology.intervalRegDoms[intervals]],\
+                self.ontology.intervalStarts[intervals],\
+                self.ontology.intervalEnds[intervals], nGroups)
+        xs = coverage/float(self.ontology.genomeSize)
+
+        # one row per (pair, term of the pair's gene)
+        rowPairs, rowTerms = self.ontology.expandTerms(pairRegDoms)
+        rowGroups = pairPerms[rowPairs]*nTerms + rowTerms
+        rowWeights = pairWeights[rowPairs]
+
+        alphas = np.bincount(rowGroups, rowWeights, minlength=nGroups)
+        rowCounts = np.bincount(rowGroups, minlength=nGroups)
+        if self.whichBeta == 1:
+            betas = rowCounts - alphas
+        elif self.whichBeta == 2:
+            maxWeights = np.zeros(nGroups)
+            np.maximum.at(maxWeights, rowGroups, rowWeights)
+            betas = rowCounts*maxWeights - alphas
+        elif self.whichBeta == 4:
+            keys, inverse = np.unique(rowGroups*(nPermutations*self.nDarts) +\
+                    pairDarts[rowPairs], return_inverse=True)
+            keyWeights = np.bincount(inverse.ravel(), rowWeights)
+            keyGroups = keys // (nPermutations*self.nDarts)
+            maxWeights = np.zeros(nGroups)
+            np.maximum.at(maxWeights, keyGroups, keyWeights)
+            betas = np.bincount(keyGroups, minlength=nGroups)*maxWeights -\
+                    alphas
+        else:
+            # a dart's heaviest weight on any term is its heaviest pair
+            dartMaxWeights = np.zeros(nPermutations*self.nDarts)
+            np.maximum.at(dartMaxWeights, pairDarts, pairWeights)
+            betas = np.bincount(rowGroups,\
+                    dartMaxWeights[pairDarts[rowPairs]], minlength=nGroups) -\
+                    alphas
+        return alphas, betas, xs
+
+    def exceedances(self, rng, nPermutations):
+        """Returns how often each term scores at least as well in
+        nPermutations random dart sets as in the observed one."""
+        alphas, betas, xs = self._score(self.randomDarts(rng, nPermutations),\
+                nPermutations)
+        logPvals = logBetaCDF(xs, alphas, betas).reshape(nPermutations, -1)
+        return (logPvals <= self.observed.logPvals).sum(axis=0)
+
+class EmpiricalScores:
+    """Analytic and permutation p-values of every term
+
+    Attributes
+    ----------
+    termIDs : array of str
+    logPvals : array of float
+               natural log of the analytic Beta p-value
+    exceedances : array of int
+                  number of permutations scoring the term at least as well
+    nPermutations : int
+    empiricalPvals : array of float
+                     (exceedances + 1)/(nPermutations + 1)
+    """
+
+    def __init__(self, termIDs, logPvals, exceedances, nPermutations):
+        self.termIDs = termIDs
+        self.logPvals = logPvals
+        self.exceedances = exceedances
+        self.nPermutations = nPermutations
+        self.empiricalPvals = (exceedances + 1.0)/(nPermutations + 1.0)
+
+    def __len__(self):
+        return len(self.termIDs)
+
+    def __repr__(self):
+        return 'EmpiricalScores(<%d terms, %d permutations>)' %\
+                (len(self), self.nPermutations)
+
+    def lines(self):
+        """Yields termID, Beta p-value and empirical p-value lines, ranked
+        by Beta p-value."""
+        order = np.argsort(self.logPvals, kind='mergesort')
+        for k in order[~np.isnan(self.logPvals[order])].tolist():
+            yield "\t".join([self.termIDs[k], formatLogP(self.logPvals[k]),\
+                    str(self.empiricalPvals[k])]) + "\n"
+
+_nullState = {}
+
+def _initNullWorker(null, seed):
+    _nullState.update(null=null, seed=seed)
+
+def _runNullBatch(batch):
+    batchIndex, nPermutations = batch
+    # one stream per batch, whichever worker runs it
+    rng = np.random.default_rng(np.random.SeedSequence(_nullState['seed'],\
+            spawn_key=(batchIndex,)))
+    return _nullState['null'].exceedances(rng, nPermutations)
+
+def permutationNull(lociFn, ontoToGeneFn, dartFn, cutOff, mean, sd,\
+        whichBeta, nPermutations=1000, antigapFn=None, genomeSize=None,\
+        batchSize=50, processes=None, seed=0, assembly=None):
+    """Computes empirical p-values of every term of a dart set
+
+    Permutations are split into batches of batchSize, which bounds the
+    memory of a worker, and the batches are run by a pool of processes.
+    Batch i always draws from the i-th stream spawned from seed, so the
+    result depends on seed and batchSize but not on the number of
+    processes.
+
+    Parameters
+    ----------
+    lociFn, ontoToGeneFn, dartFn, cutOff, mean, sd, genomeSize, assembly :
+            as for run
+    whichBeta : int
+                1, 2, 4 or 5
+    nPermutations : int
+                    number of random dart sets (default = 1000)
+    antigapFn : str
+                random darts are drawn from these regions, which also bound
+                the coverage as in run (default = None, whole chromosomes)
+    batchSize : int
+                permutations scored at once by a worker (default = 50)
+    processes : int
+                number of worker processes; 1 runs in this process
+                (default = None, one per CPU)
+    seed : int
+           (default = 0)
+
+    Returns
+    -------
+    EmpiricalScores over the terms hit by the observed darts
+    """
+    regDoms = RegDomIndex.fromLoci(lociFn, cutOff, assembly)
+    ontology = OntologyIndex(regDoms, ontoToGeneFn, antigapFn, genomeSize)
+    background = None
+    if antigapFn is not None:
+        background = GenomeIntervals.fromFile(antigapFn, regDoms.assembly)
+    null = PermutationNull(regDoms, ontology,\
+            DartSet.fromFile(dartFn, regDoms.assembly),\
+            WeightedRegDom(cutOff, mean, sd), whichBeta, background)
+
+    batches = [(i, min(batchSize, nPermutations - lo)) for i, lo in\
+            enumerate(range(0, nPermutations, batchSize))]
+    if processes == 1:
+        _initNullWorker(null, seed)
+        results = [_runNullBatch(batch) for batch in batches]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, _initNullWorker, (null, seed))
+        try:
+            results = pool.imap_unordered(_runNullBatch, batches)
+            results = list(results)
+        finally:
+            pool.close()
+            pool.join()
+    exceedances = np.sum(results, axis=0) if results else\
+            np.zeros(len(ontology.terms), dtype=np.int64)
+
+    observed = null.observed
+    scored = np.flatnonzero(~np.isnan(observed.logPvals))
+    return EmpiricalScores(observed.termIDs[scored],\
+            observed.logPvals[scored], exceedances[scored], nPermutations)
+
+def sweepMain(argv):
+    """Command line of the sweep subcommand"""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog sweep [options] <lociFn> <ontoToGeneFn> \
+<dartFn> <outFn>",
+                          description=("Scores a dart set for every "
+                                       "combination of the given parameters "
+                                       "and writes one table of all of them."))
+    parser.add_option("--cutoffs", dest="cutOffs", default="1000000",
+                      help="comma separated regdom cutoffs (default: %default)")
+    parser.add_option("--means", dest="means", default="0",
+                      help="comma separated kernel means (default: %default)")
+    parser.add_option("--sds", dest="sds", default="333333",
+                      help="comma separated kernel sds (default: %default)")
+    parser.add_option("--betas", dest="whichBetas", default="5",
+                      help="comma separated Beta variants (default: %default)")
+    parser.add_option("--best", dest="nBest", type="int", default=None,
+                      help="only write the best terms of each grid point")
+    parser.add_option("--assembly", dest="assembly", default=None,
+                      help="assembly name (hg18, hg19, hg38, mm10) or "
+                           "chrom.sizes file (default: hg18)")
+    (options, args) = parser.parse_args(argv)
+    if (len(args) != 4):
+        parser.print_usage()
+        sys.exit(1)
+
+    result = sweep(args[0], args[1], args[2],\
+            [int(v) for v in options.cutOffs.split(',')],\
+            [float(v) for v in options.means.split(',')],\
+            [float(v) for v in options.sds.split(',')],\
+            [int(v) for v in options.whichBetas.split(',')],\
+            assembly=options.assembly)
+    with open(args[3], 'w') as outFile:
+        outFile.writelines(result.lines(options.nBest))
+
+def permuteMain(argv):
+    """Command line of the permute subcommand"""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog permute [options] <lociFn> \
+<ontoToGeneFn> <dartFn> <outFn> <cutOff> <mean> <sd> <which beta>",
+                          description=("Writes the Beta and empirical "
+                                       "p-value of every term, the latter "
+                                       "from random dart sets keeping the "
+                                       "darts per chromosome."))
+    parser.add_option("-n", "--permutations", dest="nPermutations",
+                      type="int", default=1000,
+                      help="number of random dart sets (default: %default)")
+    parser.add_option("-b", "--batch-size", dest="batchSize", type="int",
+                      default=50,
+                      help="permutations scored at once by a worker, which "
+                           "bounds its memory (default: %default)")
+    parser.add_option("-p", "--processes", dest="processes", type="int",
+                      default=None,
+                      help="number of worker processes (default: one per CPU)")
+    parser.add_option("--seed", dest="seed", type="int", default=0,
+                      help="random seed (default: %default)")
+    parser.add_option("--antigap", dest="antigapFn", default=None,
+                      help="BED file of the regions random darts are drawn "
+                           "from (default: whole chromosomes)")
+    parser.add_option("--assembly", dest="assembly", default=None,
+                      help="assembly name (hg18, hg19, hg38, mm10) or "
+                           "chrom.sizes file (default: hg18)")
+    (options, args) = parser.parse_args(argv)
+    if (len(args) != 8):
+        parser.print_usage()
+        sys.exit(1)
+
+    scores = permutationNull(args[0], args[1], args[2], int(args[4]),\
+            float(args[5]), float(args[6]), int(args[7]),\
+            nPermutations=options.nPermutations, antigapFn=options.antigapFn,\
+            batchSize=options.batchSize, processes=options.processes,\
+            seed=options.seed, assembly=options.assembly)
+    with open(args[3], 'w') as outFile:
+        outFile.writelines(scores.lines())
+
+def regDomsMain(argv):
+    """Command line of the regdoms subcommand, a drop-in replacement for
+    c/createRegulatoryDomains"""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog regdoms [options] <TSS.in> \
+<chrom.sizes> <oneClosest|twoClosest|basalPlusExtension> <regDoms.out>",
+                          description=("Creates regulatory domains for a set "
+                                       "of genes based on the genomic "
+                                       "location of the TSS and the "
+                                       "association rule used."))
+    parser.add_option("--maxExtension", dest="maxExtension", type="int",
+                      default=1000000,
+                      help="distance to extend a gene's regulatory region "
+                           "from the TSS in absence of any other nearby "
+                           "genes (default: %default)")
+    parser.add_option("--basalUpstream", dest="basalUpstream", type="int",
+                      default=None,
+                      help="basal regulatory region extension upstream "
+                           "(strand-dependent!) of TSS (default: 5000)")
+    parser.add_option("--basalDownstream", dest="basalDownstream", type="int",
+                      default=None,
+                      help="basal regulatory region extension downstream "
+                           "(strand-dependent!) of TSS (default: 1000)")
+    (options, args) = parser.parse_args(argv)
+    if (len(args) != 4):
+        parser.print_usage()
+        sys.exit(1)
+    if args[2] != 'basalPlusExtension' and (options.basalUpstream is not\
+            None or options.basalDownstream is not None):
+        parser.error("Basal up/downstream options only relevant to "
+                     "basalPlusExtension association rule")
+
+    chrNames, TSSPositions, strands, names = readTSSFile(args[0])
+    order, starts, ends = createRegulatoryDomains(chrNames, TSSPositions,\
+            strands, names, readChromSizes(args[1]), args[2],\
+            options.maxExtension,\
+            5000 if options.basalUpstream is None else options.basalUpstream,\
+            1000 if options.basalDownstream is None else\
+            options.basalDownstream)
+    # BED6 with the TSS in the score field, as the C tool writes it
+    with open(args[3], 'w') as outFile:
+        for fields in zip(chrNames[order].tolist(), starts.tolist(),\
+                ends.tolist(), names[order].tolist(),\
+                TSSPositions[order].tolist(), strands[order].tolist()):
+            outFile.write("%s\t%d\t%d\t%s\t%d\t%s\n" % fields)
+
+def binomialMain(argv):
+    """Command line of the binomial subcommand"""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog binomial [options] <lociFn> \
+<ontoToGeneFn> <ontoTermsFn> <antigapFn> <dartFn> <outFn>",
+                          description=("Writes the region-based binomial "
+                                       "p-values of every term, as "
+                                       "calculateBinomialP computes them one "
+                                       "term at a time."))
+    parser.add_option("--cutoff", dest="cutOff", type="int", default=1000000,
+                      help="regdom cutoff around each TSS (default: %default)")
+    parser.add_option("--rule", dest="association", default=None,
+                      help="build the regdoms with this association rule "
+                           "instead of the cutoff (needs --chrom-sizes or "
+                           "--assembly)")
+    parser.add_option("--chrom-sizes", dest="chromSizesFn", default=None,
+                      help="chrom.sizes file used by --rule")
+    parser.add_option("--assembly", dest="assembly", default=None,
+                      help="assembly name (hg18, hg19, hg38, mm10) or "
+                           "chrom.sizes file (default: hg18)")
+    parser.add_option("--best", dest="nBest", type="int", default=30,
+                      help="number of terms written (default: %default)")
+    (options, args) = parser.parse_args(argv)
+    if (len(args) != 6):
+        parser.print_usage()
+        sys.exit(1)
+
+    if options.association is None:
+        regDoms = RegDomIndex.fromLoci(args[0], options.cutOff,\
+                options.assembly)
+    elif options.chromSizesFn is None and options.assembly is None:
+        parser.error("--rule needs --chrom-sizes or --assembly")
+    else:
+        regDoms = RegDomIndex.fromAssociationRule(args[0],\
+                options.chromSizesFn or options.assembly, options.association,\
+                maxExtension=options.cutOff)
+    binomial = BinomialEnrichment(OntologyIndex(regDoms, args[1], args[3]))
+    writeRankedTerms(binomial.score(DartSet.fromFile(args[4],\
+            regDoms.assembly)),\
+            buildOntoTermsDict(args[2]), args[5], len(binomial.termIDs),\
+            nBest=options.nBest)
+
+def convertMain(argv):
+    """Command line of the convert subcommand"""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog convert [options] <SRFtoTermsFn> \
+<binaryFn>",
+                          description=("Converts an AssociationMaker text "
+                                       "file to the binary columnar format, "
+                                       "which the scoring stage and "
+                                       "calculateGi.py memory-map."))
+    parser.add_option("--assembly", dest="assembly", default=None,
+                      help="assembly name (hg18, hg19, hg38, mm10) or "
+                           "chrom.sizes file (default: hg18)")
+    (options, args) = parser.parse_args(argv)
+    if (len(args) != 2):
+        parser.print_usage()
+        sys.exit(1)
+
+    convertAssociations(args[0], args[1], options.assembly)
+
+def batchMain(argv):
+    """Command line of the batch subcommand"""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog batch [options] <lociFn> <ontoToGeneFn> \
+<ontoTermsFn> <outDir> <cutOff> <mean> <sd> <which beta> \
+<dartFn|dartDir|manifest> [...]",
+                          description=("Scores every dart set against one "
+                                       "preloaded ontology, writing "
+                                       "<outDir>/<dart set>.out for each."))
+    parser.add_option("-p", "--processes", dest="processes", type="int",
+                      default=None,
+                      help="number of worker processes (default: one per CPU)")
+    parser.add_option("--assembly", dest="assembly", default=None,
+                      help="assembly name (hg18, hg19, hg38, mm10) or "
+                           "chrom.sizes file (default: hg18)")
+    (options, args) = parser.parse_args(argv)
+    if (len(args) < 9):
+        parser.print_usage()
+        sys.exit(1)
+
+    runBatch(args[0], args[1], args[2], listDartFiles(args[8:]), args[3],\
+            int(args[4]), float(args[5]), float(args[6]), int(args[7]),\
+            processes=options.processes, assembly=options.assembly)
+
+def ontologiesMain(argv):
+    """Command line of the ontologies subcommand"""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog ontologies [options] <lociFn> <dartFn> \
+<outDir> <cutOff> <mean> <sd> <which beta> NAME=ONTOTOGENE,ONTOTERMS [...]",
+                          description=("Scores one dart set against several "
+                                       "ontologies, sharing the dart-TSS "
+                                       "weights, and writes "
+                                       "<outDir>/<NAME>.out for each."))
+    parser.add_option("-p", "--processes", dest="processes", type="int",
+                      default=None,
+                      help="number of worker processes (default: one per "
+                           "CPU, at most one per ontology)")
+    parser.add_option("--antigap", dest="antigapFn", default=None,
+                      help="BED file of the non-gap regions of the genome")
+    parser.add_option("--assembly", dest="assembly", default=None,
+                      help="assembly name (hg18, hg19, hg38, mm10) or "
+                           "chrom.sizes file (default: hg18)")
+    (options, args) = parser.parse_args(argv)
+    if (len(args) < 8):
+        parser.print_usage()
+        sys.exit(1)
+    try:
+        ontologies = [parseOntology(spec) for spec in args[7:]]
+    except ValueError as e:
+        parser.error(str(e))
+
+    runOntologies(args[0], ontologies, args[1], args[2], int(args[3]),\
+            float(args[4]), float(args[5]), int(args[6]),\
+            antigapFn=options.antigapFn, processes=options.processes,\
+            assembly=options.assembly)
 
 if __name__ == '__main__':
+    subcommands = {'batch': batchMain, 'sweep': sweepMain,\
+            'permute': permuteMain, 'regdoms': regDomsMain,\
+            'binomial': binomialMain, 'convert': convertMain,\
+            'ontologies': ontologiesMain}
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+        subcommands[sys.argv[1]](sys.argv[2:])
+        sys.exit(0)
+
     from optparse import OptionParser
+    import shutil
+    import pipelineCache
     parser = OptionParser(usage="%prog <lociFn> <ontoToGeneFn> <dartFn> <SRFtoTermsFn> <outFn> \
             <cutOff> <mean> <sd> <which beta> <ontoTermFn>",
                           description=(""))
@@ -817,6 +3755,27 @@ if __name__ == '__main__':
     #parser.add_option("-q", "--quiet",
     #                  action="store_false", dest="verbose", default=True,
     #                  help="don't print status messages to stdout")
+    parser.add_option("--cache-dir", dest="cacheDir",
+                      default=pipelineCache.DEFAULT_CACHE_DIR,
+                      help="directory caching regdom, weight and term files "
+                           "between runs (default: %default)")
+    parser.add_option("--in-memory", dest="inMemory", action="store_true",
+                      default=False,
+                      help="skip the cache and pass intermediates between "
+                           "stages in memory; only SRFtoTermsFn is written")
+    parser.add_option("--cache-size", dest="cacheSize", type="int",
+                      default=pipelineCache.DEFAULT_CACHE_SIZE,
+                      help="bytes kept in the cache before the least "
+                           "recently used files are evicted (default: %default)")
+    parser.add_option("--assembly", dest="assembly", default=None,
+                      help="assembly name (hg18, hg19, hg38, mm10) or "
+                           "chrom.sizes file (default: hg18)")
+    parser.add_option("--report", dest="reportFn", default=None,
+                      help="write the time, record counts and peak memory "
+                           "of every stage to this JSON file")
+    parser.add_option("--profile", dest="profileFn", default=None,
+                      help="run under cProfile and dump its stats to this "
+                           "file")
 
     """
     Example Command:
@@ -838,102 +3797,54 @@ if __name__ == '__main__':
     sd = float(args[7])
     whichBeta = int(args[8])
     ontoTermsFn = args[9]
-
-    timestamp = str(datetime.now())[-5:]
-    # get data/SRFtoTerms.data
-    createRegDomsFileFromTSSs(lociFn, "/tmp/hg18.regDom."+timestamp+".bed", cutOff)
-    overlapSelect("/tmp/hg18.regDom."+timestamp+".bed", dartFn, "/tmp/regDom.SRF."+timestamp+".merge", options="-mergeOutput")
-    assignWeights(cutOff, mean, sd, "/tmp/regDom.SRF."+timestamp+".merge", "/tmp/SRF."+timestamp+".wgt")
-    maker = AssociationMaker("/tmp/SRF."+timestamp+".wgt", ontoToGeneFn, "/tmp/hg18.regDom."+timestamp+".bed")
-    maker.writeOutput(SRFtoTermsFn)
-
-    # # remove /tmp files
-    # os.system("rm /tmp/hg18.regDom.bed /tmp/regDom.SRF.merge /tmp/SRF.wgt")
-
-    inFile = open(SRFtoTermsFn)
-    outFile = open(outFn, 'w')
-
-    weightSum = 0 #Will store our alpha
-    X = 0 #Will store our input probability
-
-    lineObjects = []
-    for line in inFile:
-        lineObjects.append(TermDartTSSTriple(line))
-
-    termIDs = list(set([lineObject.termID for lineObject in lineObjects]))
-    dartNames = list(set([lineObject.dartName for lineObject in lineObjects]))
-
-    termPValues = {}
-
-    #Calculate the best score each dart achieved on the set, for use with beta 5
-    dartMaxWeights = {}
-    if whichBeta == 5:
-        dartMaxWeights = buildMaxDartWeights(dartNames, lineObjects)
+    assembly = getAssembly(options.assembly)
+    if options.reportFn is not None or options.profileFn is not None:
+        instrument.start(options.profileFn)
 
     #Load an ontoTerms dict for outputting term descriptions
     ontoTerms = buildOntoTermsDict(ontoTermsFn)
 
-    count = 0
-    results = []
-    correction = len(termIDs)
-    print("Calculating "+str(len(termIDs))+" term p-values\n")
-    for termID in termIDs:
-        if termID != 'UNKNOWN':
-
-            count+=1
-            if(count % 50 == 0):
-                print(str(count))
-                results = sorted(results, key=lambda x: x[0])[0:30]
-                outFile = open(outFn, 'w')
-                for r in results:
-                    outFile.write(str(r[0]) + "\t" + r[1] + "\t" + r[2] + "\n")
-
-            termIDObjects = filter(lambda x: x.termID == termID, lineObjects)
-            weights = [termIDObject.weight for termIDObject in termIDObjects]
-            genes = list(set([termIDObject.geneName for termIDObject in termIDObjects]))
-
-
-            alpha = sum(weights)
-            x = termIDObjects[0].percentCoverage
-
-            ## new possibility for x?
-            #wgtDist = norm(self.mean, self.sd)
-            #x = len(genes)*len(wgtDist.cdf(cutOff) - wgtDist.cdf(-cutOff))\
-            #        /sum(HUMAN_CHROMOSOME_SIZES)
-
-            #Basic beta, assumes max score is 1 for all darts
-            if whichBeta == 1:
-                beta = len(termIDObjects) - alpha
-            #Assumes max score is the max of all darts hitting this term
-            elif whichBeta == 2:
-                beta = len(termIDObjects) * max(weights) - alpha
-            elif whichBeta == 3:
-                wgtRegDom = WeightedRegDom(cutOff=1000000, mean=0, sd=333333)
-                termTSSs = [TSS(position=termIDObject.TSSPosition,\
-                                       geneName=termIDObject.geneName,\
-                                       geneID=termIDObject.geneID,\
-                                       chrName=termIDObject.chrName)\
-                            for termIDObject in termIDObjects]
-                beta = len(termIDObjects) * (wgtRegDom.bestWeightedDart(termTSSs, chromosomes=HUMAN_CHROMOSOMES)).weight
-            #Assumes max score is the number of darts times the weight of the heaviest dart
-            elif whichBeta == 4:
-                for dartName in dartNames:
-                    dartNameObjects = filter(lambda x: x.dartName == dartName, termIDObjets)
-                    weight = sum([dartNameObject.weight for dartNameObject in dartNameObjects])
-                    weightedDart = GREATx.WeightedDart(chrName=dartNameObjects[0].chrName,\
-                                                       name=dartName,
-                                                       position=dartNameObjects[0].dartPosition,
-                                                       weight=weight)
-                    weightedDarts += weightedDart
-                beta = len(weightedDarts) * max([weightedDart.weight for weightedDart in weightedDarts]) - alpha
-            #Assumes max score for a given dart is the highest score achieved by
-            # that dart on any term
-            elif whichBeta == 5:
-                totalSuccess = map(lambda x: dartMaxWeights[x.dartName], termIDObjects)
-                beta = sum(totalSuccess) - alpha
-
-            if(int(termID) in ontoTerms): desc = ontoTerms[int(termID)]
-            else: desc = "No description available"
-            pval = scipy.stats.beta.cdf(x, alpha, beta)
-            if(pval > 0): results.append((pval * correction, termID, desc))
-    outFile.write("\n\n~~~~~~~~~~~~~~~FINISHED~~~~~~~~~~~~~~~")
+    if options.inMemory:
+        scores, table = run(lociFn, ontoToGeneFn, dartFn, cutOff, mean, sd,\
+                whichBeta, SRFtoTermsFn=SRFtoTermsFn, assembly=assembly)
+    else:
+        # each stage is skipped when its inputs and parameters are unchanged
+        cache = pipelineCache.PipelineCache(options.cacheDir, options.cacheSize)
+        regDomKey = cache.key('regDom', [pipelineCache.fileDigest(lociFn)],\
+                cutOff=cutOff, rule='cutOff')
+        regDomFn = cache.fetch(regDomKey,\
+                lambda fn: createRegDomsFileFromTSSs(lociFn, fn, cutOff))
+        wgtKey = cache.key('wgt', [regDomKey, pipelineCache.fileDigest(dartFn)],\
+                cutOff=cutOff, mean=mean, sd=sd)
+        wgtFn = cache.fetch(wgtKey, lambda fn: assignWeights(cutOff, mean, sd,\
+                overlapSelect(regDomFn, dartFn, assembly=assembly), fn))
+        termsKey = cache.key('terms', [wgtKey, regDomKey,\
+                pipelineCache.fileDigest(ontoToGeneFn)],\
+                genomeSize=assembly.totalLength())
+        termsFn = cache.fetch(termsKey, lambda fn: AssociationMaker(wgtFn,\
+                ontoToGeneFn, regDomFn, assembly=assembly).writeOutput(fn))
+        # get data/SRFtoTerms.data
+        shutil.copyfile(termsFn, SRFtoTermsFn)
+
+        # the scoring stage memory-maps a binary copy instead of parsing text
+        tableKey = cache.key('termsBinary', [termsKey], assembly=assembly.name)
+        tableFn = cache.fetch(tableKey,\
+                lambda fn: convertAssociations(termsFn, fn, assembly))
+        table = TermDartTSSTable.fromBinary(tableFn)
+        print("Calculating "+str(len(table.termIDs))+" term p-values\n")
+        # beta 3 weighs the best dart with the kernel of the weights, as
+        # run does, rather than the fixed 1e6/0/333333 one of the original
+        scores = scoreTerms(table, whichBeta,\
+                wgtRegDom=WeightedRegDom(cutOff, mean, sd))
+
+    ## new possibility for x?
+    #wgtDist = norm(self.mean, self.sd)
+    #x = len(genes)*len(wgtDist.cdf(cutOff) - wgtDist.cdf(-cutOff))\
+    #        /sum(HUMAN_CHROMOSOME_SIZES)
+
+    # Bonferroni correction over every term
+    writeRankedTerms(scores, ontoTerms, outFn, scores.nTerms)
+
+    recorder = instrument.stop()
+    if recorder is not None and options.reportFn is not None:
+        recorder.write(options.reportFn)
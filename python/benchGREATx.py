@@ -0,0 +1,502 @@
+"""Benchmark of every stage of GREATx.py and calculateGi.py
+
+The stages run on a synthetic dataset (see syntheticData.py) of a chosen
+scale. The inputs of a case (regulatory domains, dart-regdom pairs, term
+associations, ...) are built beforehand and only the stage itself is
+timed. Where fork is available each case runs in a child process, so its
+peak memory is its own: the growth of the child's peak RSS over its RSS
+at the start of the case.
+
+For every case the report gives the records it handled (in the case's
+own unit: genes, darts, pairs, associations, terms, ...), wall and CPU
+seconds, records per second, peak memory and the wall time of the
+instrumented stages it went through. Reports are JSON documents that name
+the commit they were made at; --compare prints the ratios of a new run to
+an earlier report, case by case.
+
+Example
+--------
+$ python benchGREATx.py --scale medium -o before.json /tmp/synthetic
+$ git checkout newVersion
+$ python benchGREATx.py --scale medium --compare before.json /tmp/synthetic
+"""
+import collections
+import fnmatch
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import instrument
+import syntheticData
+import GREATx
+import calculateGi
+
+CASES = collections.OrderedDict()
+
+def case(name, unit, *needs):
+    """Registers a benchmark case
+
+    The decorated function takes the Fixtures and returns the number of
+    records, in unit, that it handled. The fixtures named in needs are
+    built before the case is timed.
+    """
+    def register(f):
+        CASES[name] = (unit, needs, f)
+        return f
+    return register
+
+class Fixtures:
+    """Inputs of the benchmark cases, built on first use and kept
+
+    Parameters
+    ----------
+    manifest : dict
+               returned by syntheticData.generate
+    workDir : str
+              directory for the files the cases write
+    cutOff, mean, sd : int, float, float
+                       WeightedRegDom parameters
+    band : int
+           Gi* distance band
+    """
+
+    def __init__(self, manifest, workDir, cutOff=1000000, mean=0.0,\
+            sd=333333, band=1000000):
+        self.manifest = manifest
+        self.workDir = workDir
+        self.cutOff, self.mean, self.sd, self.band = cutOff, mean, sd, band
+        self.assembly = GREATx.getAssembly(manifest['assembly'])
+        self._built = {}
+        if not os.path.isdir(workDir):
+            os.makedirs(workDir)
+
+    def __repr__(self):
+        return 'Fixtures(<%d built>)' % len(self._built)
+
+    def __getattr__(self, name):
+        if name in self.manifest:
+            return self.manifest[name]
+        if name.startswith('_') or not hasattr(self, '_build_' + name):
+            raise AttributeError(name)
+        if name not in self._built:
+            self._built[name] = getattr(self, '_build_' + name)()
+        return self._built[name]
+
+    def scratch(self, fn):
+        """Returns the name of a file in the work directory."""
+        return os.path.join(self.workDir, fn)
+
+    def _build_regDoms(self):
+        return GREATx.RegDomIndex.fromLoci(self.lociFn, self.cutOff,\
+                self.assembly)
+
+    def _build_regDomFn(self):
+        fn = self.scratch('regDom.bed')
+        self.regDoms.write(fn)
+        return fn
+
+    def _build_dartSet(self):
+        return GREATx.DartSet.fromFile(self.dartFn, self.assembly)
+
+    def _build_pairs(self):
+        return self.regDoms.join(self.dartSet)
+
+    def _build_weights(self):
+        pairs = self.pairs
+        return self.wgtRegDom.getDartTSSPairWgts(\
+                pairs.darts.positions[pairs.dartIdx],\
+                pairs.regDoms.TSSPositions[pairs.regDomIdx]).tolist()
+
+    def _build_wgtRegDom(self):
+        return GREATx.WeightedRegDom(self.cutOff, self.mean, self.sd)
+
+    def _build_wgtFn(self):
+        fn = self.scratch('darts.wgt')
+        GREATx.assignWeights(self.cutOff, self.mean, self.sd, self.pairs, fn)
+        return fn
+
+    def _build_geneTermMatrix(self):
+        # writes the binary cache next to the .canon file
+        return GREATx.GeneTermMatrix.load(self.ontoToGeneFn)
+
+    def _build_ontology(self):
+        return GREATx.OntologyIndex(self.regDoms, self.ontoToGeneFn)
+
+    def _build_antigapOntology(self):
+        return GREATx.OntologyIndex(self.regDoms, self.ontoToGeneFn,\
+                self.antigapFn)
+
+    def _build_pairGenes(self):
+        return set(self.regDoms.geneIDs[self.pairs.regDomIdx].tolist())
+
+    def _build_table(self):
+        return GREATx.AssociationMaker(self.pairs.dartTSSPairs(self.weights),\
+                self.ontology, genes=self.pairGenes).buildTable()
+
+    def _build_termsFn(self):
+        fn = self.scratch('terms.data')
+        GREATx.AssociationMaker(self.pairs.dartTSSPairs(self.weights),\
+                self.ontology, genes=self.pairGenes).writeOutput(fn)
+        return fn
+
+    def _build_binaryFn(self):
+        fn = self.scratch('terms.bin')
+        self.table.writeBinary(fn)
+        return fn
+
+    def _build_aggregates(self):
+        return GREATx.DartAggregateIndex(self.table)
+
+    def _build_binomial(self):
+        return GREATx.BinomialEnrichment(self.antigapOntology)
+
+@case('regdoms.fromLoci', 'genes')
+def _fromLoci(fx):
+    return len(GREATx.RegDomIndex.fromLoci(fx.lociFn, fx.cutOff, fx.assembly))
+
+@case('regdoms.createFile', 'genes')
+def _createRegDomsFile(fx):
+    GREATx.createRegDomsFileFromTSSs(fx.lociFn, fx.scratch('created.bed'),\
+            fx.cutOff)
+    return fx.manifest['genes']
+
+@case('regdoms.fromFile', 'regdoms', 'regDomFn')
+def _regDomsFromFile(fx):
+    return len(GREATx.RegDomIndex.fromFile(fx.regDomFn, fx.assembly))
+
+@case('regdoms.basalPlusExtension', 'genes')
+def _associationRule(fx):
+    GREATx.RegDomIndex.fromAssociationRule(fx.lociFn, fx.assembly,\
+            'basalPlusExtension', maxExtension=fx.cutOff)
+    return fx.manifest['genes']
+
+@case('darts.fromFile', 'darts')
+def _dartsFromFile(fx):
+    return len(GREATx.DartSet.fromFile(fx.dartFn, fx.assembly))
+
+@case('overlap.join', 'darts', 'regDoms', 'dartSet')
+def _join(fx):
+    fx.regDoms.join(fx.dartSet)
+    return len(fx.dartSet)
+
+@case('overlap.overlapSelect', 'darts', 'regDomFn')
+def _overlapSelect(fx):
+    GREATx.overlapSelect(fx.regDomFn, fx.dartFn, assembly=fx.assembly)
+    return fx.manifest['darts']
+
+@case('weights.pairWeights', 'pairs', 'pairs', 'wgtRegDom')
+def _pairWeights(fx):
+    pairs = fx.pairs
+    fx.wgtRegDom.getDartTSSPairWgts(pairs.darts.positions[pairs.dartIdx],\
+            pairs.regDoms.TSSPositions[pairs.regDomIdx])
+    return len(pairs)
+
+@case('weights.assignWeights', 'pairs', 'pairs')
+def _assignWeights(fx):
+    GREATx.assignWeights(fx.cutOff, fx.mean, fx.sd, fx.pairs,\
+            fx.scratch('assigned.wgt'))
+    return len(fx.pairs)
+
+@case('ontology.geneTermMatrix', 'annotations')
+def _geneTermMatrix(fx):
+    return len(GREATx.GeneTermMatrix.fromCanon(fx.ontoToGeneFn).indices)
+
+@case('ontology.geneTermMatrixCached', 'annotations', 'geneTermMatrix')
+def _geneTermMatrixCached(fx):
+    geneTerms = GREATx.GeneTermMatrix.load(fx.ontoToGeneFn)
+    # the arrays are mapped; touch them as OntologyIndex would
+    return int(geneTerms.indices.sum() >= 0)*len(geneTerms.indices)
+
+@case('ontology.OntologyIndex', 'intervals', 'regDoms')
+def _ontologyIndex(fx):
+    return len(GREATx.OntologyIndex(fx.regDoms,\
+            fx.ontoToGeneFn).intervalTerms)
+
+@case('ontology.antigap', 'intervals', 'regDoms')
+def _antigapOntologyIndex(fx):
+    return len(GREATx.OntologyIndex(fx.regDoms, fx.ontoToGeneFn,\
+            fx.antigapFn).intervalTerms)
+
+@case('associations.buildTable', 'associations', 'pairs', 'weights',\
+        'ontology', 'pairGenes')
+def _buildTable(fx):
+    return len(GREATx.AssociationMaker(fx.pairs.dartTSSPairs(fx.weights),\
+            fx.ontology, genes=fx.pairGenes).buildTable())
+
+@case('associations.fromWgtFile', 'associations', 'wgtFn', 'ontology',\
+        'table')
+def _associationsFromWgt(fx):
+    GREATx.AssociationMaker(fx.wgtFn, fx.ontology).writeOutput(\
+            fx.scratch('written.data'))
+    return len(fx.table)
+
+@case('table.fromFile', 'associations', 'termsFn')
+def _tableFromFile(fx):
+    return len(GREATx.TermDartTSSTable.fromFile(fx.termsFn, fx.assembly))
+
+@case('table.writeBinary', 'associations', 'table')
+def _writeBinary(fx):
+    fx.table.writeBinary(fx.scratch('written.bin'))
+    return len(fx.table)
+
+@case('table.fromBinary', 'associations', 'binaryFn')
+def _tableFromBinary(fx):
+    table = GREATx.TermDartTSSTable.fromBinary(fx.binaryFn)
+    # the columns are mapped; touch them as scoring would
+    return int(table.weights.sum() >= 0)*len(table)
+
+@case('scoring.DartAggregateIndex', 'associations', 'table')
+def _aggregates(fx):
+    GREATx.DartAggregateIndex(fx.table)
+    return len(fx.table)
+
+def _scoringCase(whichBeta):
+    @case('scoring.beta%d' % whichBeta, 'terms', 'table', 'aggregates',\
+            'wgtRegDom')
+    def _score(fx):
+        return len(GREATx.scoreTerms(fx.table, whichBeta, fx.aggregates,\
+                fx.wgtRegDom))
+    return _score
+
+def _sparseScoringCase(whichBeta):
+    @case('scoring.sparseBeta%d' % whichBeta, 'terms', 'pairs', 'weights',\
+            'ontology')
+    def _score(fx):
+        return len(fx.ontology.scorePairs(fx.pairs, fx.weights, whichBeta))
+    return _score
+
+for _whichBeta in range(1, 6):
+    _scoringCase(_whichBeta)
+    if _whichBeta != 3:
+        _sparseScoringCase(_whichBeta)
+
+ONTOLOGIES = 3
+
+def _ontologySpecs(fx):
+    return [('onto%d' % i, fx.ontoToGeneFn, fx.ontoTermsFn) for i in\
+            range(ONTOLOGIES)]
+
+@case('ontologies.shared', 'ontologies', 'geneTermMatrix')
+def _sharedOntologies(fx):
+    return len(GREATx.runOntologies(fx.lociFn, _ontologySpecs(fx), fx.dartFn,\
+            fx.scratch('ontologies'), fx.cutOff, fx.mean, fx.sd, 5,\
+            processes=1, assembly=fx.assembly))
+
+@case('ontologies.separate', 'ontologies', 'geneTermMatrix')
+def _separateOntologies(fx):
+    for name, ontoToGeneFn, ontoTermsFn in _ontologySpecs(fx):
+        scores, table = GREATx.run(fx.lociFn, ontoToGeneFn, fx.dartFn,\
+                fx.cutOff, fx.mean, fx.sd, 5, assembly=fx.assembly,\
+                wantTable=False)
+        GREATx.writeRankedTerms(scores, GREATx.buildOntoTermsDict(ontoTermsFn),\
+                fx.scratch(name + '.out'), scores.nTerms)
+    return ONTOLOGIES
+
+@case('binomial.score', 'darts', 'binomial', 'dartSet')
+def _binomial(fx):
+    fx.binomial.score(fx.dartSet)
+    return len(fx.dartSet)
+
+@case('pipeline.scoreDartSet', 'darts', 'ontology', 'dartSet', 'wgtRegDom')
+def _scoreDartSet(fx):
+    GREATx.scoreDartSet(fx.dartSet, fx.ontology, fx.wgtRegDom, 5)
+    return len(fx.dartSet)
+
+@case('pipeline.run', 'darts')
+def _run(fx):
+    GREATx.run(fx.lociFn, fx.ontoToGeneFn, fx.dartFn, fx.cutOff, fx.mean,\
+            fx.sd, 5, assembly=fx.assembly)
+    return fx.manifest['darts']
+
+@case('pipeline.sweep', 'scores')
+def _sweep(fx):
+    return len(GREATx.sweep(fx.lociFn, fx.ontoToGeneFn, fx.dartFn,\
+            [fx.cutOff//2, fx.cutOff], [fx.mean], [fx.sd//2, fx.sd], [1, 5],\
+            assembly=fx.assembly))
+
+@case('pipeline.permutationNull', 'permutations')
+def _permutationNull(fx):
+    GREATx.permutationNull(fx.lociFn, fx.ontoToGeneFn, fx.dartFn, fx.cutOff,\
+            fx.mean, fx.sd, 5, nPermutations=20, batchSize=10, processes=1,\
+            assembly=fx.assembly)
+    return 20
+
+@case('gi.buildSpatialWeights', 'darts', 'aggregates')
+def _spatialWeights(fx):
+    calculateGi.buildSpatialWeights(fx.aggregates.dartChrCodes,\
+            fx.aggregates.dartPositions, band=fx.band)
+    return len(fx.aggregates.dartPositions)
+
+@case('gi.calculateGiStar', 'term-darts', 'table', 'aggregates')
+def _giStar(fx):
+    return len(calculateGi.calculateGiStar(fx.table, band=fx.band,\
+            aggregates=fx.aggregates))
+
+def _measure(name, f, fx):
+    """Runs one case in this process and returns its result dict."""
+    rss = instrument.currentRSS()
+    instrument.start()
+    try:
+        with instrument.stage(name):
+            records = f(fx)
+    finally:
+        recorder = instrument.stop()
+    entry = recorder.stages[name]
+    peak = instrument.maxRSS()
+    wall = entry['wallSeconds']
+    return collections.OrderedDict([('records', int(records)),\
+            ('wallSeconds', wall), ('cpuSeconds', entry['cpuSeconds']),\
+            ('recordsPerSecond', records/wall if wall > 0 else None),\
+            ('peakMemoryBytes', peak - rss if None not in (peak, rss)\
+            else None),\
+            ('stages', collections.OrderedDict((path[len(name) + 1:],\
+            stage['wallSeconds']) for path, stage in recorder.stages.items()\
+            if path != name))])
+
+def _forked(name, f, fx):
+    """Runs one case in a child process, when fork is available."""
+    if not hasattr(os, 'fork'):
+        return _measure(name, f, fx)
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            result = _measure(name, f, fx)
+        except Exception as e:
+            result = {'error': '%s: %s' % (type(e).__name__, e)}
+        with os.fdopen(w, 'w') as out:
+            json.dump(result, out)
+        os._exit(0)
+    os.close(w)
+    with os.fdopen(r) as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    if not data:
+        return {'error': 'case process died'}
+    return json.loads(data, object_pairs_hook=collections.OrderedDict)
+
+def runCase(name, fx, repeat=1):
+    """Returns the result dict of the case name, the fastest of repeat runs."""
+    unit, needs, f = CASES[name]
+    for need in needs:
+        getattr(fx, need)
+    results = [_forked(name, f, fx) for i in range(repeat)]
+    failed = [r for r in results if 'error' in r]
+    if failed:
+        result = failed[0]
+    else:
+        result = min(results, key=lambda r: r['wallSeconds'])
+        result['peakMemoryBytes'] = max(r['peakMemoryBytes'] for r in results)
+    return collections.OrderedDict([('case', name), ('unit', unit)] +\
+            list(result.items()))
+
+def gitCommit():
+    """Returns the commit of the working tree, with '+' when it has
+    uncommitted changes, or None outside of git."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],\
+                cwd=here, stderr=subprocess.STDOUT).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain',\
+                '--untracked-files=no'], cwd=here).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty else '')
+
+def benchmark(fx, names=None, repeat=1, progress=None):
+    """Runs the cases in names (default all) and returns the report dict;
+    progress, if given, is called with each case result."""
+    cases = []
+    for name in (names or list(CASES)):
+        result = runCase(name, fx, repeat)
+        cases.append(result)
+        if progress is not None:
+            progress(result)
+    return collections.OrderedDict([('commit', gitCommit()),\
+            ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),\
+            ('python', platform.python_version()),\
+            ('numpy', np.__version__), ('platform', platform.platform()),\
+            ('dataset', collections.OrderedDict((k, v) for k, v in\
+            fx.manifest.items() if not k.endswith('Fn'))),\
+            ('cutOff', fx.cutOff), ('mean', fx.mean), ('sd', fx.sd),\
+            ('band', fx.band), ('repeat', repeat), ('cases', cases)])
+
+def formatResult(result, base=None):
+    """Returns one line of the result table, with the ratios to base."""
+    if 'error' in result:
+        return "%-30s %s" % (result['case'], result['error'])
+    line = "%-30s %10d %-12s %9.3f %12.0f %9.1f" % (result['case'],\
+            result['records'], result['unit'], result['wallSeconds'],\
+            result['recordsPerSecond'] or 0,\
+            (result['peakMemoryBytes'] or 0)/2.0**20)
+    if base is not None and 'error' not in base:
+        line += " %9.3f %7.2fx %9.1f" % (base['wallSeconds'],\
+                base['wallSeconds']/max(result['wallSeconds'], 1e-9),\
+                (base['peakMemoryBytes'] or 0)/2.0**20)
+    return line
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] <datasetDir>",
+                          description=("Times every GREATx stage on a "
+                                       "synthetic dataset, generated in "
+                                       "datasetDir if needed."))
+    syntheticData.addScaleOptions(parser)
+    parser.add_option("-k", "--cases", dest="patterns", action="append",
+                      default=None,
+                      help="run the cases matching this pattern (e.g. "
+                           "'scoring.*'); may be repeated (default: all)")
+    parser.add_option("--list", dest="list", action="store_true",
+                      default=False, help="list the cases and exit")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=1,
+                      help="runs of each case, the fastest is reported "
+                           "(default: %default)")
+    parser.add_option("--cutoff", dest="cutOff", type="int", default=1000000,
+                      help="regulatory domain cut-off (default: %default)")
+    parser.add_option("--mean", dest="mean", type="float", default=0.0,
+                      help="weight kernel mean (default: %default)")
+    parser.add_option("--sd", dest="sd", type="float", default=333333,
+                      help="weight kernel sd (default: %default)")
+    parser.add_option("--band", dest="band", type="int", default=1000000,
+                      help="Gi* distance band (default: %default)")
+    parser.add_option("-o", "--output", dest="outFn", default=None,
+                      help="write the report to this JSON file")
+    parser.add_option("--compare", dest="baseFn", default=None,
+                      help="print the ratios to an earlier JSON report")
+    (options, args) = parser.parse_args()
+    if options.list:
+        for name, (unit, needs, f) in CASES.items():
+            print("%-30s %s" % (name, unit))
+        sys.exit(0)
+    if (len(args) != 1):
+        parser.print_usage()
+        sys.exit(1)
+
+    names = [name for name in CASES if options.patterns is None or\
+            any(fnmatch.fnmatch(name, p) for p in options.patterns)]
+    base = {}
+    if options.baseFn is not None:
+        with open(options.baseFn) as f:
+            base = dict((r['case'], r) for r in json.load(f)['cases'])
+
+    manifest = syntheticData.generate(args[0],\
+            **syntheticData.scaleParams(options))
+    fx = Fixtures(manifest, os.path.join(args[0], 'bench'), options.cutOff,\
+            options.mean, options.sd, options.band)
+    header = "%-30s %10s %-12s %9s %12s %9s" % ('case', 'records', 'unit',\
+            'seconds', 'records/s', 'peak MB')
+    if base:
+        header += " %9s %8s %9s" % ('base s', 'speedup', 'base MB')
+    print(header)
+    def progress(result):
+        print(formatResult(result, base.get(result['case'])))
+        sys.stdout.flush()
+    report = benchmark(fx, names, options.repeat, progress)
+    if options.outFn is not None:
+        with open(options.outFn, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
@@ -0,0 +1,109 @@
+"""Memory and construction rate of the GREATx record classes
+
+Every record class is built once per line of a dart-TSS weight file
+(data/SRF.wgt by default), from fields parsed beforehand so that only
+construction is measured. For each class we report the bytes allocated per
+record, as traced by tracemalloc (the shallow size of the object and its
+__dict__ on Python 2), and the records built per second. The
+same figures are given for a subclass that adds a per-object __dict__,
+which is how these classes were stored before they had __slots__.
+"""
+import gc
+import os
+import sys
+import time
+from GREATx import Dart, WeightedDart, DartTSSPair, TSS, TermDartTSSTriple,\
+        Loci, RegDom
+
+DEFAULT_WGT = os.path.join(os.path.dirname(os.path.abspath(__file__)),\
+        os.pardir, 'data', 'SRF.wgt')
+
+def readWgtFields(wgtFn, copies=1):
+    """Returns the fields of every line of a .wgt file, copies times over."""
+    with open(wgtFn) as f:
+        lines = [line.rstrip('\n').split('\t') for line in f if line.strip()]
+    return lines*copies
+
+def recordArgs(lines):
+    """Returns [(name, class, list of constructor argument tuples)] built
+    from the fields of .wgt lines."""
+    return [('Dart', Dart, [(l[0], l[1], int(l[2])) for l in lines]),\
+            ('WeightedDart', WeightedDart,\
+            [(l[0], l[1], int(l[2]), float(l[6])) for l in lines]),\
+            ('DartTSSPair', DartTSSPair, [(l[0], l[1], int(l[2]), int(l[5]),\
+            float(l[6]), l[3], l[4]) for l in lines]),\
+            ('TSS', TSS, [(int(l[5]), l[3], l[4], l[0]) for l in lines]),\
+            ('TermDartTSSTriple', TermDartTSSTriple,\
+            [("\t".join(['0'] + l + ['0.01']),) for l in lines]),\
+            ('Loci', Loci,\
+            [("\t".join([l[4], l[0], l[5], '+', l[3]]),) for l in lines]),\
+            ('RegDom', RegDom, [(int(l[5]) - 1000, int(l[5]) + 1000, l[4])\
+            for l in lines])]
+
+def withDict(cls):
+    """Returns a subclass of cls whose objects also carry a __dict__."""
+    return type(cls.__name__ + 'WithDict', (cls,), {})
+
+def measure(cls, args, repeat=3):
+    """Returns (bytes per record, records per second) of building cls(*a)
+    for every a in args; the rate is the best of repeat runs, with the
+    garbage collector off."""
+    try:
+        import tracemalloc
+    except ImportError:
+        records = [cls(*a) for a in args]
+        allocated = 0
+        for record in records:
+            allocated += sys.getsizeof(record)
+            if hasattr(record, '__dict__'):
+                allocated += sys.getsizeof(record.__dict__)
+    else:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        records = [cls(*a) for a in args]
+        allocated = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        # the list itself is not part of the records
+        allocated -= sys.getsizeof(records)
+    del records
+
+    elapsed = []
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = time.time()
+            records = [cls(*a) for a in args]
+            elapsed.append(time.time() - start)
+            del records
+    finally:
+        gc.enable()
+    return float(allocated)/len(args), len(args)/max(min(elapsed), 1e-9)
+
+def benchmark(wgtFn=DEFAULT_WGT, copies=1):
+    """Yields (class name, records, slots bytes/record, slots records/s,
+    dict bytes/record, dict records/s) for every record class."""
+    lines = readWgtFields(wgtFn, copies)
+    for name, cls, args in recordArgs(lines):
+        slotBytes, slotRate = measure(cls, args)
+        dictBytes, dictRate = measure(withDict(cls), args)
+        yield name, len(args), slotBytes, slotRate, dictBytes, dictRate
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] [wgtFn]",
+                          description=("Reports bytes per record and "
+                                       "construction rate of the record "
+                                       "classes on a .wgt file (default: "
+                                       "data/SRF.wgt)."))
+    parser.add_option("-c", "--copies", dest="copies", type="int", default=1,
+                      help="build every line this many times (default: "
+                           "%default)")
+    (options, args) = parser.parse_args()
+    if (len(args) > 1):
+        parser.print_usage()
+        sys.exit(1)
+
+    print("%-18s %9s %14s %14s %14s %14s" % ('class', 'records',\
+            'bytes/record', 'records/s', 'dict bytes', 'dict records/s'))
+    for row in benchmark(args[0] if args else DEFAULT_WGT, options.copies):
+        print("%-18s %9d %14.1f %14.0f %14.1f %14.0f" % row)
@@ -0,0 +1,80 @@
+"""In-process interface to the incomplete beta code of c/betaCDFLib.c
+
+The library is built with `make libbetaCDF.so` in c/ and loaded through
+ctypes, which releases the GIL for the duration of each call. Whole arrays
+of (x, alpha, beta) triples are evaluated in one call and the results are
+returned in log space, so tiny p-values keep their magnitude. Where the
+continued fraction does not converge the library uses the Peizer-Pratt
+normal approximation instead of aborting. That only happens near the mean
+once alpha + beta exceeds about 1e10, where the approximation is within
+3e-8 relative error in log space; everywhere else the results agree with
+an exact evaluation to 1e-8 relative error or better (test_betaCDF.py).
+
+The library is looked up at $GREATX_BETACDF_LIB, then in ../c next to this
+file. When it is not found, available() is False and GREATx falls back to
+its scipy implementation.
+"""
+import ctypes
+import os
+import numpy as np
+
+LIBRARY_NAME = 'libbetaCDF.so'
+
+def _load():
+    candidates = [os.environ.get('GREATX_BETACDF_LIB'),\
+            os.path.join(os.path.dirname(os.path.abspath(__file__)),\
+            os.pardir, 'c', LIBRARY_NAME)]
+    for fn in candidates:
+        if fn and os.path.exists(fn):
+            lib = ctypes.CDLL(fn)
+            doubles = ctypes.POINTER(ctypes.c_double)
+            lib.logBetaCDFArray.restype = ctypes.c_long
+            lib.logBetaCDFArray.argtypes = [doubles, doubles, doubles,\
+                    doubles, ctypes.c_long]
+            return lib
+    return None
+
+_lib = _load()
+
+def available():
+    """Returns whether the shared library was found."""
+    return _lib is not None
+
+def logBetaCDF(x, alpha, beta, returnFallbacks=False, threads=1):
+    """Returns log of the Beta(alpha, beta) cdf at x for arrays
+
+    Invalid parameters (alpha or beta <= 0, x outside [0, 1]) give NaN.
+    With returnFallbacks, also returns how many entries needed the
+    asymptotic approximation. With threads > 1 the arrays are split into
+    that many chunks evaluated concurrently, which the released GIL allows.
+    """
+    if _lib is None:
+        raise RuntimeError(LIBRARY_NAME + " not found; run make " +\
+                LIBRARY_NAME + " in c/")
+    x, alpha, beta = np.broadcast_arrays(x, alpha, beta)
+    shape = x.shape
+    x, alpha, beta = [np.ascontiguousarray(v, dtype=np.float64).ravel()\
+            for v in (x, alpha, beta)]
+    logP = np.empty(len(x))
+    doubles = ctypes.POINTER(ctypes.c_double)
+
+    def evaluate(bounds):
+        lo, hi = bounds
+        return _lib.logBetaCDFArray(x[lo:hi].ctypes.data_as(doubles),\
+                alpha[lo:hi].ctypes.data_as(doubles),\
+                beta[lo:hi].ctypes.data_as(doubles),\
+                logP[lo:hi].ctypes.data_as(doubles), hi - lo)
+
+    if threads > 1 and len(logP) > threads:
+        from multiprocessing.pool import ThreadPool
+        edges = np.linspace(0, len(logP), threads + 1).astype(int).tolist()
+        pool = ThreadPool(threads)
+        try:
+            fallbacks = sum(pool.map(evaluate, zip(edges[:-1], edges[1:])))
+        finally:
+            pool.close()
+    else:
+        fallbacks = evaluate((0, len(logP)))
+    if returnFallbacks:
+        return logP.reshape(shape), fallbacks
+    return logP.reshape(shape)
@@ -1,72 +1,208 @@
-import scipy
-from GREATx import WeightedDart, TermDartTSSTriple
-
-inFile = open('../data/SRFtoTerms.data')
-outFile = open('../data/GiLocal.data','w')
-
-lineObjects = []
-for line in inFile:
-    lineObjects.append(TermDartTSSTriple(line))
-termIDs = list(set([lineObject.termID for lineObject in lineObjects])) ##unique set of term IDS
-dartNames = list(set([lineObject.dartName for lineObject in lineObjects])) ##unique set of dart names
-
-for termID in termIDs:
-    if termID != 'UNKNOWN':
-        termIDObjects = filter(lambda x: x.termID == termID,lineObjects)##All the lines associated with the term
-        weightedDarts = []
-        for dartName in dartNames:
-            termIDObjectsForDartName =\
-                    filter(lambda x: x.dartName == dartName, termIDObjects)
-            if len(termIDObjectsForDartName) > 0:
-                dartWeight = sum([x.weight for x in termIDObjectsForDartName])
-                dartPosition = termIDObjectsForDartName[0].dartPosition
-                chrName = termIDObjectsForDartName[0].chrName
-                weightedDarts.append(WeightedDart(chrName=chrName,\
-                                                  name=dartName,\
-                                                  position=dartPosition,\
-                                                  weight=dartWeight))
-
-        X_bar = sum([x.weight for x in weightedDarts])/len(weightedDarts)
-        S = scipy.sqrt(sum([x.weight**2/len(weightedDarts)\
-                            for x in weightedDarts]) - X_bar**2)
-
-        for weightedDartObjectI in weightedDarts: 
-            numerator1 = 0.0
-            numerator2 = 0.0
-            denom1 = 0.0
-            denom2 = 0.0
-            for weightedDartObjectJ in weightedDarts:
-                if weightedDartObjectJ.name == weightedDartObjectI.name:
-                    continue
-                if weightedDartObjectJ.chrName != weightedDartObjectI.chrName:
-                    continue
-
-                if (scipy.fabs(weightedDartObjectI.position - weightedDartObjectJ.position) > 46944323): # size of the smallest chromosome
-                    spatialWeight = 0
-                else:
-                    spatialWeight = 1
-
-                numerator1 += spatialWeight*weightedDartObjectJ.weight
-                numerator2 += spatialWeight*X_bar
-                denom1 += len(weightedDarts)*(spatialWeight**2)            
-                denom2 += spatialWeight            
-
-            denom2 = denom2**2
-            numerator = numerator1 - numerator2
-            if(len(weightedDarts) == 1): 
-                ZScore = "Only one dart on " + weightedDartObjectI.chrName
-            else:
-                denominator = S*scipy.sqrt(\
-                        (denom1 - denom2)/(len(weightedDarts) - 1))
-                if denominator == 0:
-                    ZScore = "0 denom"
-                else:
-                    ZScore = numerator/denominator
-            outFile.write(\
-                    "\t".join([termID,\
-                               weightedDartObjectI.name,\
-                               weightedDartObjectI.chrName,\
-                               str(weightedDartObjectI.position),\
-                               str(ZScore)])\
-                    + "\n")
+"""Getis-Ord Gi* local statistic for every dart of every term
 
+The weight of a dart on a term is the sum of its dart-TSS pair weights for
+that term. Darts are spatial neighbors when they lie on the same chromosome
+within a fixed distance band of each other. The dart-dart spatial weight
+matrix is built once per chromosome from sorted dart positions, and the Gi*
+z-scores of all terms are computed with sparse matrix products over it.
+"""
+import numpy as np
+import scipy.sparse
+import instrument
+from GREATx import TermDartTSSTable, DartAggregateIndex
+
+# size of the smallest hg18 chromosome (chr21)
+DEFAULT_BAND = 46944323
+
+@instrument.timed('spatialWeights')
+def buildSpatialWeights(chrCodes, positions, band=DEFAULT_BAND,\
+        kernel='binary', includeSelf=False):
+    """Returns the sparse dart-dart spatial weight matrix
+
+    Parameters
+    ----------
+    chrCodes : array of int
+               chromosome code of each dart
+    positions : array of int
+                position of each dart
+    band : int
+           darts further apart than band have no weight (default = 46944323)
+    kernel : str
+             'binary' gives every pair within the band weight 1, 'gaussian'
+             weights a pair by a normal pdf with sd = band/3, scaled to 1 at
+             distance 0 (default = 'binary')
+    includeSelf : bool
+                  whether a dart is its own neighbor (default = False)
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix of shape (len(positions), len(positions))
+    """
+    chrCodes = np.asarray(chrCodes)
+    positions = np.asarray(positions, dtype=np.int64)
+    rows, cols = [], []
+    for chrCode in np.unique(chrCodes):
+        onChr = np.flatnonzero(chrCodes == chrCode)
+        onChr = onChr[np.argsort(positions[onChr], kind='mergesort')]
+        chrPositions = positions[onChr]
+        lo = np.searchsorted(chrPositions, chrPositions - band, side='left')
+        hi = np.searchsorted(chrPositions, chrPositions + band, side='right')
+        counts = hi - lo
+        runStarts = np.cumsum(counts) - counts
+        i = np.repeat(np.arange(len(onChr)), counts)
+        j = np.arange(counts.sum()) - np.repeat(runStarts - lo, counts)
+        if not includeSelf:
+            i, j = i[i != j], j[i != j]
+        rows.append(onChr[i])
+        cols.append(onChr[j])
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+    instrument.count('neighborPairs', len(rows))
+
+    if kernel == 'binary':
+        weights = np.ones(len(rows))
+    elif kernel == 'gaussian':
+        distances = (positions[rows] - positions[cols])/(band/3.0)
+        weights = np.exp(-0.5*distances*distances)
+    else:
+        raise ValueError("kernel must be 'binary' or 'gaussian': %r" % kernel)
+    return scipy.sparse.csr_matrix((weights, (rows, cols)),\
+            shape=(len(positions), len(positions)))
+
+class GiStarResult:
+    """Gi* z-scores of every (term, dart) pair
+
+    Attributes
+    ----------
+    termIDs, dartNames, chrNames : array of str
+                                   labels of the codes below
+    termCodes, dartCodes, chrCodes : array of int
+                                     term, dart and chromosome of each entry
+    positions : array of int
+                dart position of each entry
+    dartWeights : array of float
+                  weight of the dart on the term
+    termDartCounts : array of int
+                     number of darts hitting the term of each entry
+    denominators : array of float
+                   Gi* denominator of each entry
+    zScores : array of float
+              Gi* z-score of each entry, NaN where the term has a single
+              dart or the denominator is 0
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __len__(self):
+        return len(self.zScores)
+
+    def __repr__(self):
+        return 'GiStarResult(<%d term-dart z-scores>)' % len(self)
+
+    def lines(self):
+        """Yields the result in the GiLocal.data format."""
+        for termCode, dartCode, chrCode, position, count, denominator,\
+                zScore in zip(self.termCodes.tolist(),\
+                self.dartCodes.tolist(), self.chrCodes.tolist(),\
+                self.positions.tolist(), self.termDartCounts.tolist(),\
+                self.denominators.tolist(), self.zScores.tolist()):
+            if count == 1:
+                zScore = "Only one dart on " + self.chrNames[chrCode]
+            elif denominator == 0:
+                zScore = "0 denom"
+            yield "\t".join([self.termIDs[termCode], self.dartNames[dartCode],\
+                    self.chrNames[chrCode], str(position), str(zScore)]) + "\n"
+
+@instrument.timed('giStar')
+def calculateGiStar(table, band=DEFAULT_BAND, kernel='binary',\
+        includeSelf=False, termChunk=512, aggregates=None):
+    """Computes Gi* z-scores for every dart of every term in a table
+
+    Parameters
+    ----------
+    table : TermDartTSSTable
+    band, kernel, includeSelf :
+            passed to buildSpatialWeights
+    termChunk : int
+                number of terms multiplied against the spatial weights at
+                once, which bounds the memory of the dense-ish products
+                (default = 512)
+    aggregates : DartAggregateIndex
+                 aggregates of table; built when not given (default = None)
+
+    Returns
+    -------
+    GiStarResult
+    """
+    if aggregates is None:
+        aggregates = DartAggregateIndex(table)
+    known = (table.termIDs != 'UNKNOWN')[aggregates.termDartTermCodes]
+
+    # dart weights per (term, dart)
+    nTerms, nDarts = len(table.termIDs), len(table.dartNames)
+    X = scipy.sparse.csr_matrix((aggregates.termDartWeights[known],\
+            (aggregates.termDartTermCodes[known],\
+             aggregates.termDartDartCodes[known])), shape=(nTerms, nDarts))
+    X.sort_indices()
+    M = X.copy()
+    M.data = np.ones(len(M.data))
+
+    dartChrCodes = aggregates.dartChrCodes
+    dartPositions = aggregates.dartPositions
+
+    W = buildSpatialWeights(dartChrCodes, dartPositions, band=band,\
+            kernel=kernel, includeSelf=includeSelf)
+    W2 = W.multiply(W).tocsr()
+
+    n = np.diff(M.indptr).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        X_bar = np.asarray(X.sum(axis=1)).ravel()/n
+        S = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel()/n\
+                - X_bar**2)
+
+    # neighbor sums at every (term, dart) entry of X, a chunk of terms at a time
+    A, B, C = [], [], []
+    for lo in range(0, nTerms, termChunk):
+        Xc, Mc = X[lo:lo + termChunk], M[lo:lo + termChunk]
+        A.append(_valuesAt(Xc.dot(W), Mc))
+        B.append(_valuesAt(Mc.dot(W), Mc))
+        C.append(_valuesAt(Mc.dot(W2), Mc))
+    A, B, C = (np.concatenate(v) if v else np.zeros(0) for v in (A, B, C))
+
+    termCodes = np.repeat(np.arange(nTerms), np.diff(M.indptr))
+    dartCodes = M.indices
+    instrument.count('giEntries', len(dartCodes))
+    nEntry = n[termCodes]
+    numerator = A - X_bar[termCodes]*B
+    with np.errstate(invalid='ignore', divide='ignore'):
+        denominators = S[termCodes]*np.sqrt((nEntry*C - B**2)/(nEntry - 1))
+        zScores = np.where((nEntry > 1) & (denominators != 0),\
+                numerator/denominators, np.nan)
+
+    return GiStarResult(termIDs=table.termIDs, dartNames=table.dartNames,\
+            chrNames=table.chrNames, termCodes=termCodes,\
+            dartCodes=dartCodes, chrCodes=dartChrCodes[dartCodes],\
+            positions=dartPositions[dartCodes], dartWeights=X.data,\
+            termDartCounts=nEntry.astype(np.int64),\
+            denominators=denominators, zScores=zScores)
+
+def _valuesAt(product, pattern):
+    """Returns the entries of product at the nonzeros of pattern, in order."""
+    product = product.tocsr()
+    product.sort_indices()
+    nCols = np.int64(pattern.shape[1])
+    keys = np.repeat(np.arange(product.shape[0], dtype=np.int64),\
+            np.diff(product.indptr))*nCols + product.indices
+    wanted = np.repeat(np.arange(pattern.shape[0], dtype=np.int64),\
+            np.diff(pattern.indptr))*nCols + pattern.indices
+    idx = np.minimum(np.searchsorted(keys, wanted), max(len(keys) - 1, 0))
+    if len(keys) == 0:
+        return np.zeros(len(wanted))
+    return np.where(keys[idx] == wanted, product.data[idx], 0.0)
+
+if __name__ == '__main__':
+    # text or binary (see GREATx.py convert)
+    table = TermDartTSSTable.load('../data/SRFtoTerms.data')
+    with open('../data/GiLocal.data', 'w') as outFile:
+        outFile.writelines(calculateGiStar(table).lines())
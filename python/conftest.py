@@ -0,0 +1,9 @@
+"""Fixtures shared by the GREATx tests"""
+import pytest
+import syntheticData
+
+@pytest.fixture(scope='session')
+def dataset(tmp_path_factory):
+    """Manifest of a small synthetic dataset, see syntheticData.generate"""
+    return syntheticData.generate(str(tmp_path_factory.mktemp('synthetic')),\
+            genes=500, terms=100, darts=300, seed=1)
@@ -0,0 +1,168 @@
+"""Client of the GREATx enrichment service (see enrichmentServer.py)
+
+Kept apart from the service so that sending a dart set does not pay for
+importing GREATx and scipy.
+
+Example
+--------
+$ python enrichmentClient.py --socket /tmp/greatx.sock SRF.hg18.bed
+$ python enrichmentClient.py --socket /tmp/greatx.sock -n 100 -c 4 SRF.hg18.bed
+"""
+import json
+import socket
+import sys
+import time
+
+try:
+    from http.client import HTTPConnection
+    from urllib.parse import urlencode
+except ImportError:
+    from httplib import HTTPConnection
+    from urllib import urlencode
+
+DEFAULT_PORT = 8642
+
+class UnixHTTPConnection(HTTPConnection):
+    """HTTPConnection to a server on a Unix socket"""
+
+    def __init__(self, socketFn, timeout=None):
+        HTTPConnection.__init__(self, 'localhost')
+        self.socketFn = socketFn
+        self.socketTimeout = timeout
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.socketTimeout is not None:
+            self.sock.settimeout(self.socketTimeout)
+        self.sock.connect(self.socketFn)
+
+class EnrichmentClient(object):
+    """Client of an enrichment service
+
+    Parameters
+    ----------
+    socketFn : str
+               Unix socket of the service (default = None, use host:port)
+    host : str
+    port : int
+    timeout : float
+              seconds (default = None, no timeout)
+
+    Example
+    --------
+    >>> client = EnrichmentClient('/tmp/greatx.sock')
+    >>> sys.stdout.write(client.score(open('SRF.hg18.bed').read(), sd=100000))
+    """
+
+    def __init__(self, socketFn=None, host='localhost', port=DEFAULT_PORT,\
+            timeout=None):
+        self.socketFn = socketFn
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def __repr__(self):
+        if self.socketFn is not None:
+            return 'EnrichmentClient(%r)' % self.socketFn
+        return 'EnrichmentClient(%r, %r)' % (self.host, self.port)
+
+    def _request(self, method, path, body=None):
+        if self.socketFn is not None:
+            connection = UnixHTTPConnection(self.socketFn, self.timeout)
+        else:
+            connection = HTTPConnection(self.host, self.port,\
+                    timeout=self.timeout)
+        try:
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            text = response.read().decode('utf-8')
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError("service answered %d: %s" %\
+                    (response.status, text.strip()))
+        return text
+
+    def score(self, darts, **params):
+        """Returns the ranked term table of darts, the text of a dart BED
+        file; params are the query parameters of /score."""
+        query = urlencode(sorted((k, v) for k, v in params.items()\
+                if v is not None))
+        return self._request('POST', '/score' + ('?' + query if query else\
+                ''), darts.encode('utf-8'))
+
+    def status(self):
+        return json.loads(self._request('GET', '/status'))
+
+
+def main(argv):
+    """Command line of the client"""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] <dartFn> [outFn]",
+                          description=("Sends a dart set to a running "
+                                       "service and writes the ranked terms "
+                                       "to outFn (default: stdout). With -n, "
+                                       "sends it repeatedly and reports the "
+                                       "latencies instead."))
+    parser.add_option("--socket", dest="socketFn", default=None,
+                      help="Unix socket of the service")
+    parser.add_option("--host", dest="host", default="localhost",
+                      help="TCP host (default: %default)")
+    parser.add_option("--port", dest="port", type="int", default=DEFAULT_PORT,
+                      help="TCP port (default: %default)")
+    for name in ('ontology', 'cutoff', 'mean', 'sd', 'beta', 'best'):
+        parser.add_option("--" + name, dest=name, default=None,
+                          help="%s of this request (default: the service's)"\
+                                  % name)
+    parser.add_option("--status", dest="status", action="store_true",
+                      default=False, help="print the service status and exit")
+    parser.add_option("-n", "--requests", dest="nRequests", type="int",
+                      default=None, help="send the dart set this many times")
+    parser.add_option("-c", "--concurrency", dest="concurrency", type="int",
+                      default=1, help="requests in flight with -n "
+                                      "(default: %default)")
+    (options, args) = parser.parse_args(argv)
+    client = EnrichmentClient(options.socketFn, options.host, options.port)
+    if options.status:
+        print(json.dumps(client.status(), indent=2, sort_keys=True))
+        return
+    if not (1 <= len(args) <= 2):
+        parser.print_usage()
+        sys.exit(1)
+
+    with open(args[0]) as f:
+        darts = f.read()
+    params = dict((name, getattr(options, name)) for name in\
+            ('ontology', 'cutoff', 'mean', 'sd', 'beta', 'best'))
+    if options.nRequests is None:
+        try:
+            result = client.score(darts, **params)
+        except RuntimeError as e:
+            sys.stderr.write("%s\n" % e)
+            sys.exit(1)
+        if len(args) == 2:
+            with open(args[1], 'w') as outFile:
+                outFile.write(result)
+        else:
+            sys.stdout.write(result + "\n")
+        return
+
+    from multiprocessing.pool import ThreadPool
+    def timedRequest(i):
+        start = time.time()
+        client.score(darts, **params)
+        return time.time() - start
+    pool = ThreadPool(options.concurrency)
+    start = time.time()
+    try:
+        latencies = sorted(pool.map(timedRequest, range(options.nRequests)))
+    finally:
+        pool.close()
+    elapsed = time.time() - start
+    print("%d requests in %.2f s (%.1f/s); latency median %.3f s, max %.3f s"\
+            % (len(latencies), elapsed, len(latencies)/elapsed,\
+            latencies[len(latencies)//2], latencies[-1]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
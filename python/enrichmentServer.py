@@ -0,0 +1,323 @@
+"""Long-running GREATx enrichment service
+
+For a small dart set, a GREATx.py run is dominated by start-up: importing
+scipy, reading the loci, gene -> term and term description files, and
+building the regulatory domains and their term intervals. The service does
+all of that once and then scores the dart sets sent to it over HTTP, on a
+TCP port or a local Unix socket. It answers with the ranked term table
+GREATx.py writes to its outFn. Requests are handled concurrently, one
+thread each.
+
+An OntologyIndex is built once per (ontology, cutOff) and kept for later
+requests; the assembly and the ontologies are fixed when the service
+starts, and the kernel mean, sd and Beta variant only affect the scoring.
+
+Requests
+--------
+POST /score    the body holds the dart BED lines; optional query
+               parameters: ontology, cutoff, mean, sd, beta, best
+GET /status    JSON description of the service and its loaded indexes
+
+Example
+--------
+$ python enrichmentServer.py --socket /tmp/greatx.sock hg18.loci \
+        GOBP=ontoToGene.canon,ontoTerms.canon
+$ python enrichmentClient.py --socket /tmp/greatx.sock SRF.hg18.bed
+"""
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from GREATx import getAssembly, GeneTermMatrix, buildOntoTermsDict,\
+        GenomeIntervals, RegDomIndex, OntologyIndex, WeightedRegDom, DartSet, scoreDartSet,\
+        rankedTermLines, parseOntology
+
+from enrichmentClient import DEFAULT_PORT
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import urlparse, parse_qs
+
+# query parameter -> (score() argument, type)
+QUERY_PARAMETERS = {'ontology': ('ontology', str), 'cutoff': ('cutOff', int),\
+        'mean': ('mean', float), 'sd': ('sd', float),\
+        'beta': ('whichBeta', int), 'best': ('nBest', int)}
+
+class EnrichmentService(object):
+    """Preloaded indexes of one assembly and its ontologies
+
+    Parameters
+    ----------
+    lociFn : str
+             name of the loci file (e.g. hg18.loci)
+    ontologies : list of (str, str, str)
+                 (name, ontoToGeneFn, ontoTermsFn) of each ontology served;
+                 the first one is the default
+    cutOff, mean, sd, whichBeta : int, float, float, int
+                                  defaults of the requests, as for GREATx.run
+    nBest : int
+            default number of terms returned (default = 30)
+    antigapFn, genomeSize, assembly :
+            as for GREATx.run
+    maxIndexes : int
+                 number of (ontology, cutOff) indexes kept, least recently
+                 used first out (default = 8)
+
+    Example
+    --------
+    >>> service = EnrichmentService('hg18.loci', [('GOBP', 'ontoToGene.canon', 'ontoTerms.canon')])
+    >>> sys.stdout.write(service.score(open('SRF.hg18.bed'), sd=100000))
+    """
+
+    def __init__(self, lociFn, ontologies, cutOff=1000000, mean=0.0,\
+            sd=333333.0, whichBeta=5, nBest=30, antigapFn=None,\
+            genomeSize=None, assembly=None, maxIndexes=8):
+        if not ontologies:
+            raise ValueError("at least one ontology is needed")
+        self.assembly = getAssembly(assembly)
+        self.lociFn = lociFn
+        self.antigapFn = antigapFn
+        # read once, so that building an index never interns chromosomes
+        self.antigaps = None if antigapFn is None else\
+                GenomeIntervals.fromFile(antigapFn, self.assembly)
+        self.genomeSize = genomeSize
+        self.maxIndexes = maxIndexes
+        self.defaults = {'ontology': ontologies[0][0], 'cutOff': cutOff,\
+                'mean': mean, 'sd': sd, 'whichBeta': whichBeta,\
+                'nBest': nBest}
+        self.ontologyNames = [name for name, ontoToGeneFn, ontoTermsFn in\
+                ontologies]
+        self.geneTermMatrices, self.ontoTerms = {}, {}
+        for name, ontoToGeneFn, ontoTermsFn in ontologies:
+            self.geneTermMatrices[name] = GeneTermMatrix.load(ontoToGeneFn)
+            self.ontoTerms[name] = buildOntoTermsDict(ontoTermsFn)
+        # the regdoms of any other cutOff are the same TSSs
+        self.regDoms = RegDomIndex.fromLoci(lociFn, cutOff, self.assembly)
+        self.regDomsCutOff = cutOff
+        self._indexes = collections.OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.ontologyIndex(self.defaults['ontology'], cutOff)
+
+    def __repr__(self):
+        return 'EnrichmentService(<%d ontologies, %d indexes>)' %\
+                (len(self.ontologyNames), len(self._indexes))
+
+    def _cachedIndex(self, key):
+        # the caller holds self._lock
+        index = self._indexes.pop(key, None)
+        if index is not None:
+            self._indexes[key] = index
+        return index
+
+    def ontologyIndex(self, ontology, cutOff):
+        """Returns the OntologyIndex of an ontology at cutOff, building it
+        on first use
+
+        The index is built outside the service lock, so requests on indexes
+        already loaded go on meanwhile; concurrent requests for the same
+        new index wait for one build.
+        """
+        if ontology not in self.geneTermMatrices:
+            raise ValueError("unknown ontology %s" % ontology)
+        key = (ontology, cutOff)
+        with self._lock:
+            index = self._cachedIndex(key)
+            if index is not None:
+                return index
+            building = self._building.setdefault(key, threading.Lock())
+        with building:
+            with self._lock:
+                index = self._cachedIndex(key)
+            if index is not None:
+                return index
+            try:
+                regDoms = self.regDoms if cutOff == self.regDomsCutOff\
+                        else self.regDoms.withCutOff(cutOff)
+                index = OntologyIndex(regDoms,\
+                        self.geneTermMatrices[ontology], self.antigaps,\
+                        self.genomeSize)
+            finally:
+                with self._lock:
+                    self._building.pop(key, None)
+                    if index is not None:
+                        self._indexes[key] = index
+                        while len(self._indexes) > self.maxIndexes:
+                            self._indexes.popitem(last=False)
+            return index
+
+    def score(self, dartLines, **params):
+        """Returns the ranked term table of the darts in dartLines
+
+        dartLines are the lines of a dart BED file. params override the
+        defaults: ontology, cutOff, mean, sd, whichBeta and nBest. The
+        result is what GREATx.py writes to its outFn.
+        """
+        unknown = set(params) - set(self.defaults)
+        if unknown:
+            raise ValueError("unknown parameters %s" %\
+                    ", ".join(sorted(unknown)))
+        options = dict(self.defaults)
+        options.update((k, v) for k, v in params.items() if v is not None)
+        ontology = self.ontologyIndex(options['ontology'], options['cutOff'])
+        # interning the chromosome names may extend the shared assembly
+        with self._lock:
+            darts = DartSet.fromLines(dartLines, self.assembly)
+            self.requests += 1
+        scores, table = scoreDartSet(darts, ontology,\
+                WeightedRegDom(options['cutOff'], options['mean'],\
+                options['sd']), options['whichBeta'])
+        return "".join(rankedTermLines(scores,\
+                self.ontoTerms[options['ontology']],\
+                max(scores.nTerms, 1), options['nBest']))
+
+    def status(self):
+        """Returns a JSON-serializable description of the service."""
+        with self._lock:
+            indexes = [{'ontology': ontology, 'cutOff': cutOff,\
+                    'terms': len(index.terms)} for (ontology, cutOff), index\
+                    in self._indexes.items()]
+            requests = self.requests
+        return {'assembly': self.assembly.name, 'loci': self.lociFn,\
+                'regulatoryDomains': len(self.regDoms),\
+                'ontologies': self.ontologyNames, 'defaults': self.defaults,\
+                'indexes': indexes, 'requests': requests,\
+                'uptime': time.time() - self.started}
+
+class EnrichmentHandler(BaseHTTPRequestHandler):
+    """HTTP front end of the EnrichmentService in server.service"""
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/status':
+            return self._reply(404, "unknown path %s\n" % self.path)
+        self._reply(200, json.dumps(self.server.service.status()) + "\n",\
+                'application/json')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/score':
+            return self._reply(404, "unknown path %s\n" % self.path)
+        try:
+            params = {}
+            for name, values in parse_qs(url.query).items():
+                if name not in QUERY_PARAMETERS:
+                    raise ValueError("unknown parameter %s" % name)
+                argument, convert = QUERY_PARAMETERS[name]
+                params[argument] = convert(values[-1])
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length).decode('utf-8')
+            result = self.server.service.score(body.splitlines(), **params)
+        except ValueError as e:
+            return self._reply(400, "%s\n" % e)
+        except Exception as e:
+            return self._reply(500, "%s: %s\n" % (type(e).__name__, e))
+        self._reply(200, result)
+
+    def _reply(self, code, text, contentType='text/plain'):
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', contentType + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def makeServer(service, socketFn=None, host='localhost', port=DEFAULT_PORT,\
+        verbose=False):
+    """Returns an HTTP server for service on a Unix socket, when socketFn
+    is given, or on host:port; call serve_forever() to run it."""
+    if socketFn is not None:
+        if os.path.exists(socketFn):
+            os.remove(socketFn)
+        server = ThreadingUnixHTTPServer(socketFn, EnrichmentHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), EnrichmentHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+def serveMain(argv):
+    """Command line of the service"""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] <lociFn> \
+NAME=ONTOTOGENE,ONTOTERMS [...]",
+                          description=("Preloads the regulatory domains and "
+                                       "ontologies and scores the dart sets "
+                                       "posted to it; the first ontology is "
+                                       "the default."))
+    parser.add_option("--socket", dest="socketFn", default=None,
+                      help="listen on this Unix socket instead of TCP")
+    parser.add_option("--host", dest="host", default="localhost",
+                      help="TCP host (default: %default)")
+    parser.add_option("--port", dest="port", type="int", default=DEFAULT_PORT,
+                      help="TCP port (default: %default)")
+    parser.add_option("--cutoff", dest="cutOff", type="int", default=1000000,
+                      help="default regdom cutoff (default: %default)")
+    parser.add_option("--mean", dest="mean", type="float", default=0.0,
+                      help="default kernel mean (default: %default)")
+    parser.add_option("--sd", dest="sd", type="float", default=333333.0,
+                      help="default kernel sd (default: %default)")
+    parser.add_option("--beta", dest="whichBeta", type="int", default=5,
+                      help="default Beta variant (default: %default)")
+    parser.add_option("--best", dest="nBest", type="int", default=30,
+                      help="default number of terms returned "
+                           "(default: %default)")
+    parser.add_option("--antigap", dest="antigapFn", default=None,
+                      help="antigap BED file bounding the coverage")
+    parser.add_option("--assembly", dest="assembly", default=None,
+                      help="assembly name (hg18, hg19, hg38, mm10) or "
+                           "chrom.sizes file (default: hg18)")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true",
+                      default=False, help="log every request to stderr")
+    (options, args) = parser.parse_args(argv)
+    if (len(args) < 2):
+        parser.print_usage()
+        sys.exit(1)
+    try:
+        ontologies = [parseOntology(spec) for spec in args[1:]]
+    except ValueError as e:
+        parser.error(str(e))
+
+    start = time.time()
+    service = EnrichmentService(args[0], ontologies, options.cutOff,\
+            options.mean, options.sd, options.whichBeta, options.nBest,\
+            options.antigapFn, assembly=options.assembly)
+    server = makeServer(service, options.socketFn, options.host, options.port,\
+            options.verbose)
+    sys.stderr.write("Loaded in %.1f s; serving on %s\n" % (time.time() -\
+            start, options.socketFn or "%s:%d" % (options.host, options.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if options.socketFn is not None and os.path.exists(options.socketFn):
+            os.remove(options.socketFn)
+
+if __name__ == '__main__':
+    serveMain(sys.argv[1:])
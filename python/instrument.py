@@ -0,0 +1,246 @@
+"""Per-stage timing, counters and memory of GREATx runs
+
+The pipeline stages (regulatory domains, overlap, weights, associations,
+scoring, Gi*) mark themselves with stage() or timed() and report how many
+records they handled with count(). Nothing is recorded until start() is
+called; until then stage() returns a shared no-op context manager and
+count() returns at once, so the cost of an uninstrumented run is a
+function call per stage, never per record.
+
+Once started, every stage records its wall and CPU time, the records it
+counted, the resident set size before and after, and the peak RSS of the
+process when it ended. The peak RSS is a process-wide high-water mark, so
+a stage's own peak only shows when it raised that mark (maxRSSGrowth).
+Stages nest, and a stage entered again is added to its earlier entry. The
+report is a JSON document; start() can also run cProfile over the whole
+run and dump its stats for pstats or snakeviz.
+
+Example
+--------
+>>> recorder = instrument.start(profileFn='run.prof')
+>>> scores, table = GREATx.run(...)
+>>> instrument.stop().write('run.json')
+"""
+import collections
+import functools
+import json
+import os
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+def currentRSS():
+    """Returns the resident set size of the process in bytes, or None."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def maxRSS():
+    """Returns the peak resident set size of the process in bytes, or None."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*_MAXRSS_UNIT
+
+def _cpuSeconds():
+    t = os.times()
+    return t[0] + t[1]
+
+class _NullStage(object):
+    """Context manager of a stage that records nothing"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage(object):
+    """Context manager recording one pass through a stage"""
+    __slots__ = ('recorder', 'path', 'wall', 'cpu', 'rss', 'maxRSS')
+
+    def __init__(self, recorder, path):
+        self.recorder = recorder
+        self.path = path
+
+    def __enter__(self):
+        self.recorder._begin(self.path)
+        self.rss, self.maxRSS = currentRSS(), maxRSS()
+        self.cpu, self.wall = _cpuSeconds(), time.time()
+        return self
+
+    def __exit__(self, *exc):
+        wall, cpu = time.time() - self.wall, _cpuSeconds() - self.cpu
+        self.recorder._stack().pop()
+        self.recorder._finish(self, wall, cpu, currentRSS(), maxRSS())
+        return False
+
+class Recorder:
+    """Timings, counters and memory of the stages of one run
+
+    Parameters
+    ----------
+    profileFn : str
+                if given, cProfile runs from construction until stop() and
+                its stats are dumped to this file (default = None)
+
+    Attributes
+    ----------
+    stages : OrderedDict
+             stage path ('parent/child') -> dict of calls, wallSeconds,
+             cpuSeconds, rssStartBytes, rssEndBytes, maxRSSBytes,
+             maxRSSGrowthBytes and counters, in the order stages were first
+             entered
+    counters : OrderedDict
+               name -> total over the run
+    """
+
+    def __init__(self, profileFn=None):
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.profileFn = profileFn
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._start = (time.time(), _cpuSeconds())
+        self._end = None
+        self.profiler = None
+        if profileFn is not None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def __repr__(self):
+        return 'Recorder(<%d stages>)' % len(self.stages)
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def stage(self, name):
+        """Returns a context manager recording a stage within the current
+        one; a stage entered within itself is part of the outer pass."""
+        stack = self._stack()
+        if stack and stack[-1].rsplit('/', 1)[-1] == name:
+            return _NULL_STAGE
+        return _Stage(self, stack[-1] + '/' + name if stack else name)
+
+    def count(self, name, n=1):
+        """Adds n to the counter name of the run and of the current stage."""
+        stack = self._stack()
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            if stack:
+                counters = self._entry(stack[-1])['counters']
+                counters[name] = counters.get(name, 0) + n
+
+    def _entry(self, path):
+        if path not in self.stages:
+            self.stages[path] = collections.OrderedDict([('calls', 0),\
+                    ('wallSeconds', 0.0), ('cpuSeconds', 0.0),\
+                    ('rssStartBytes', None), ('rssEndBytes', None),\
+                    ('maxRSSBytes', None), ('maxRSSGrowthBytes', 0),\
+                    ('counters', collections.OrderedDict())])
+        return self.stages[path]
+
+    def _begin(self, path):
+        self._stack().append(path)
+        with self._lock:
+            self._entry(path)
+
+    def _finish(self, stage, wall, cpu, rss, peak):
+        with self._lock:
+            entry = self.stages[stage.path]
+            entry['calls'] += 1
+            entry['wallSeconds'] += wall
+            entry['cpuSeconds'] += cpu
+            if entry['rssStartBytes'] is None:
+                entry['rssStartBytes'] = stage.rss
+            entry['rssEndBytes'] = rss
+            entry['maxRSSBytes'] = peak
+            if peak is not None and stage.maxRSS is not None:
+                entry['maxRSSGrowthBytes'] += peak - stage.maxRSS
+
+    def stop(self):
+        """Stops the clock and the profiler, dumping its stats."""
+        if self._end is None:
+            self._end = (time.time(), _cpuSeconds())
+            if self.profiler is not None:
+                self.profiler.disable()
+                self.profiler.dump_stats(self.profileFn)
+        return self
+
+    def report(self):
+        """Returns the report as a JSON-serializable dict."""
+        end = self._end or (time.time(), _cpuSeconds())
+        return collections.OrderedDict([('argv', list(sys.argv)),\
+                ('started', time.strftime('%Y-%m-%dT%H:%M:%S',\
+                time.localtime(self._start[0]))),\
+                ('wallSeconds', end[0] - self._start[0]),\
+                ('cpuSeconds', end[1] - self._start[1]),\
+                ('maxRSSBytes', maxRSS()), ('profile', self.profileFn),\
+                ('counters', self.counters),\
+                ('stages', [collections.OrderedDict([('stage', path)] +\
+                list(entry.items())) for path, entry in self.stages.items()])])
+
+    def write(self, reportFn):
+        """Writes the report to reportFn as JSON."""
+        with open(reportFn, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+            f.write("\n")
+
+_recorder = None
+
+def start(profileFn=None):
+    """Starts recording stages into a new Recorder and returns it."""
+    global _recorder
+    _recorder = Recorder(profileFn)
+    return _recorder
+
+def stop():
+    """Stops recording and returns the Recorder, or None if not started."""
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.stop()
+    return recorder
+
+def active():
+    """Returns the Recorder in use, or None."""
+    return _recorder
+
+def stage(name):
+    """Returns a context manager recording the stage name, when recording."""
+    if _recorder is None:
+        return _NULL_STAGE
+    return _recorder.stage(name)
+
+def count(name, n=1):
+    """Adds n to the counter name, when recording."""
+    if _recorder is not None:
+        _recorder.count(name, n)
+
+def timed(name):
+    """Decorator recording every call of a function as the stage name"""
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return f(*args, **kwargs)
+            with _recorder.stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,146 @@
+"""Content-addressed cache for GREATx pipeline intermediates
+
+Each pipeline stage (regulatory domains, dart-TSS weights, term
+associations) writes one file. The file is stored under a key hashed from
+the stage name, the digests of its inputs and its parameters, so a stage
+whose inputs and parameters have not changed is skipped and its previous
+output reused. Files are written atomically and the least recently used
+ones are evicted once the cache grows past its size bound. The files of the
+current run are never evicted, so a run may leave the cache above its bound
+until a later run evicts them.
+"""
+import hashlib
+import os
+import tempfile
+import instrument
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'GREATx')
+DEFAULT_CACHE_SIZE = 2*1024**3
+
+_digests = {}
+
+def fileDigest(fn):
+    """Returns the sha1 hex digest of the contents of fn
+
+    Digests are remembered per (path, size, mtime) for the life of the
+    process, so a file is only read once.
+    """
+    stat = os.stat(fn)
+    memoKey = (os.path.abspath(fn), stat.st_size, stat.st_mtime)
+    if memoKey not in _digests:
+        digest = hashlib.sha1()
+        with open(fn, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        _digests[memoKey] = digest.hexdigest()
+    return _digests[memoKey]
+
+class PipelineCache:
+    """Directory of pipeline intermediates keyed by their inputs
+
+    Parameters
+    ----------
+    cacheDir : str
+               directory holding the cached files, created if needed
+               (default = ~/.cache/GREATx)
+    maxBytes : int
+               total size above which least recently used files are
+               evicted (default = 2 GiB)
+
+    Attributes
+    ----------
+    pinned : set
+             keys fetched through this cache; they are never evicted by
+             it, as later stages of the same run may still read them
+
+    Example
+    --------
+    >>> cache = PipelineCache()
+    >>> key = cache.key('regDom', [fileDigest(lociFn)], cutOff=cutOff)
+    >>> regDomFn = cache.fetch(key, lambda fn: createRegDomsFileFromTSSs(lociFn, fn, cutOff))
+    """
+
+    def __init__(self, cacheDir=DEFAULT_CACHE_DIR, maxBytes=DEFAULT_CACHE_SIZE):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.pinned = set()
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def __repr__(self):
+        return 'PipelineCache(%r, %r)' % (self.cacheDir, self.maxBytes)
+
+    def key(self, stage, digests, **params):
+        """Returns the key of a stage given its input digests and parameters
+
+        digests are fileDigest()s of input files or keys of upstream stages.
+        """
+        h = hashlib.sha1()
+        h.update(stage.encode('utf-8'))
+        for digest in digests:
+            h.update(b'\0' + digest.encode('utf-8'))
+        for name in sorted(params):
+            h.update(('\0%s=%r' % (name, params[name])).encode('utf-8'))
+        return '%s.%s' % (stage, h.hexdigest())
+
+    def path(self, key):
+        return os.path.join(self.cacheDir, key)
+
+    def get(self, key):
+        """Returns the path of the cached file for key, or None."""
+        fn = self.path(key)
+        try:
+            os.utime(fn, None)  # mark as recently used
+        except OSError:
+            return None
+        return fn
+
+    def fetch(self, key, build):
+        """Returns the path of the file for key, building it if needed
+
+        build(fn) must write the stage's output to fn. It writes to a
+        temporary file in the cache directory, which is renamed into place
+        only once build returns, so readers never see a partial file.
+        """
+        self.pinned.add(key)
+        fn = self.get(key)
+        if fn is not None:
+            instrument.count('cacheHits')
+            return fn
+        instrument.count('cacheMisses')
+        fd, tmpFn = tempfile.mkstemp(prefix='.' + key + '.', dir=self.cacheDir)
+        os.close(fd)
+        try:
+            build(tmpFn)
+            os.chmod(tmpFn, 0o644)
+            os.rename(tmpFn, self.path(key))
+        finally:
+            if os.path.exists(tmpFn):
+                os.remove(tmpFn)
+        self.evict()
+        return self.path(key)
+
+    def evict(self):
+        """Removes least recently used files until the cache fits maxBytes,
+        keeping the pinned ones."""
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if name.startswith('.'):
+                continue
+            fn = os.path.join(self.cacheDir, name)
+            try:
+                stat = os.stat(fn)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            if name in self.pinned:
+                continue
+            try:
+                os.remove(os.path.join(self.cacheDir, name))
+            except OSError:
+                continue
+            total -= size
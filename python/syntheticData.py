@@ -0,0 +1,213 @@
+"""Synthetic genomes, ontologies and dart sets for benchmarking GREATx
+
+Genes are placed at random on the chromosomes of an assembly, in
+proportion to their sizes, and written as a loci file. Terms annotate
+random sets of genes whose sizes follow a log-normal distribution, as in
+real ontologies where a few terms are very broad and most are narrow, and
+are written as ontoToGene.canon and ontoTerms.canon files. A dart set
+puts part of its darts near the TSSs of the genes of a few enriched terms
+and spreads the rest uniformly over the genome. An antigap file masks a
+gap at the start of every chromosome.
+
+Everything is drawn from one seed, so a dataset can be regenerated
+anywhere from its parameters.
+
+Example
+--------
+$ python syntheticData.py --scale medium /tmp/synthetic
+"""
+import collections
+import json
+import os
+import sys
+import numpy as np
+from GREATx import getAssembly
+
+# (genes, terms, darts) of the named scales
+SCALES = collections.OrderedDict([\
+        ('small', dict(genes=2000, terms=1000, darts=1000)),\
+        ('medium', dict(genes=20000, terms=5000, darts=100000)),\
+        ('large', dict(genes=20000, terms=20000, darts=1000000))])
+
+MANIFEST = 'manifest.json'
+
+def syntheticLoci(assembly, nGenes, rng):
+    """Returns (geneIDs, chrNames, TSSPositions, strands, geneNames) of
+    nGenes genes placed uniformly over the genome, sorted by position."""
+    sizes = assembly.sizes
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    genomic = np.sort(rng.randint(0, offsets[-1], size=nGenes,\
+            dtype=np.int64))
+    chrCodes = np.searchsorted(offsets, genomic, side='right') - 1
+    TSSPositions = genomic - offsets[chrCodes]
+    chrNames = np.array(assembly.chrNames)[chrCodes]
+    strands = np.where(rng.rand(nGenes) < 0.5, '+', '-')
+    geneIDs = np.array([str(i) for i in range(1, nGenes + 1)])
+    geneNames = np.array(['GENE%d' % i for i in range(1, nGenes + 1)])
+    return geneIDs, chrNames, TSSPositions, strands, geneNames
+
+def syntheticOntology(nGenes, nTerms, rng, medianSize=20, sigma=1.5):
+    """Returns (termCodes, geneIdx) pairs annotating term termCodes[i] to
+    gene geneIdx[i]; term sizes are log-normal around medianSize, between
+    1 and a quarter of the genes."""
+    sizes = np.exp(np.log(medianSize) + sigma*rng.randn(nTerms))
+    sizes = np.clip(sizes.astype(np.int64), 1, max(nGenes//4, 1))
+    termCodes = np.repeat(np.arange(nTerms), sizes)
+    geneIdx = rng.randint(0, nGenes, size=len(termCodes))
+    # a gene is annotated to a term once
+    keys = np.unique(termCodes*np.int64(nGenes) + geneIdx)
+    return keys // nGenes, keys % nGenes
+
+def syntheticDarts(assembly, chrNames, TSSPositions, nDarts, rng,\
+        nearGenes=None, enrichment=0.5, spread=50000, width=50):
+    """Returns (chrNames, starts, ends, names) of nDarts darts
+
+    A fraction enrichment of the darts is drawn around the TSSs of the
+    genes indexed by nearGenes, at a normal distance of sd spread; the
+    others are uniform over the genome.
+    """
+    nNear = int(nDarts*enrichment) if nearGenes is not None and\
+            len(nearGenes) else 0
+    sizes = assembly.sizes
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    genomic = rng.randint(0, offsets[-1], size=nDarts - nNear,\
+            dtype=np.int64)
+    uniformCodes = np.searchsorted(offsets, genomic, side='right') - 1
+    dartChrNames = np.array(assembly.chrNames)[uniformCodes]
+    starts = genomic - offsets[uniformCodes]
+    if nNear:
+        genes = rng.choice(nearGenes, size=nNear)
+        nearStarts = TSSPositions[genes] +\
+                (spread*rng.randn(nNear)).astype(np.int64)
+        nearChrNames = chrNames[genes]
+        chrSizes = sizes[assembly.intern(nearChrNames)]
+        nearStarts = np.clip(nearStarts, 0, chrSizes - width)
+        dartChrNames = np.concatenate([dartChrNames, nearChrNames])
+        starts = np.concatenate([starts, nearStarts])
+    starts = np.maximum(starts, 0)
+    names = np.array(['dart.%d' % i for i in range(1, nDarts + 1)])
+    return dartChrNames, starts, starts + width, names
+
+def _writeLines(fn, columns):
+    with open(fn, 'w') as f:
+        for fields in zip(*[[str(v) for v in column] for column in columns]):
+            f.write("\t".join(fields) + "\n")
+
+def generate(outDir, genes=2000, terms=1000, darts=1000, assembly=None,\
+        seed=0, enrichedTerms=10, enrichment=0.5):
+    """Writes a synthetic dataset to outDir and returns its file names
+
+    Parameters
+    ----------
+    outDir : str
+             directory the files are written to, created if needed
+    genes, terms, darts : int
+                          number of genes, ontology terms and darts
+    assembly : Assembly or str
+               genome the genes and darts are placed on, see getAssembly
+               (default = DEFAULT_ASSEMBLY)
+    seed : int
+           seed of the random draws (default = 0)
+    enrichedTerms : int
+                    number of terms whose genes attract darts (default = 10)
+    enrichment : float
+                 fraction of darts near the genes of the enriched terms
+                 (default = 0.5)
+
+    Returns
+    -------
+    dict with the parameters and the file names lociFn, ontoToGeneFn,
+    ontoTermsFn, dartFn and antigapFn. It is also written to
+    outDir/manifest.json; when a manifest with the same parameters is
+    already there the files are reused.
+    """
+    assembly = getAssembly(assembly)
+    params = collections.OrderedDict([('genes', genes), ('terms', terms),\
+            ('darts', darts), ('assembly', assembly.name), ('seed', seed),\
+            ('enrichedTerms', enrichedTerms), ('enrichment', enrichment)])
+    files = collections.OrderedDict((name, os.path.join(outDir, fn)) for\
+            name, fn in [('lociFn', 'synthetic.loci'),\
+            ('ontoToGeneFn', 'ontoToGene.canon'),\
+            ('ontoTermsFn', 'ontoTerms.canon'), ('dartFn', 'darts.bed'),\
+            ('antigapFn', 'antigap.bed')])
+    manifest = collections.OrderedDict(params)
+    manifest.update(files)
+    manifestFn = os.path.join(outDir, MANIFEST)
+    if os.path.exists(manifestFn):
+        with open(manifestFn) as f:
+            if json.load(f) == json.loads(json.dumps(manifest)) and\
+                    all(os.path.exists(fn) for fn in files.values()):
+                return manifest
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+
+    rng = np.random.RandomState(seed)
+    geneIDs, chrNames, TSSPositions, strands, geneNames =\
+            syntheticLoci(assembly, genes, rng)
+    _writeLines(files['lociFn'], [geneIDs, chrNames, TSSPositions, strands,\
+            geneNames])
+
+    termCodes, geneIdx = syntheticOntology(genes, terms, rng)
+    termIDs = np.array(['GO:%07d' % (i + 1) for i in range(terms)])
+    _writeLines(files['ontoToGeneFn'], [termIDs[termCodes], geneIDs[geneIdx]])
+    _writeLines(files['ontoTermsFn'], [termIDs,\
+            ['synthetic term %d' % (i + 1) for i in range(terms)]])
+
+    nearGenes = np.unique(geneIdx[termCodes < enrichedTerms])
+    _writeLines(files['dartFn'], syntheticDarts(assembly, chrNames,\
+            TSSPositions, darts, rng, nearGenes, enrichment))
+
+    # everything but the first 1% of each chromosome
+    sizes = assembly.sizes
+    _writeLines(files['antigapFn'], [assembly.chrNames, sizes//100, sizes])
+
+    with open(manifestFn, 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    return manifest
+
+def addScaleOptions(parser):
+    """Adds the dataset options of generate to an OptionParser."""
+    parser.add_option("--scale", dest="scale", default='small',
+                      choices=list(SCALES),
+                      help="preset sizes: %s (default: %%default)" %\
+                           ", ".join("%s = %d genes, %d terms, %d darts" %\
+                           (name, s['genes'], s['terms'], s['darts'])\
+                           for name, s in SCALES.items()))
+    parser.add_option("--genes", dest="genes", type="int", default=None,
+                      help="number of genes (overrides --scale)")
+    parser.add_option("--terms", dest="terms", type="int", default=None,
+                      help="number of ontology terms (overrides --scale)")
+    parser.add_option("--darts", dest="darts", type="int", default=None,
+                      help="number of darts (overrides --scale)")
+    parser.add_option("--assembly", dest="assembly", default=None,
+                      help="assembly name (hg18, hg19, hg38, mm10) or "
+                           "chrom.sizes file (default: hg18)")
+    parser.add_option("--seed", dest="seed", type="int", default=0,
+                      help="seed of the random draws (default: %default)")
+
+def scaleParams(options):
+    """Returns the generate keyword arguments of parsed scale options."""
+    params = dict(SCALES[options.scale])
+    for name in ('genes', 'terms', 'darts'):
+        if getattr(options, name) is not None:
+            params[name] = getattr(options, name)
+    params['assembly'] = options.assembly
+    params['seed'] = options.seed
+    return params
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] <outDir>",
+                          description=("Writes a synthetic loci file, "
+                                       "ontology, dart set and antigap file "
+                                       "to outDir."))
+    addScaleOptions(parser)
+    (options, args) = parser.parse_args()
+    if (len(args) != 1):
+        parser.print_usage()
+        sys.exit(1)
+
+    manifest = generate(args[0], **scaleParams(options))
+    for name, value in manifest.items():
+        print("%-14s %s" % (name, value))
@@ -0,0 +1,607 @@
+"""Deterministic checks of the GREATx pipeline on a small synthetic dataset"""
+import collections
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+from scipy.stats import beta as betaDist, binom
+import GREATx
+
+def _byTerm(termIDs, values):
+    return dict(zip([str(termID) for termID in termIDs], np.asarray(values)))
+
+def _assertSameScores(termIDs, logPvals, scores):
+    expected = _byTerm(scores.termIDs, scores.logPvals)
+    found = _byTerm(termIDs, logPvals)
+    assert sorted(found) == sorted(expected)
+    for termID, logP in expected.items():
+        assert found[termID] == pytest.approx(logP, rel=1e-9, abs=1e-12,\
+                nan_ok=True)
+
+@pytest.mark.parametrize('whichBeta', [1, 2, 3, 4, 5])
+def test_sweepMatchesRun(dataset, whichBeta):
+    cutOffs, means, sds = [1000000, 500000], [0], [333333, 100000]
+    result = GREATx.sweep(dataset['lociFn'], dataset['ontoToGeneFn'],\
+            dataset['dartFn'], cutOffs, means, sds, [whichBeta])
+    for cutOff in cutOffs:
+        for sd in sds:
+            scores, table = GREATx.run(dataset['lociFn'],\
+                    dataset['ontoToGeneFn'], dataset['dartFn'], cutOff, 0, sd,\
+                    whichBeta)
+            rows = result.point(cutOff, 0, sd, whichBeta)
+            _assertSameScores(result.termIDs[rows], result.logPvals[rows],\
+                    scores)
+            assert set(result.corrections[rows].tolist()) <= {scores.nTerms}
+
+def test_permutationNullDropsDartsWithoutBackground(dataset, capsys):
+    regDoms = GREATx.RegDomIndex.fromLoci(dataset['lociFn'], 1000000)
+    ontology = GREATx.OntologyIndex(regDoms, dataset['ontoToGeneFn'])
+    darts = GREATx.DartSet.fromFile(dataset['dartFn'], regDoms.assembly)
+    wgtRegDom = GREATx.WeightedRegDom(1000000, 0, 333333)
+    whole = GREATx.GenomeIntervals.wholeGenome(regDoms.assembly)
+    kept = whole.chrNames != 'chr1'
+    background = GREATx.GenomeIntervals(whole.chrNames[kept],\
+            whole.starts[kept], whole.ends[kept], regDoms.assembly)
+    onChr1 = darts.chrNames == 'chr1'
+    assert 0 < onChr1.sum() < len(darts)
+
+    null = GREATx.PermutationNull(regDoms, ontology, darts, wgtRegDom, 5,\
+            background)
+    assert null.droppedDarts == onChr1.sum()
+    assert null.nDarts == len(darts) - onChr1.sum()
+    assert 'dropped %d darts' % onChr1.sum() in capsys.readouterr().err
+
+    others = GREATx.DartSet(darts.chrNames[~onChr1], darts.starts[~onChr1],\
+            darts.ends[~onChr1], darts.names[~onChr1], regDoms.assembly)
+    expected = GREATx.PermutationNull(regDoms, ontology, others, wgtRegDom, 5,\
+            background)
+    assert expected.droppedDarts == 0
+    np.testing.assert_array_equal(null.observed.logPvals,\
+            expected.observed.logPvals)
+    rng = np.random.default_rng(0)
+    assert null.exceedances(rng, 5).shape == (len(ontology.terms),)
+
+def test_overlapSelectUsesTheGivenAssembly(tmp_path):
+    regDomFn, dartFn = str(tmp_path / 'regDom.bed'), str(tmp_path / 'darts.bed')
+    with open(regDomFn, 'w') as f:
+        f.write("chrM\t0\t16000\tmt-Co1\t17708\t+\t5328\n")
+    with open(dartFn, 'w') as f:
+        f.write("chrM\t1000\t1050\tdart.1\n")
+    default = GREATx.getAssembly()
+    nDefault = len(default)
+    pairs = GREATx.overlapSelect(regDomFn, dartFn, assembly='mm10')
+    assert len(pairs) == 1
+    assert pairs.darts.assembly is GREATx.getAssembly('mm10')
+    assert pairs.regDoms.assembly is pairs.darts.assembly
+    assert len(default) == nDefault
+
+def test_lociReprsRoundTrip():
+    line = "17708\tchrM\t5328\t+\tmt-Co1\n"
+    loci = GREATx.Loci(line)
+    assert str(eval(repr(loci), vars(GREATx))) == str(loci)
+    region = GREATx.LociRegulatoryRegion(line, cutOff=10000)
+    assert repr(region) ==\
+            "LociRegulatoryRegion('17708\\tchrM\\t5328\\t+\\tmt-Co1', cutOff=10000)"
+    assert str(eval(repr(region), vars(GREATx))) == str(region)
+
+# geneID, chromosome, TSS, strand, gene name
+RULE_LOCI = [('1', 'chr1', 400000, '-', 'B'), ('2', 'chr1', 100000, '+', 'A'),\
+        ('3', 'chr1', 2000000, '+', 'C'), ('4', 'chr2', 3000, '+', 'D'),\
+        ('5', 'chr1', 2002000, '-', 'E')]
+
+# worked out by hand with maxExtension 1 Mb, basal 5 kb up and 1 kb down
+RULE_DOMAINS = {
+    'basalPlusExtension': {'A': (0, 399000), 'B': (101000, 1400000),\
+            'C': (1000000, 2001000), 'E': (2001000, 3002000),\
+            'D': (0, 1003000)},
+    'twoClosest': {'A': (0, 400000), 'B': (100000, 1400000),\
+            'C': (1000000, 2002000), 'E': (2000000, 3002000),\
+            'D': (0, 1003000)},
+    'oneClosest': {'A': (0, 250000), 'B': (250000, 1200000),\
+            'C': (1200000, 2001000), 'E': (2001000, 3002000),\
+            'D': (0, 1003000)}}
+
+@pytest.mark.parametrize('association', sorted(RULE_DOMAINS))
+def test_associationRuleDomains(tmp_path, association):
+    lociFn = str(tmp_path / 'rule.loci')
+    with open(lociFn, 'w') as f:
+        for fields in RULE_LOCI:
+            f.write("\t".join(str(field) for field in fields) + "\n")
+    regDoms = GREATx.RegDomIndex.fromAssociationRule(lociFn, 'hg18',\
+            association, maxExtension=1000000, basalUpstream=5000,\
+            basalDownstream=1000)
+    domains = dict((geneName, (start, end)) for geneName, start, end in\
+            zip(regDoms.geneNames.tolist(), regDoms.starts.tolist(),\
+            regDoms.ends.tolist()))
+    assert domains == RULE_DOMAINS[association]
+    assert regDoms.geneNames.tolist() == ['A', 'B', 'C', 'E', 'D']
+
+def _termGenes(ontoToGeneFn):
+    termGenes = collections.defaultdict(set)
+    with open(ontoToGeneFn) as f:
+        for line in f:
+            termID, geneID = line.split()
+            termGenes[str(int(termID.split(':')[1]))].add(geneID)
+    return termGenes
+
+def _mergedLength(intervals):
+    total, end = 0, None
+    for start, stop in sorted(intervals):
+        if end is not None and start < end:
+            start = end
+        if stop > start:
+            total += stop - start
+            end = stop
+    return total
+
+@pytest.fixture(scope='module')
+def binomial(dataset):
+    regDoms = GREATx.RegDomIndex.fromLoci(dataset['lociFn'], 500000)
+    return GREATx.BinomialEnrichment(GREATx.OntologyIndex(regDoms,\
+            dataset['ontoToGeneFn'], dataset['antigapFn']))
+
+def test_binomialMatchesScipy(dataset, binomial):
+    darts = GREATx.DartSet.fromFile(dataset['dartFn'])
+    scores = binomial.score(darts)
+    hits = np.asarray(scores.alphas)
+    # P(X >= k) for X ~ Binomial(n, p)
+    expected = binom.logsf(hits - 1, len(darts), binomial.fractions)
+    assert (hits > 0).sum() > 10
+    kept = expected > -600
+    np.testing.assert_allclose(scores.logPvals[kept], expected[kept],\
+            rtol=1e-9, atol=1e-12)
+    assert (scores.logPvals[hits == 0] == 0).all()
+
+def test_binomialHitsAndCoverageByBruteForce(dataset, binomial):
+    regDoms = binomial.ontology.regDoms
+    darts = GREATx.DartSet.fromFile(dataset['dartFn'])
+    termGenes = _termGenes(dataset['ontoToGeneFn'])
+    sizes = regDoms.assembly.chromSizes()
+    # the antigap file keeps all but the first 1% of each chromosome
+    kept = dict((chrName, (size//100, size)) for chrName, size in\
+            sizes.items() if size)
+    domains = list(zip(regDoms.chrNames.tolist(), regDoms.starts.tolist(),\
+            regDoms.ends.tolist(), regDoms.geneIDs.tolist()))
+    hits = binomial.hitCounts(darts)
+    for k, termID in enumerate(binomial.termIDs.tolist()):
+        genes = termGenes[termID]
+        termDomains = [(c, s, e) for c, s, e, g in domains if g in genes]
+        hitDarts = sum(any(c == chrName and s <= position < e for\
+                c, s, e in termDomains) for chrName, position in\
+                zip(darts.chrNames.tolist(), darts.positions.tolist()))
+        assert hits[k] == hitDarts
+        covered = sum(_mergedLength([(max(s, kept[c][0]), min(e, kept[c][1]))\
+                for c, s, e in termDomains if c == chrName])\
+                for chrName in set(c for c, s, e in termDomains))
+        assert binomial.fractions[k] == pytest.approx(covered/float(\
+                sum(end - start for start, end in kept.values())), rel=1e-12)
+
+def test_columnsRoundTrip(tmp_path):
+    fn = str(tmp_path / 'columns.bin')
+    columns = [('ints', np.arange(7, dtype=np.int64)),\
+            ('bigEndian', np.linspace(0, 1, 5).astype('>f8')),\
+            ('matrix', np.arange(12, dtype=np.int32).reshape(3, 4)),\
+            ('names', np.array(['chr1', 'chrX', 'chr10'])),\
+            ('bytes', np.array([b'a', b'bcd'])), ('empty', np.zeros(0))]
+    GREATx.writeColumns(fn, 'test', columns)
+    mapped = GREATx.mapColumns(fn, 'test')
+    assert list(mapped) == [name for name, array in columns]
+    for name, array in columns:
+        assert mapped[name].dtype == array.dtype
+        np.testing.assert_array_equal(mapped[name], array)
+    with pytest.raises(ValueError):
+        GREATx.mapColumns(fn, 'TermDartTSSTable')
+
+def test_binaryTableRoundTrip(dataset, tmp_path):
+    scores, table = GREATx.run(dataset['lociFn'], dataset['ontoToGeneFn'],\
+            dataset['dartFn'], 1000000, 0, 333333, 5)
+    binaryFn = str(tmp_path / 'table.bin')
+    table.writeBinary(binaryFn)
+    mapped = GREATx.TermDartTSSTable.load(binaryFn)
+    assert len(mapped) == len(table) > 0
+    for name in GREATx.TermDartTSSTable._binaryColumns +\
+            ('geneNames', 'geneIDs'):
+        expected, found = getattr(table, name), getattr(mapped, name)
+        assert found.dtype == expected.dtype, name
+        np.testing.assert_array_equal(found, expected, err_msg=name)
+    assert not mapped.weights.flags.writeable
+    for whichBeta in (1, 5):
+        found = GREATx.scoreTerms(mapped, whichBeta)
+        _assertSameScores(found.termIDs, found.logPvals,\
+                GREATx.scoreTerms(table, whichBeta))
+
+@pytest.mark.parametrize('antigap', [False, True])
+@pytest.mark.parametrize('whichBeta', [1, 2, 4, 5])
+def test_scorePairsMatchesScoreTerms(dataset, whichBeta, antigap):
+    regDoms = GREATx.RegDomIndex.fromLoci(dataset['lociFn'], 1000000)
+    ontology = GREATx.OntologyIndex(regDoms, dataset['ontoToGeneFn'],\
+            dataset['antigapFn'] if antigap else None)
+    pairs = regDoms.join(GREATx.DartSet.fromFile(dataset['dartFn'],\
+            regDoms.assembly))
+    weights = GREATx.pairWeights(pairs,\
+            GREATx.WeightedRegDom(1000000, 0, 333333))
+    expected, table = GREATx.scoreWeightedPairs(pairs, weights, ontology,\
+            whichBeta, wantTable=True)
+    scores = ontology.scorePairs(pairs, weights, whichBeta)
+    assert table is not None and scores.nTerms == expected.nTerms
+    assert [str(termID) for termID in scores.termIDs] ==\
+            [str(termID) for termID in expected.termIDs]
+    for name in ('alphas', 'betas', 'xs', 'logPvals'):
+        np.testing.assert_allclose(getattr(scores, name),\
+                getattr(expected, name), rtol=1e-9, atol=1e-12, err_msg=name)
+    with pytest.raises(ValueError):
+        ontology.scorePairs(pairs, weights, 3)
+
+def test_geneTermMatrixCacheRoundTrip(dataset, tmp_path):
+    canonFn = str(tmp_path / 'ontoToGene.canon')
+    with open(dataset['ontoToGeneFn']) as f:
+        text = f.read()
+    with open(canonFn, 'w') as f:
+        f.write(text)
+    expected = collections.defaultdict(list)
+    for line in text.splitlines():
+        termID, geneID = line.split()
+        expected[geneID].append(int(termID.split(':')[1]))
+
+    parsed = GREATx.GeneTermMatrix.load(canonFn)
+    assert os.path.exists(canonFn + GREATx.GeneTermMatrix.CACHE_SUFFIX)
+    cached = GREATx.GeneTermMatrix.load(canonFn)
+    assert not cached.indices.flags.writeable
+    for name in ('geneIDs', 'termIDs', 'indptr', 'indices'):
+        np.testing.assert_array_equal(getattr(cached, name),\
+                getattr(parsed, name), err_msg=name)
+    # fromDict numbers the terms in gene order rather than file order
+    for geneTerms in (parsed, cached, GREATx.GeneTermMatrix.fromDict(expected)):
+        assert geneTerms.geneTerms() == expected
+
+def _scanEveryBase(wgtRegDom, TSSs):
+    """Returns {chrName: (first base scanned, weight of every base within
+    cutOff of a TSS)}"""
+    scans = {}
+    for chrName in set(tss.chrName for tss in TSSs):
+        TSSPositions = np.array([tss.position for tss in TSSs\
+                if tss.chrName == chrName])
+        positions = np.arange(TSSPositions.min() - wgtRegDom.cutOff,\
+                TSSPositions.max() + wgtRegDom.cutOff + 1)
+        offsets = TSSPositions[None, :] - positions[:, None]
+        scans[chrName] = (positions[0], np.where(np.abs(offsets) <=\
+                wgtRegDom.cutOff, np.exp(-0.5*((offsets - wgtRegDom.mean)/\
+                wgtRegDom.sd)**2), 0.0).sum(axis=1))
+    return scans
+
+def test_bestWeightedDartMatchesAScanOfEveryBase():
+    rng = np.random.default_rng(0)
+    # mean-shift stops short of the mode at 272 on this flat top
+    cases = [(44, -2.098, 5.335, {'chr1': [69, 141, 179, 262, 273]})]
+    for i in range(300):
+        cases.append((int(rng.integers(1, 200)), rng.uniform(-10, 10),\
+                rng.uniform(0.5, 150), dict((chrName,\
+                rng.integers(0, 2000, rng.integers(1, 20)).tolist())\
+                for chrName in ('chr1', 'chr2')[:rng.integers(1, 3)])))
+    for cutOff, mean, sd, chrPositions in cases:
+        wgtRegDom = GREATx.WeightedRegDom(cutOff, mean, sd)
+        TSSs = [GREATx.TSS(position, chrName=chrName) for chrName, positions\
+                in chrPositions.items() for position in positions]
+        dart = wgtRegDom.bestWeightedDart(TSSs)
+        scans = _scanEveryBase(wgtRegDom, TSSs)
+        heaviest = max(weights.max() for start, weights in scans.values())
+        start, weights = scans[dart.chrName]
+        assert dart.weight == pytest.approx(heaviest, rel=1e-12)
+        assert weights[dart.position - start] == pytest.approx(heaviest,\
+                rel=1e-12)
+
+@pytest.fixture(scope='module')
+def baselineAssociations(dataset, tmp_path_factory):
+    """The association file of the baseline's file by file pipeline"""
+    tmp = tmp_path_factory.mktemp('baseline')
+    regDomFn, mergedFn, wgtFn, SRFtoTermsFn, ontoToGeneFn = [str(tmp / name)\
+            for name in ('regDom.bed', 'merged', 'darts.wgt',\
+            'SRFtoTerms.data', 'ontoToGene.canon')]
+    # genes ending in 7 lose their terms, so some pairs are UNKNOWN
+    with open(dataset['ontoToGeneFn']) as f:
+        with open(ontoToGeneFn, 'w') as out:
+            out.writelines(line for line in f if not line.rstrip().endswith('7'))
+    GREATx.createRegDomsFileFromTSSs(dataset['lociFn'], regDomFn, 1000000)
+    GREATx.overlapSelect(regDomFn, dataset['dartFn'], mergedFn)
+    GREATx.assignWeights(1000000, 0, 333333, mergedFn, wgtFn)
+    GREATx.AssociationMaker(wgtFn, ontoToGeneFn, regDomFn)\
+            .writeOutput(SRFtoTermsFn)
+    return SRFtoTermsFn
+
+def _baselinePvals(lineObjects, whichBeta):
+    """Returns ({termID: p-value}, Bonferroni factor) computed one term at
+    a time as the baseline's main did"""
+    termIDs = list(set(lineObject.termID for lineObject in lineObjects))
+    dartMaxWeights = {}
+    for lineObject in lineObjects:
+        dartMaxWeights[lineObject.dartName] = max(lineObject.weight,\
+                dartMaxWeights.get(lineObject.dartName, 0.0))
+    pvals = {}
+    for termID in termIDs:
+        if termID == 'UNKNOWN':
+            continue
+        termIDObjects = [lineObject for lineObject in lineObjects\
+                if lineObject.termID == termID]
+        weights = [termIDObject.weight for termIDObject in termIDObjects]
+        alpha = sum(weights)
+        x = termIDObjects[0].percentCoverage
+        if whichBeta == 1:
+            beta = len(termIDObjects) - alpha
+        elif whichBeta == 2:
+            beta = len(termIDObjects)*max(weights) - alpha
+        elif whichBeta == 3:
+            wgtRegDom = GREATx.WeightedRegDom(cutOff=1000000, mean=0,\
+                    sd=333333)
+            termTSSs = [GREATx.TSS(position=termIDObject.TSSPosition,\
+                    chrName=termIDObject.chrName)\
+                    for termIDObject in termIDObjects]
+            beta = len(termIDObjects)*wgtRegDom.bestWeightedDart(termTSSs,\
+                    chromosomes=GREATx.HUMAN_CHROMOSOMES).weight
+        elif whichBeta == 4:
+            dartWeights = collections.defaultdict(float)
+            for termIDObject in termIDObjects:
+                dartWeights[termIDObject.dartName] += termIDObject.weight
+            beta = len(dartWeights)*max(dartWeights.values()) - alpha
+        elif whichBeta == 5:
+            beta = sum(dartMaxWeights[termIDObject.dartName]\
+                    for termIDObject in termIDObjects) - alpha
+        pvals[termID] = betaDist.cdf(x, alpha, beta)
+    return pvals, len(termIDs)
+
+@pytest.mark.parametrize('whichBeta', [1, 2, 3, 4, 5])
+def test_scoreTermsMatchesTheBaselineLoop(baselineAssociations, whichBeta):
+    with open(baselineAssociations) as f:
+        lineObjects = [GREATx.TermDartTSSTriple(line) for line in f]
+    assert 'UNKNOWN' in set(lineObject.termID for lineObject in lineObjects)
+    expected, correction = _baselinePvals(lineObjects, whichBeta)
+    scores = GREATx.scoreTerms(\
+            GREATx.TermDartTSSTable.fromFile(baselineAssociations), whichBeta)
+    assert scores.nTerms == correction
+    found = dict(zip(scores.termIDs.tolist(), scores.pvals.tolist()))
+    assert sorted(found) == sorted(expected)
+    assert sum(pval > 1e-300 for pval in expected.values()) > 50
+    for termID, pval in expected.items():
+        assert found[termID] == pytest.approx(pval, rel=1e-9, abs=1e-300,\
+                nan_ok=True)
+
+def _singleRunOutput(dataset, ontoToGeneFn, ontoTermsFn, dartFn, outFn,\
+        whichBeta=5):
+    scores, table = GREATx.run(dataset['lociFn'], ontoToGeneFn, dartFn,\
+            500000, 0, 100000, whichBeta, antigapFn=dataset['antigapFn'],\
+            wantTable=False)
+    GREATx.writeRankedTerms(scores, GREATx.buildOntoTermsDict(ontoTermsFn),\
+            outFn, scores.nTerms)
+    with open(outFn) as f:
+        return f.read()
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_runBatchMatchesSingleRuns(dataset, tmp_path, processes):
+    with open(dataset['dartFn']) as f:
+        lines = f.readlines()
+    dartFns = []
+    for k in range(3):
+        dartFns.append(str(tmp_path / ('set%d.bed' % k)))
+        with open(dartFns[-1], 'w') as f:
+            f.writelines(lines[k::3])
+    outFns = GREATx.runBatch(dataset['lociFn'], dataset['ontoToGeneFn'],\
+            dataset['ontoTermsFn'], dartFns, str(tmp_path / 'out'), 500000,\
+            0, 100000, 5, antigapFn=dataset['antigapFn'], processes=processes)
+    assert len(outFns) == 3
+    for dartFn, outFn in zip(dartFns, outFns):
+        expected = _singleRunOutput(dataset, dataset['ontoToGeneFn'],\
+                dataset['ontoTermsFn'], dartFn, str(tmp_path / 'single.out'))
+        assert 'synthetic term' in expected
+        with open(outFn) as f:
+            assert f.read() == expected
+
+@pytest.mark.parametrize('processes,whichBeta', [(1, 3), (2, 5)])
+def test_runOntologiesMatchesSingleRuns(dataset, tmp_path, processes,\
+        whichBeta):
+    with open(dataset['ontoToGeneFn']) as f:
+        lines = f.readlines()
+    ontologies = [('all', dataset['ontoToGeneFn'], dataset['ontoTermsFn'])]
+    for k in range(2):
+        ontologies.append(('half%d' % k, str(tmp_path / ('half%d.canon' % k)),\
+                dataset['ontoTermsFn']))
+        with open(ontologies[-1][1], 'w') as f:
+            f.writelines(lines[k::2])
+    outFns = GREATx.runOntologies(dataset['lociFn'], ontologies,\
+            dataset['dartFn'], str(tmp_path / 'out'), 500000, 0, 100000,\
+            whichBeta, antigapFn=dataset['antigapFn'], processes=processes)
+    assert [os.path.basename(outFn) for outFn in outFns] ==\
+            ['all.out', 'half0.out', 'half1.out']
+    for (name, ontoToGeneFn, ontoTermsFn), outFn in zip(ontologies, outFns):
+        expected = _singleRunOutput(dataset, ontoToGeneFn, ontoTermsFn,\
+                dataset['dartFn'], str(tmp_path / 'single.out'), whichBeta)
+        assert 'synthetic term' in expected
+        with open(outFn) as f:
+            assert f.read() == expected
+
+def _eagerAssociationLines(wgtFn, ontoToGeneFn, regDomFn, genomeSize):
+    """The output lines of the baseline AssociationMaker, which read every
+    pair into memory before writing anything"""
+    with open(wgtFn) as f:
+        pairs = [line.split("\t") for line in f]
+    genetoterms = collections.defaultdict(list)
+    with open(ontoToGeneFn) as f:
+        for line in f:
+            termID, geneID = line.split()
+            genetoterms[geneID].append(str(int(termID.split(':')[1])))
+    genes = set(pair[4] for pair in pairs)
+    termRanges = collections.defaultdict(list)
+    with open(regDomFn) as f:
+        for line in f:
+            line = line.split()
+            if line[4] in genes:
+                for term in genetoterms[line[4]]:
+                    termRanges[term].append((line[0], int(line[1]),\
+                            int(line[2])))
+    coverage = dict((term, sum(_mergedLength([(start, end) for c, start, end\
+            in ranges if c == chrName]) for chrName in set(c for c, start, end\
+            in ranges))/float(genomeSize)) for term, ranges in termRanges.items())
+    lines = []
+    for pair in pairs:
+        pair = "\t".join(pair).rstrip("\n")
+        terms = genetoterms[pair.split("\t")[4]]
+        if terms == []:
+            lines.append("UNKNOWN\t" + pair + "\t0.0\n")
+        for term in terms:
+            lines.append(term + "\t" + pair + "\t" + str(coverage[term]) + "\n")
+    return lines
+
+@pytest.fixture(scope='module')
+def associationInputs(dataset, tmp_path_factory):
+    """(wgtFn, regDomFn) of the baseline file by file stages, and the wgt
+    file of the first half of the darts"""
+    tmp = tmp_path_factory.mktemp('associations')
+    regDomFn, mergedFn, wgtFn, halfFn, halfWgtFn = [str(tmp / name) for name\
+            in ('regDom.bed', 'merged', 'darts.wgt', 'half.bed', 'half.wgt')]
+    GREATx.createRegDomsFileFromTSSs(dataset['lociFn'], regDomFn, 1000000)
+    with open(dataset['dartFn']) as f:
+        lines = f.readlines()
+    with open(halfFn, 'w') as f:
+        f.writelines(lines[:len(lines)//2])
+    for dartFn, outFn in ((dataset['dartFn'], wgtFn), (halfFn, halfWgtFn)):
+        GREATx.overlapSelect(regDomFn, dartFn, mergedFn)
+        GREATx.assignWeights(1000000, 0, 333333, mergedFn, outFn)
+    return wgtFn, halfWgtFn, regDomFn
+
+def _associationLines(maker, tmp_path):
+    outFn = str(tmp_path / 'associations')
+    maker.writeOutput(outFn)
+    with open(outFn) as f:
+        return f.readlines()
+
+def test_streamedAssociationsMatchTheEagerBaseline(dataset, tmp_path,\
+        associationInputs):
+    wgtFn, halfWgtFn, regDomFn = associationInputs
+    maker = GREATx.AssociationMaker(wgtFn, dataset['ontoToGeneFn'], regDomFn)
+    expected = _eagerAssociationLines(wgtFn, dataset['ontoToGeneFn'],\
+            regDomFn, maker.ontology.genomeSize)
+    assert len(expected) > 1000
+    assert maker.ontology.genomeSize == sum(GREATx.HUMAN_CHROMOSOME_SIZES)
+    assert _associationLines(maker, tmp_path) == expected
+    # a one-shot iterator of pairs streams through once when genes is given
+    pairs = maker.readDartWeightsFile(wgtFn)
+    streamed = GREATx.AssociationMaker(pairs, maker.ontology,\
+            genes=maker.readDartWeightsGenes(wgtFn))
+    assert [maker.buildLine(*association) for association in streamed] ==\
+            expected
+
+def test_associationMakersShareNoState(dataset, tmp_path, associationInputs):
+    wgtFn, halfWgtFn, regDomFn = associationInputs
+    trimmedFn = str(tmp_path / 'trimmed.canon')
+    with open(dataset['ontoToGeneFn']) as f:
+        with open(trimmedFn, 'w') as out:
+            out.writelines(line for line in f if not line.rstrip().endswith('7'))
+    first = GREATx.AssociationMaker(halfWgtFn, dataset['ontoToGeneFn'],\
+            regDomFn)
+    before = _associationLines(first, tmp_path)
+    coverage = dict(first.termtocoverage)
+    second = GREATx.AssociationMaker(wgtFn, trimmedFn, regDomFn)
+    assert first.termtocoverage is not second.termtocoverage
+    assert first.genetoterms is not second.genetoterms
+    assert dict(first.termtocoverage) == coverage
+    assert _associationLines(first, tmp_path) == before
+    assert _associationLines(second, tmp_path) == _eagerAssociationLines(\
+            wgtFn, trimmedFn, regDomFn, second.ontology.genomeSize)
+    assert before == _eagerAssociationLines(halfWgtFn,\
+            dataset['ontoToGeneFn'], regDomFn, first.ontology.genomeSize)
+
+# AssociationMaker output of three darts: d1 at 2000 lies in the
+# overlapping domains of g1 (terms 9 and 10) and g2 (term 9), d2 only in
+# g2's and d3 in that of g3, which has no terms
+HAND_ASSOCIATIONS = """\
+9\tchr1\td1\t2000\tg1\t1\t1000\t0.5\t0.3
+10\tchr1\td1\t2000\tg1\t1\t1000\t0.5\t0.1
+9\tchr1\td1\t2000\tg2\t2\t5000\t0.25\t0.3
+9\tchr1\td2\t6000\tg2\t2\t5000\t0.625\t0.3
+UNKNOWN\tchr2\td3\t8000\tg3\t3\t9000\t0.125\t0.0
+"""
+
+@pytest.fixture
+def handTable(tmp_path):
+    tripleFn = str(tmp_path / 'hand.data')
+    with open(tripleFn, 'w') as f:
+        f.write(HAND_ASSOCIATIONS)
+    return GREATx.TermDartTSSTable.fromFile(tripleFn)
+
+def test_tableRowsAreSortedByTermInFileOrder(handTable, tmp_path):
+    table = handTable
+    # term ids sort as strings
+    assert table.termIDs.tolist() == ['10', '9', 'UNKNOWN']
+    assert table.termCodes.tolist() == [0, 1, 1, 1, 2]
+    assert table.termOffsets.tolist() == [0, 1, 4, 5]
+    assert table.dartNames.tolist() == ['d1', 'd2', 'd3']
+    assert table.dartCodes.tolist() == [0, 0, 0, 1, 2]
+    assert table.chrNames.tolist() == ['chr1', 'chr2']
+    assert table.chrCodes.tolist() == [0, 0, 0, 0, 1]
+    assert table.dartPositions.tolist() == [2000, 2000, 2000, 6000, 8000]
+    assert table.geneNames.tolist() == ['g1', 'g1', 'g2', 'g2', 'g3']
+    assert table.geneIDs.tolist() == ['1', '1', '2', '2', '3']
+    assert table.TSSPositions.tolist() == [1000, 1000, 5000, 5000, 9000]
+    assert table.weights.tolist() == [0.5, 0.5, 0.25, 0.625, 0.125]
+    assert table.percentCoverages.tolist() == [0.1, 0.3, 0.3, 0.3, 0.0]
+    assert [(termID, rows.start, rows.stop) for termID, rows in\
+            table.iterTerms()] == [('10', 0, 1), ('9', 1, 4), ('UNKNOWN', 4, 5)]
+
+    onAssembly = GREATx.TermDartTSSTable.fromFile(str(tmp_path / 'hand.data'),\
+            'hg18')
+    assert onAssembly.chrCodes.tolist() ==\
+            GREATx.getAssembly('hg18').intern(table.chrNames[table.chrCodes])\
+            .tolist()
+    assert onAssembly.chrNames[onAssembly.chrCodes].tolist() ==\
+            ['chr1', 'chr1', 'chr1', 'chr1', 'chr2']
+
+def test_dartAggregatesOfTheHandBuiltTable(handTable):
+    aggregates = GREATx.DartAggregateIndex(handTable)
+    # (term, dart) pairs: (10, d1), (9, d1), (9, d2), (UNKNOWN, d3)
+    assert aggregates.termDartTermCodes.tolist() == [0, 1, 1, 2]
+    assert aggregates.termDartDartCodes.tolist() == [0, 0, 1, 2]
+    assert aggregates.termDartWeights.tolist() == [0.5, 0.75, 0.625, 0.125]
+    assert aggregates.termDartOffsets.tolist() == [0, 1, 3, 4]
+    assert aggregates.dartMaxWeights.tolist() == [0.5, 0.625, 0.125]
+    assert aggregates.dartWeightSums.tolist() == [1.25, 0.625, 0.125]
+    assert aggregates.dartChrCodes.tolist() == [0, 0, 1]
+    assert aggregates.dartPositions.tolist() == [2000, 6000, 8000]
+    assert aggregates.termDartSlice(1) == slice(1, 3)
+
+    # term 10: 1 pair, 1 dart, alpha 0.5; term 9: 3 pairs, 2 darts,
+    # alpha 1.375, heaviest pair 0.625, heaviest dart 0.75
+    expected = {1: [0.5, 1.625], 2: [0.0, 0.5], 4: [0.0, 0.125],\
+            5: [0.0, 0.25]}
+    for whichBeta, betas in expected.items():
+        scores = GREATx.scoreTerms(handTable, whichBeta, aggregates)
+        assert scores.termIDs.tolist() == ['10', '9']
+        assert scores.alphas.tolist() == [0.5, 1.375]
+        assert scores.betas.tolist() == betas
+        assert scores.xs.tolist() == [0.1, 0.3]
+        assert scores.nTerms == 3
+
+def _rankedOutput(scores, ontoTermsFn, outFn):
+    GREATx.writeRankedTerms(scores, GREATx.buildOntoTermsDict(ontoTermsFn),\
+            outFn, scores.nTerms)
+    with open(outFn) as f:
+        return f.read()
+
+@pytest.mark.parametrize('inMemory', [False, True])
+def test_commandLineScoresBeta3WithItsOwnKernel(dataset, tmp_path, inMemory):
+    SRFtoTermsFn, outFn = str(tmp_path / 'SRFtoTerms.data'),\
+            str(tmp_path / 'out.txt')
+    subprocess.check_call([sys.executable, os.path.join(os.path.dirname(\
+            os.path.abspath(__file__)), 'GREATx.py'), '--cache-dir',\
+            str(tmp_path / 'cache')] + (['--in-memory'] if inMemory else []) +\
+            [dataset['lociFn'], dataset['ontoToGeneFn'], dataset['dartFn'],\
+            SRFtoTermsFn, outFn, '500000', '0', '100000', '3',\
+            dataset['ontoTermsFn']], stdout=subprocess.DEVNULL)
+    with open(outFn) as f:
+        output = f.read()
+    table = GREATx.TermDartTSSTable.fromFile(SRFtoTermsFn)
+    # the best dart is weighed with the kernel of the run's own weights,
+    # not the baseline's fixed 1e6/0/333333 one
+    assert output == _rankedOutput(GREATx.scoreTerms(table, 3,\
+            wgtRegDom=GREATx.WeightedRegDom(500000, 0, 100000)),\
+            dataset['ontoTermsFn'], str(tmp_path / 'expected.txt'))
+    assert output != _rankedOutput(GREATx.scoreTerms(table, 3),\
+            dataset['ontoTermsFn'], str(tmp_path / 'baseline.txt'))
@@ -0,0 +1,93 @@
+"""Accuracy of the incomplete beta of c/betaCDFLib.c"""
+import numpy as np
+import pytest
+from scipy.stats import beta as betaDist, norm
+import betaCDF
+
+pytestmark = pytest.mark.skipif(not betaCDF.available(),\
+        reason=betaCDF.LIBRARY_NAME + " not built")
+
+def _grid():
+    params = np.logspace(-2, 5, 15)
+    xs = np.concatenate([np.logspace(-12, -1, 12), np.linspace(0.05, 0.95, 19),\
+            1 - np.logspace(-12, -1, 12)])
+    x, a, b = np.meshgrid(xs, params, params, indexing='ij')
+    return x.ravel(), a.ravel(), b.ravel()
+
+def test_gridAgainstScipy():
+    x, a, b = _grid()
+    logP, fallbacks = betaCDF.logBetaCDF(x, a, b, returnFallbacks=True)
+    expected = betaDist.logcdf(x, a, b)
+    # scipy's log(cdf) loses digits as the cdf nears underflow
+    kept = np.isfinite(expected) & (expected > -600)
+    assert kept.sum() > 0.7*len(x)
+    assert fallbacks == 0
+    np.testing.assert_allclose(logP[kept], expected[kept], rtol=1e-9,\
+            atol=1e-300)
+
+def test_meanNeighbourhoodOfLargeParameters():
+    for a, b in [(1e6, 1e6), (1e8, 1e5), (1e5, 1e8)]:
+        mean = a/(a + b)
+        sd = np.sqrt(a*b/(a + b)**2/(a + b + 1))
+        x = mean + sd*np.linspace(-20, 6, 27)
+        expected = betaDist.logcdf(x, a, b)
+        np.testing.assert_allclose(betaCDF.logBetaCDF(x, a, b), expected,\
+                rtol=1e-8)
+
+def _logBinomialLowerTail(mpmath, x, a, b):
+    # for integers a, b: I_x(a, b) = P(Binomial(a + b - 1, 1 - x) < b)
+    n = a + b - 1
+    x = mpmath.mpf(x)
+    term = x**n
+    total = term
+    for j in range(1, b):
+        term = term*(n - j + 1)/j*(1 - x)/x
+        total += term
+    return float(mpmath.log(total))
+
+def test_skewedLargeParametersAgainstBinomialSums():
+    mpmath = pytest.importorskip('mpmath')
+    mpmath.mp.dps = 40
+    for a, b in [(10**9, 1000), (10**8, 100), (10**7, 10)]:
+        mean = a/(a + b)
+        sd = np.sqrt(a*b/(a + b)**2/(a + b + 1))
+        for z in np.linspace(-30, 4, 18):
+            x = mean + sd*z
+            if x >= 1:
+                continue
+            expected = _logBinomialLowerTail(mpmath, x, a, b)
+            assert betaCDF.logBetaCDF(x, a, b) == pytest.approx(expected,\
+                    rel=1e-8)
+
+def test_deepTailsAgainstMpmath():
+    mpmath = pytest.importorskip('mpmath')
+    mpmath.mp.dps = 40
+    for x, a, b in [(0.12200866253952192, 355.743, 23.876),\
+            (0.9842391671314614, 46928.3, 9.7707), (1e-30, 2.5, 7.0),\
+            (0.5118087715475601, 1115.82, 12.4675), (0.3, 2000.0, 50.0)]:
+        expected = float(mpmath.log(mpmath.betainc(a, b, 0, x,\
+                regularized=True)))
+        assert betaCDF.logBetaCDF(x, a, b) == pytest.approx(expected,\
+                rel=1e-11)
+
+def test_fallbackMatchesTheNormalLimit():
+    # a symmetric Beta with a = b = 1e12 is normal to about 1e-12
+    a = b = 1e12
+    sd = np.sqrt(0.25/(a + b + 1))
+    z = np.linspace(-3, 3, 61)
+    logP, fallbacks = betaCDF.logBetaCDF(0.5 + sd*z, a, b,\
+            returnFallbacks=True)
+    assert fallbacks > 0
+    np.testing.assert_allclose(logP, norm.logcdf(z), rtol=1e-8)
+
+def test_edges():
+    logP = betaCDF.logBetaCDF([0.0, 1.0, 0.5, 1.5, -0.1, 0.5],\
+            [2.0, 2.0, 0.0, 2.0, 2.0, 2.0], [3.0, 3.0, 3.0, 3.0, 3.0, -1.0])
+    assert logP[0] == -np.inf
+    assert logP[1] == 0.0
+    assert np.isnan(logP[2:]).all()
+
+def test_threadsGiveTheSameValues():
+    x, a, b = _grid()
+    np.testing.assert_array_equal(betaCDF.logBetaCDF(x, a, b, threads=4),\
+            betaCDF.logBetaCDF(x, a, b))
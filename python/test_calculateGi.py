@@ -0,0 +1,81 @@
+"""Gi* z-scores against a direct loop over every pair of darts"""
+import math
+import numpy as np
+import pytest
+import GREATx
+import calculateGi
+
+BAND = 5000000
+
+@pytest.fixture(scope='module')
+def table(dataset):
+    scores, table = GREATx.run(dataset['lociFn'], dataset['ontoToGeneFn'],\
+            dataset['dartFn'], 1000000, 0, 333333, 5)
+    return table
+
+def _bruteForceGiStar(table, band, kernel, includeSelf):
+    """Returns {(termID, dartName): z-score or None} as the original
+    calculateGi.py loop computed it"""
+    result = {}
+    for termCode, termID in enumerate(table.termIDs.tolist()):
+        if termID == 'UNKNOWN':
+            continue
+        darts = {}
+        for row in np.flatnonzero(table.termCodes == termCode).tolist():
+            name = table.dartNames[table.dartCodes[row]]
+            weight, chrCode, position = darts.get(name, (0.0,\
+                    table.chrCodes[row], table.dartPositions[row]))
+            darts[name] = (weight + table.weights[row], chrCode, position)
+        n = len(darts)
+        weights = [weight for weight, chrCode, position in darts.values()]
+        xBar = sum(weights)/n
+        S = math.sqrt(max(sum(w*w for w in weights)/n - xBar**2, 0.0))
+        for nameI, (weightI, chrI, positionI) in darts.items():
+            A = B = C = 0.0
+            for nameJ, (weightJ, chrJ, positionJ) in darts.items():
+                if (nameI == nameJ and not includeSelf) or chrI != chrJ:
+                    continue
+                distance = abs(positionI - positionJ)
+                if distance > band:
+                    w = 0.0
+                elif kernel == 'binary':
+                    w = 1.0
+                else:
+                    w = math.exp(-0.5*(distance/(band/3.0))**2)
+                A += w*weightJ
+                B += w
+                C += w*w
+            denominator = S*math.sqrt((n*C - B*B)/(n - 1)) if n > 1 else 0.0
+            result[(termID, nameI)] = (A - xBar*B)/denominator\
+                    if denominator > 1e-12 else None
+    return result
+
+@pytest.mark.parametrize('kernel,includeSelf', [('binary', False),\
+        ('binary', True), ('gaussian', False)])
+def test_giStarMatchesBruteForce(table, kernel, includeSelf):
+    expected = _bruteForceGiStar(table, BAND, kernel, includeSelf)
+    result = calculateGi.calculateGiStar(table, band=BAND, kernel=kernel,\
+            includeSelf=includeSelf, termChunk=7)
+    found = {}
+    for termCode, dartCode, zScore in zip(result.termCodes.tolist(),\
+            result.dartCodes.tolist(), result.zScores.tolist()):
+        found[(table.termIDs[termCode], table.dartNames[dartCode])] = zScore
+    assert sorted(found) == sorted(expected)
+    assert any(z is not None for z in expected.values())
+    for key, zScore in expected.items():
+        if zScore is None:
+            assert np.isnan(found[key])
+        else:
+            assert found[key] == pytest.approx(zScore, rel=1e-8, abs=1e-8)
+
+def test_spatialWeightsWithinTheBand():
+    chrCodes = np.array([0, 0, 0, 1, 0])
+    positions = np.array([100, 250, 400, 120, 160])
+    W = calculateGi.buildSpatialWeights(chrCodes, positions, band=150)
+    expected = np.zeros((5, 5))
+    for i in range(5):
+        for j in range(5):
+            if i != j and chrCodes[i] == chrCodes[j] and\
+                    abs(positions[i] - positions[j]) <= 150:
+                expected[i, j] = 1
+    np.testing.assert_array_equal(W.toarray(), expected)
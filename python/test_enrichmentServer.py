@@ -0,0 +1,63 @@
+"""Tests of the enrichment service"""
+import threading
+import GREATx
+import enrichmentServer
+
+def _service(dataset, **kwargs):
+    return enrichmentServer.EnrichmentService(dataset['lociFn'],\
+            [('synthetic', dataset['ontoToGeneFn'], dataset['ontoTermsFn'])],\
+            antigapFn=dataset['antigapFn'], **kwargs)
+
+def _dartLines(dataset):
+    with open(dataset['dartFn']) as f:
+        return f.readlines()
+
+def test_scoreMatchesRun(dataset):
+    service = _service(dataset)
+    scores, table = GREATx.run(dataset['lociFn'], dataset['ontoToGeneFn'],\
+            dataset['dartFn'], 500000, 0, 100000, 5,\
+            antigapFn=dataset['antigapFn'], wantTable=False)
+    expected = "".join(GREATx.rankedTermLines(scores,\
+            GREATx.buildOntoTermsDict(dataset['ontoTermsFn']), scores.nTerms))
+    assert service.score(_dartLines(dataset), cutOff=500000, sd=100000) ==\
+            expected
+
+def test_buildingAnIndexBlocksNoOtherRequest(dataset, monkeypatch):
+    service = _service(dataset)
+    started, release = threading.Event(), threading.Event()
+    builds = []
+
+    def slowIndex(regDoms, *args):
+        builds.append(regDoms)
+        started.set()
+        assert release.wait(30)
+        return GREATx.OntologyIndex(regDoms, *args)
+    monkeypatch.setattr(enrichmentServer, 'OntologyIndex', slowIndex)
+
+    lines = _dartLines(dataset)
+    results = []
+    newCutOff = [threading.Thread(target=lambda: results.append(\
+            service.score(lines, cutOff=500000))) for i in range(3)]
+    for thread in newCutOff:
+        thread.start()
+    assert started.wait(30)
+    # the default index is loaded: this request must not wait for the build
+    done = threading.Event()
+    other = threading.Thread(target=lambda: (service.score(lines),\
+            done.set()))
+    other.start()
+    assert done.wait(30)
+    release.set()
+    for thread in newCutOff + [other]:
+        thread.join(30)
+    assert len(builds) == 1
+    assert len(results) == 3 and len(set(results)) == 1
+    assert sorted(cutOff for ontology, cutOff in service._indexes) ==\
+            [500000, 1000000]
+
+def test_indexesAreEvictedLeastRecentlyUsedFirst(dataset):
+    service = _service(dataset, maxIndexes=2)
+    for cutOff in (500000, 1000000, 200000):
+        service.ontologyIndex('synthetic', cutOff)
+    assert list(service._indexes) == [('synthetic', 1000000),\
+            ('synthetic', 200000)]
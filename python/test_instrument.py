@@ -0,0 +1,68 @@
+"""Stage timings and counters of instrument.py"""
+import json
+import time
+import numpy as np
+import pytest
+import GREATx
+import instrument
+
+@pytest.fixture
+def recorder():
+    yield instrument.start()
+    instrument.stop()
+
+@instrument.timed('outer')
+def _work(seconds, records):
+    with instrument.stage('inner'):
+        time.sleep(seconds)
+        instrument.count('records', records)
+        # a stage entered within itself is part of the outer pass
+        with instrument.stage('inner'):
+            instrument.count('records', 1)
+    return records
+
+def test_nothingIsRecordedUntilStarted():
+    assert instrument.active() is None
+    assert instrument.stage('idle') is instrument.stage('other')
+    instrument.count('records')
+    assert _work(0, 2) == 2
+
+def test_stagesRecordTheirNameTimingAndCounts(recorder):
+    assert instrument.active() is recorder
+    _work(0.05, 3)
+    _work(0.05, 4)
+    assert list(recorder.stages) == ['outer', 'outer/inner']
+    outer, inner = recorder.stages['outer'], recorder.stages['outer/inner']
+    assert outer['calls'] == inner['calls'] == 2
+    assert inner['wallSeconds'] >= 0.1
+    assert outer['wallSeconds'] >= inner['wallSeconds']
+    assert inner['counters'] == {'records': 9}
+    assert outer['counters'] == {}
+    assert recorder.counters == {'records': 9}
+
+def test_instrumentedRunGivesTheSameScores(dataset, tmp_path):
+    args = (dataset['lociFn'], dataset['ontoToGeneFn'], dataset['dartFn'],\
+            500000, 0, 100000, 5)
+    scores, table = GREATx.run(*args, antigapFn=dataset['antigapFn'])
+    instrument.start(profileFn=str(tmp_path / 'run.prof'))
+    try:
+        instrumented, table = GREATx.run(*args, antigapFn=dataset['antigapFn'])
+    finally:
+        recorder = instrument.stop()
+    assert instrument.active() is None
+    assert instrumented.termIDs.tolist() == scores.termIDs.tolist()
+    np.testing.assert_array_equal(instrumented.logPvals, scores.logPvals)
+
+    reportFn = str(tmp_path / 'run.json')
+    recorder.write(reportFn)
+    with open(reportFn) as f:
+        report = json.load(f)
+    stages = dict((stage['stage'], stage) for stage in report['stages'])
+    for name in ('regdoms', 'ontology', 'darts', 'overlap', 'assignWeights',\
+            'associations', 'scoring'):
+        assert stages[name]['calls'] >= 1
+        assert stages[name]['wallSeconds'] >= 0
+    assert report['counters']['darts'] == len(GREATx.DartSet.fromFile(\
+            dataset['dartFn']))
+    assert report['counters']['terms'] == len(scores.termIDs)
+    assert (tmp_path / 'run.prof').exists()
@@ -0,0 +1,56 @@
+"""Tests of the pipeline cache and its eviction"""
+import os
+import subprocess
+import sys
+import pipelineCache
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def _write(text):
+    def build(fn):
+        with open(fn, 'w') as f:
+            f.write(text)
+    return build
+
+def test_fetchBuildsOnceAndReuses(tmp_path):
+    cache = pipelineCache.PipelineCache(str(tmp_path))
+    key = cache.key('stage', ['abc'], cutOff=1)
+    assert key == cache.key('stage', ['abc'], cutOff=1)
+    assert key != cache.key('stage', ['abc'], cutOff=2)
+    fn = cache.fetch(key, _write('first'))
+    assert cache.fetch(key, _write('second')) == fn
+    with open(fn) as f:
+        assert f.read() == 'first'
+
+def test_evictionKeepsTheKeysOfTheRun(tmp_path):
+    cache = pipelineCache.PipelineCache(str(tmp_path), maxBytes=1)
+    fns = [cache.fetch(cache.key('stage', [str(i)]), _write('x'*100))\
+            for i in range(3)]
+    assert all(os.path.exists(fn) for fn in fns)
+
+    # a later run evicts them, but never its own files
+    later = pipelineCache.PipelineCache(str(tmp_path), maxBytes=1)
+    fn = later.fetch(later.key('stage', ['later']), _write('x'*100))
+    assert os.path.exists(fn)
+    assert not any(os.path.exists(fn) for fn in fns)
+
+def _runGREATx(dataset, cacheDir, outDir, cutOff):
+    outFn = os.path.join(outDir, 'out%d.txt' % cutOff)
+    subprocess.check_call([sys.executable, os.path.join(HERE, 'GREATx.py'),\
+            '--cache-dir', cacheDir, '--cache-size', '1000',\
+            dataset['lociFn'], dataset['ontoToGeneFn'], dataset['dartFn'],\
+            os.path.join(outDir, 'SRFtoTerms%d.data' % cutOff), outFn,\
+            str(cutOff), '0', '333333', '5', dataset['ontoTermsFn']],\
+            stdout=subprocess.DEVNULL)
+    with open(outFn) as f:
+        return f.read()
+
+def test_tinyCacheSize(dataset, tmp_path):
+    cacheDir = str(tmp_path / 'cache')
+    first = _runGREATx(dataset, cacheDir, str(tmp_path), 1000000)
+    assert first
+    assert len(os.listdir(cacheDir)) == 4
+    # the second run evicts the first run's files as it goes
+    assert _runGREATx(dataset, cacheDir, str(tmp_path), 500000)
+    assert len(os.listdir(cacheDir)) == 4
+    assert _runGREATx(dataset, cacheDir, str(tmp_path), 1000000) == first